@@ -1,10 +1,11 @@
 from django.conf import settings
 from django.contrib import admin
 from django.utils import timezone
-from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification
+from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification, OutboxEmail, DigestEntry
 from django.apps import apps
 from django.contrib.auth.models import User, Group
 from .forms import SubscriptionModelForm, MonitorModelForm
+from .counters import reset_counters
 from guardian.admin import GuardedModelAdmin
 Device = apps.get_model(settings.DEVICE_MODEL)
 Var = apps.get_model(settings.VAR_MODEL)
@@ -294,11 +295,12 @@ set_active_false.short_description = 'Set active status false'
 
 @admin.register(Subscription)
 class SubscriptionAdmin(GuardedModelAdmin):
-    list_display = ('__str__', 'user', 'group', 'alarm', 'email', 'staff_template', 'user_template',
+    list_display = ('__str__', 'user', 'group', 'alarm', 'email', 'delivery', 'staff_template', 'user_template',
                     'active')
-    list_filter = (UserListFilter_Subscription, GroupListFilter_Subscription, AlarmListFilter_Subscription, 'email')
+    list_filter = (UserListFilter_Subscription, GroupListFilter_Subscription, AlarmListFilter_Subscription, 'email',
+                   'delivery')
     fieldsets = ((None, {
-                     'fields': ('active', 'created', 'alarm', 'email',)
+                     'fields': ('active', 'created', 'alarm', 'email', 'delivery',)
                  }),
                  ('User or group', {
                      'fields': ('user', 'group')
@@ -363,19 +365,50 @@ class UserListFilter_Notification(admin.SimpleListFilter):
             return queryset.filter(user=self.value())
 
 
+def set_status(queryset, value):
+
+    """
+    Change the status of notifications, their users are counted again (see alarms.counters)
+    """
+    notifications = list(queryset.values_list('user_id', 'group_id'))
+    queryset.update(status=value)
+    reset_counters(user_ids=[user_id for user_id, group_id in notifications if user_id is not None],
+                   group_ids=[group_id for user_id, group_id in notifications if group_id is not None])
+
+
 def set_status_checked(modeladmin, request, queryset):
-    queryset.update(status='checked')
+    set_status(queryset, 'checked')
 set_status_checked.short_description = 'Set status checked'
 
 
 def set_status_unchecked(modeladmin, request, queryset):
-    queryset.update(status='unchecked')
+    set_status(queryset, 'unchecked')
 set_status_unchecked.short_description = 'Set status unchecked'
 
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'user', 'event', 'status', 'created')
+    list_display = ('__str__', 'user', 'group', 'event', 'status', 'created')
     list_filter = (EventTypeListFilter_Notification, UserListFilter_Notification, 'status', 'created')
     ordering = ('-pk', )
-    actions = [set_status_checked, set_status_unchecked]
\ No newline at end of file
+    actions = [set_status_checked, set_status_unchecked]
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'event', 'subject', 'recipients', 'status', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('status', 'created')
+    ordering = ('-pk', )
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DigestEntry)
+class DigestEntryAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'user', 'event', 'email', 'created')
+    list_filter = ('created', )
+    ordering = ('-pk', )
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,145 @@
+# coding=utf-8
+import time
+from collections import namedtuple
+from threading import Lock
+from django.conf import settings
+from django.contrib.auth.models import User
+from .models import Subscription
+
+# Seconds before the audience of an alarm is resolved again, to take changes made by other processes
+AUDIENCE_TTL = getattr(settings, 'ALARMS_AUDIENCE_TTL', 60)
+
+# Kinds of email templates of a subscription
+TEMPLATE_FILE = 'file'
+TEMPLATE_TEXT = 'text'
+
+# Active subscription of an alarm: the subscribed user, or the users of the subscribed group
+SubscriptionAudience = namedtuple('SubscriptionAudience', ['pk', 'user_id', 'group_id', 'user_ids', 'email',
+                                                           'template', 'digest'])
+# Active subscriptions of an alarm, in creation order, and the emails of their users by user id
+Audience = namedtuple('Audience', ['subscriptions', 'emails'])
+
+
+def subscription_template(subscription):
+
+    """
+    Email template chosen for a subscription: staff template, staff text, user template or user text.
+    Empty or null texts aren't templates
+    :return: (TEMPLATE_FILE, template name), (TEMPLATE_TEXT, template code) or None
+    """
+    if subscription.staff_template is not None:
+        return TEMPLATE_FILE, subscription.staff_template
+    elif subscription.staff_template_text:
+        return TEMPLATE_TEXT, subscription.staff_template_text
+    elif subscription.user_template is not None:
+        return TEMPLATE_FILE, subscription.user_template
+    elif subscription.user_template_text:
+        return TEMPLATE_TEXT, subscription.user_template_text
+    return None
+
+
+def resolve_audience(alarm_id):
+
+    """
+    Users to notify of the events of an alarm, with three queries
+    :param alarm_id: Alarm id, or None for subscriptions without alarm
+    :return: Audience
+    """
+    subscriptions = list(Subscription.objects.filter(alarm_id=alarm_id, active=True).order_by('pk'))
+    group_ids = set(subscription.group_id for subscription in subscriptions if subscription.group_id is not None)
+    members = {}  # group id -> user ids
+    if group_ids:
+        for group_id, user_id in User.groups.through.objects.filter(group_id__in=group_ids)\
+                .order_by('user_id').values_list('group_id', 'user_id'):
+            members.setdefault(group_id, []).append(user_id)
+    items = []
+    for subscription in subscriptions:
+        if subscription.user_id is not None:
+            user_ids = (subscription.user_id, )
+        elif subscription.group_id is not None:
+            user_ids = tuple(members.get(subscription.group_id, ()))
+        else:
+            continue
+        items.append(SubscriptionAudience(subscription.pk, subscription.user_id, subscription.group_id, user_ids,
+                                          subscription.email, subscription_template(subscription),
+                                          subscription.delivery == Subscription.DIGEST))
+    user_ids = set(user_id for item in items for user_id in item.user_ids)
+    emails = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'email')) if user_ids else {}
+    return Audience(items, emails)
+
+
+class AudienceCache(object):
+
+    """
+    Audience of each alarm, resolved in the first event of the alarm. The event fan-out takes the
+    subscribed users from it instead of querying subscriptions, groups and users by event.
+    An alarm is resolved again when its subscriptions, the users of its subscribed groups, or its users
+    change (see signals), or after ttl seconds.
+    """
+
+    def __init__(self, ttl=AUDIENCE_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.audiences = {}  # alarm id -> (resolution time, Audience)
+        self.version = 0  # incremented when audiences are invalidated
+        # reverse indexes, to invalidate only the alarms affected by a change
+        self.by_subscription = {}  # subscription id -> alarm id
+        self.by_group = {}  # group id -> alarm ids
+        self.by_user = {}  # user id -> alarm ids
+
+    def get(self, alarm_id):
+
+        """
+        Audience of an alarm, resolved if it isn't cached or it's expired. If audiences are invalidated while
+        it's resolved, it isn't cached, so the next event resolves it again with the change
+        :return: Audience, it shouldn't be modified
+        """
+        entry = self.audiences.get(alarm_id)
+        if entry is not None and (self.ttl is None or time.time() - entry[0] <= self.ttl):
+            return entry[1]
+        version = self.version
+        audience = resolve_audience(alarm_id)
+        with self.lock:
+            if self.version != version:
+                return audience
+            self.audiences[alarm_id] = (time.time(), audience)
+            for item in audience.subscriptions:
+                self.by_subscription[item.pk] = alarm_id
+                if item.group_id is not None:
+                    self.by_group.setdefault(item.group_id, set()).add(alarm_id)
+            for user_id in audience.emails:
+                self.by_user.setdefault(user_id, set()).add(alarm_id)
+        return audience
+
+    def invalidate(self, alarm_ids):
+        with self.lock:
+            self.version += 1
+            for alarm_id in alarm_ids:
+                self.audiences.pop(alarm_id, None)
+
+    def alarms_for_subscription(self, subscription):
+
+        """
+        Alarms affected by a change of a subscription: its alarm, and the alarm it had when it was cached
+        """
+        alarm_ids = {subscription.alarm_id}
+        if subscription.pk in self.by_subscription:
+            alarm_ids.add(self.by_subscription[subscription.pk])
+        return alarm_ids
+
+    def alarms_for_groups(self, group_ids):
+        return set().union(*(self.by_group.get(group_id, ()) for group_id in group_ids))
+
+    def alarms_for_users(self, user_ids):
+        return set().union(*(self.by_user.get(user_id, ()) for user_id in user_ids))
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.audiences.clear()
+            self.by_subscription.clear()
+            self.by_group.clear()
+            self.by_user.clear()
+
+
+subscriber_audience = AudienceCache()
@@ -0,0 +1,163 @@
+# coding=utf-8
+import timeit
+from django.contrib.auth.models import User, Group
+from django.db import transaction
+from django.template import Template, Context
+from .models import Alarm, AlarmEvent, Notification
+from .expressions import parse_formula
+from .vectorized import vectorize
+
+FORMULA_CASES = (
+    ('{{ var.value }} > 12', {'var': {'value': 15}}),
+    ('{{ vars.voltaje.value }} < 5', {'vars': {'voltaje': {'value': 3}}}),
+    ('{{ vars.food.value }} < 5 and {{ vars.voltaje.value }} > 12',
+     {'vars': {'food': {'value': 0}, 'voltaje': {'value': 15}}}),
+    ('{{ var.value | bit:2 }}', {'var': {'value': 4}}),
+)
+
+
+def per_call(function, iterations):
+
+    """
+    Microseconds by call of function
+    """
+    return timeit.timeit(function, number=iterations) * 1000000.0 / iterations
+
+
+def benchmark_formulas(iterations=10000):
+
+    """
+    Compare the cost of an evaluation: template render + eval (previous path), with the template parsed
+    by evaluation or once (compiled formulas cache), vs parsed expression
+    :return: list of (formula, template microseconds, cached template microseconds, expression microseconds)
+    """
+    results = []
+    for formula, context in FORMULA_CASES:
+        def template_path():
+            template = Template('{% load alarms_template_filters %}' + formula)
+            return eval(template.render(Context(context)))
+
+        template = Template('{% load alarms_template_filters %}' + formula)
+        expression = parse_formula(formula)
+        assert bool(template_path()) == bool(expression.evaluate(context))
+        results.append((formula, per_call(template_path, iterations),
+                        per_call(lambda: eval(template.render(Context(context))), iterations),
+                        per_call(lambda: expression.evaluate(context), iterations)))
+    return results
+
+
+VECTORIZED_FORMULAS = ('{{ var.value }} > 12', '{{ var.value | bit:2 }}', '1 < {{ var.value }} <= 5 or {{ var.value }} > 40')
+VECTORIZED_SIZES = (10, 100, 1000, 10000)
+
+
+def benchmark_vectorized(iterations=10000):
+
+    """
+    Compare the cost of evaluating a formula for the vars of a monitor: var by var vs over arrays
+    :return: list of (formula, number of vars, var by var microseconds, vectorized microseconds)
+    """
+    results = []
+    for formula in VECTORIZED_FORMULAS:
+        expression = parse_formula(formula)
+        vectorized = vectorize(expression)
+        for size in VECTORIZED_SIZES:
+            vars = [{'value': value % 50} for value in range(size)]
+            repeat = max(1, iterations // size)
+            results.append((formula, size,
+                            per_call(lambda: [expression.evaluate({'var': var}) for var in vars], repeat),
+                            per_call(lambda: vectorized.evaluate(vars), repeat)))
+    return results
+
+
+FAN_OUT_SIZES = (100, 2000)
+
+
+def benchmark_fan_out(iterations=10000):
+
+    """
+    Compare the cost of notifying the users of a large group subscription: a create by user (previous path)
+    vs bulk fan-out. The users and events are created in the database inside a transaction which is rolled back
+    :return: list of (users, create by user milliseconds, bulk milliseconds)
+    """
+    from .signals import create_notifications
+
+    repeat = max(1, iterations // 5000)
+    results = []
+    with transaction.atomic():
+        alarm = Alarm.objects.create(name='benchmark', slug='benchmark-fan-out')
+        event = AlarmEvent.objects.create(alarm=alarm)
+        for size in FAN_OUT_SIZES:
+            User.objects.bulk_create([User(username='benchmark-%d-%d' % (size, number)) for number in range(size)])
+            user_ids = list(User.objects.filter(username__startswith='benchmark-%d-' % size)
+                            .values_list('pk', flat=True))
+
+            def create_by_user():
+                for user_id in user_ids:
+                    Notification.objects.create(user_id=user_id, event=event)
+
+            results.append((size, per_call(create_by_user, repeat) / 1000.0,
+                            per_call(lambda: create_notifications(event, user_ids), repeat) / 1000.0))
+        transaction.set_rollback(True)
+    return results
+
+
+FAN_OUT_ON_READ_EVENTS = 50
+
+
+def benchmark_fan_out_on_read(iterations=10000):
+
+    """
+    Compare a large group subscription notified by user (fan-out on write) vs one notification by group
+    (fan-out on read): rows written and milliseconds for FAN_OUT_ON_READ_EVENTS events, and milliseconds
+    to list the notifications of a user of the group. Inside a transaction which is rolled back
+    :return: list of (users, by user rows, by user write ms, by group rows, by group write ms,
+                      by user list ms, by group list ms)
+    """
+    from .signals import create_notifications
+    from .notifications import user_notifications
+
+    repeat = max(1, iterations // 5000)
+    results = []
+    with transaction.atomic():
+        alarm = Alarm.objects.create(name='benchmark', slug='benchmark-fan-out-on-read')
+        events = [AlarmEvent.objects.create(alarm=alarm) for number in range(FAN_OUT_ON_READ_EVENTS)]
+        for size in FAN_OUT_SIZES:
+            group = Group.objects.create(name='benchmark-%d' % size)
+            User.objects.bulk_create([User(username='benchmark-read-%d-%d' % (size, number))
+                                      for number in range(size)])
+            users = list(User.objects.filter(username__startswith='benchmark-read-%d-' % size))
+            group.user_set.add(*users)
+            user_ids = [user.pk for user in users]
+
+            def by_user():
+                for event in events:
+                    create_notifications(event, user_ids)
+
+            def by_group():
+                for event in events:
+                    create_notifications(event, [], [group.pk])
+
+            user = users[0]
+            rows = Notification.objects.count()
+            write_ms = per_call(by_user, 1) / 1000.0
+            user_rows = Notification.objects.count() - rows
+            user_list_ms = per_call(lambda: list(Notification.objects.filter(user=user)), repeat) / 1000.0
+            Notification.objects.filter(event__in=events).delete()
+            read_ms = per_call(by_group, 1) / 1000.0
+            group_rows = Notification.objects.count() - rows
+            group_list_ms = per_call(lambda: list(user_notifications(user)), repeat) / 1000.0
+            Notification.objects.filter(event__in=events).delete()
+            results.append((size, user_rows, write_ms, group_rows, read_ms, user_list_ms, group_list_ms))
+        transaction.set_rollback(True)
+    return results
+
+
+BENCHMARKS = {
+    'formulas': (benchmark_formulas, ('Formula', 'Template + eval (us)', 'Cached template + eval (us)',
+                                      'Expression (us)')),
+    'vectorized': (benchmark_vectorized, ('Formula', 'Vars', 'Var by var (us)', 'Vectorized (us)')),
+    'fan_out': (benchmark_fan_out, ('Group users', 'Create by user (ms)', 'Bulk (ms)')),
+    'fan_out_on_read': (benchmark_fan_out_on_read, ('Group users', 'By user rows', 'By user write (ms)',
+                                                    'By group rows', 'By group write (ms)', 'By user list (ms)',
+                                                    'By group list (ms)')),
+}
@@ -0,0 +1,66 @@
+# coding=utf-8
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, OuterRef, Subquery
+from .models import Notification, NotificationCounter
+from .notifications import user_notifications
+
+
+def count_notifications(user):
+
+    """
+    Count the notifications of a user and save its counter
+    :return: NotificationCounter
+    """
+    notifications = user_notifications(user)
+    counter = NotificationCounter(user=user, unchecked=notifications.filter(state=Notification.UNCHECKED).count(),
+                                  latest=notifications.aggregate(latest=Max('pk'))['latest'])
+    try:
+        with transaction.atomic():
+            counter.save(force_insert=True)
+    except IntegrityError:  # counted at once by other request
+        return NotificationCounter.objects.get(user=user)
+    return counter
+
+
+def get_counter(user):
+
+    """
+    Counter of a user, counted if it doesn't exist (first time, or reset)
+    :return: NotificationCounter
+    """
+    try:
+        return NotificationCounter.objects.get(user=user)
+    except NotificationCounter.DoesNotExist:
+        return count_notifications(user)
+
+
+def notified(event, user_ids, group_ids=()):
+
+    """
+    Add the notifications of an event to the existing counters of their users, with one update by kind
+    :param user_ids: ids of the users notified one by one
+    :param group_ids: ids of the groups notified with one notification
+    """
+    if user_ids:
+        latest = Notification.objects.filter(event=event, user=OuterRef('user')).order_by('-pk').values('pk')[:1]
+        NotificationCounter.objects.filter(user_id__in=user_ids)\
+            .update(unchecked=F('unchecked') + 1, latest=Subquery(latest))
+    if group_ids:
+        members = User.groups.through.objects.filter(group_id__in=group_ids).exclude(user_id__in=user_ids)\
+            .values('user_id')
+        latest = Notification.objects.filter(event=event, group__user=OuterRef('user')).order_by('pk').values('pk')[:1]
+        NotificationCounter.objects.filter(user_id__in=members)\
+            .update(unchecked=F('unchecked') + 1, latest=Subquery(latest))
+
+
+def reset_counters(user_ids=None, group_ids=None):
+
+    """
+    Delete the counters of users, or of the users of groups. They are counted again in the next read
+    """
+    if user_ids:
+        NotificationCounter.objects.filter(user_id__in=user_ids).delete()
+    if group_ids:
+        NotificationCounter.objects.filter(
+            user_id__in=User.groups.through.objects.filter(group_id__in=group_ids).values('user_id')).delete()
@@ -0,0 +1,73 @@
+# coding=utf-8
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+from .models import DigestEntry, OutboxEmail
+from .email_templates import template_cache
+
+# Seconds the events of a digest subscription are accumulated before its user receives them in one email
+DIGEST_WINDOW = getattr(settings, 'ALARMS_EMAIL_DIGEST_WINDOW', 900)
+# Plain text template of the digest emails
+DIGEST_TEMPLATE = 'digest.txt'
+
+
+def put_digest(event, recipients):
+
+    """
+    Save an event for the digests of its users
+    :param recipients: list of (user id, email)
+    """
+    if recipients:
+        DigestEntry.objects.bulk_create([DigestEntry(user_id=user_id, event=event, email=email)
+                                         for user_id, email in recipients])
+
+
+def digest_email(user, entries):
+
+    """
+    Digest email of a user, with all its entries
+    :param entries: list of DigestEntry of the user, in creation order
+    :return: unsaved OutboxEmail
+    """
+    context = {'user': user,
+               'events': [entry.event for entry in entries],
+               'since': entries[0].created}
+    body = template_cache.get_file(DIGEST_TEMPLATE).render(context)
+    return OutboxEmail(subject='Event Digest: %d events' % len(entries), from_email='noreply@localhost.com',
+                       recipients=entries[-1].email, body=body)
+
+
+def flush_digests(window=DIGEST_WINDOW, now=None):
+
+    """
+    Put in the outbox the digests of the users which oldest entry is older than window seconds, and delete
+    their entries. The entries of a user are deleted and its email saved in a savepoint, if other sender
+    flushed them first the digest is discarded.
+    :return: number of digest emails put in the outbox
+    """
+    now = now or timezone.now()
+    user_ids = list(DigestEntry.objects.values('user').annotate(first=Min('created'))
+                    .filter(first__lte=now - timedelta(seconds=window)).order_by().values_list('user', flat=True))
+    if not user_ids:
+        return 0
+    by_user = {}  # user id -> list of DigestEntry
+    for entry in DigestEntry.objects.filter(user_id__in=user_ids, created__lte=now)\
+            .select_related('user', 'event__alarm', 'event__device', 'event__variables').order_by('created', 'pk'):
+        by_user.setdefault(entry.user_id, []).append(entry)
+    emails = 0
+    for user_id, entries in by_user.items():
+        with transaction.atomic():
+            deleted = DigestEntry.objects.filter(pk__in=[entry.pk for entry in entries]).delete()[0]
+            if deleted != len(entries):
+                transaction.set_rollback(True)
+                continue
+            try:
+                digest_email(entries[0].user, entries).save()
+            except Exception as e:  # the entries are kept for the next flush
+                transaction.set_rollback(True)
+                print('Error rendering the digest of %s. Details: %s' % (entries[0].user, e))
+                continue
+        emails += 1
+    return emails
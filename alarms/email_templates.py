@@ -0,0 +1,127 @@
+# coding=utf-8
+import re
+from threading import Lock
+from django.template import Template, Context
+from django.template.loader import get_template
+from .audience import TEMPLATE_FILE
+
+# Plain text template of the event emails
+MAIL_TEMPLATE = 'mail.txt'
+# Templates which mention the user are rendered by user, the others once by event
+USER_VARIABLE = re.compile(r'\buser\b')
+
+
+class CompiledTemplate(object):
+
+    """
+    Email template parsed only once. If it can't be loaded or parsed, the error is kept and raised in each render.
+    """
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.template = None
+        self.error = None
+        self.uses_user = True
+        try:
+            if kind == TEMPLATE_FILE:
+                self.template = get_template(value)
+                source = self.template.template.source
+            else:
+                self.template = Template(value)
+                source = value
+            self.uses_user = bool(USER_VARIABLE.search(source))
+        except Exception as e:
+            self.error = e
+
+    def render(self, context):
+
+        """
+        :param context: dict with the event, alarm, user, device, var...
+        :return: rendered text
+        """
+        if self.error is not None:
+            raise self.error
+        if self.kind == TEMPLATE_FILE:
+            return self.template.render(context)
+        return self.template.render(Context(context))
+
+
+class TemplateCache(object):
+
+    """
+    Compiled email templates: template files by name, and template texts by subscription id. Each text entry
+    keeps the hash of the text which was compiled, so a changed text is compiled again even if it wasn't
+    invalidated (see signals, it's invalidated when the subscription is saved or deleted).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}  # template name -> CompiledTemplate
+        self.texts = {}  # subscription id -> (text hash, CompiledTemplate)
+
+    def get(self, subscription_id, template):
+
+        """
+        Compiled template of a subscription
+        :param template: (TEMPLATE_FILE, template name) or (TEMPLATE_TEXT, template code)
+        :return: CompiledTemplate
+        """
+        kind, value = template
+        if kind == TEMPLATE_FILE:
+            return self.get_file(value)
+        text_hash = hash(value)
+        entry = self.texts.get(subscription_id)
+        if entry is not None and entry[0] == text_hash:
+            return entry[1]
+        compiled = CompiledTemplate(kind, value)
+        with self.lock:
+            self.texts[subscription_id] = (text_hash, compiled)
+        return compiled
+
+    def get_file(self, name):
+        compiled = self.files.get(name)
+        if compiled is None:
+            compiled = CompiledTemplate(TEMPLATE_FILE, name)
+            with self.lock:
+                self.files[name] = compiled
+        return compiled
+
+    def invalidate(self, subscription_id):
+        with self.lock:
+            self.texts.pop(subscription_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.texts.clear()
+
+
+template_cache = TemplateCache()
+
+
+class EventRenderer(object):
+
+    """
+    Renders of the emails of an event. A template is rendered once for the event, or once by user
+    (or group) if it mentions the user, instead of once by email.
+    """
+
+    def __init__(self):
+        self.rendered = {}  # (template key, user or None) -> rendered text
+
+    def render(self, key, compiled, context):
+        render_key = (key, context.get('user') if compiled.uses_user else None)
+        if render_key not in self.rendered:
+            self.rendered[render_key] = compiled.render(context)
+        return self.rendered[render_key]
+
+    def plain_text(self, context):
+        return self.render(MAIL_TEMPLATE, template_cache.get_file(MAIL_TEMPLATE), context)
+
+    def html(self, subscription_id, template, context):
+
+        """
+        HTML of a subscription template
+        :param template: (TEMPLATE_FILE, template name), (TEMPLATE_TEXT, template code)
+        """
+        return self.render(template, template_cache.get(subscription_id, template), context)
@@ -0,0 +1,272 @@
+# coding=utf-8
+from django.conf import settings
+from django.utils import timezone
+from .models import Alarm, AlarmEvent, MonitorLookupVar
+from .expressions import FormulaError
+from .formulas import get_formula
+from .routing import routing_index
+from .states import event_states, can_open, create_event, finish_events
+from .vectorized import vectorize
+
+from django.apps import apps
+Device = apps.get_model(settings.DEVICE_MODEL)
+Var = apps.get_model(settings.VAR_MODEL)
+
+# Minimum number of vars to evaluate a formula over arrays, with less vars it is slower than var by var
+VECTORIZE_MIN_VARS = getattr(settings, 'ALARMS_VECTORIZE_MIN_VARS', 16)
+# Ids by query, under the SQLite variables limit
+QUERY_BATCH_SIZE = 500
+
+
+def create_event_for_alarm_formula_by_device_update(instance, now=None):
+
+    """
+    Create event by formula field in alarm referenced by updated device
+    :param instance: Device
+    :param now: evaluation date, the date of the device update
+    """
+    now = now or timezone.now()
+    alarm_ids = routing_index.alarms_for_device(instance.pk)
+    if not alarm_ids:  # the device isn't monitored by an alarm
+        return
+    # Get the alarms reference by monitors list
+    alarms = Alarm.objects.filter(pk__in=alarm_ids, monitor__devices=instance, monitor__active=True).distinct()
+    #vars = instance.vars.values('value', 'slug', 'var_type')
+    vars = Var.objects.filter(device=instance).values('value', 'slug', 'var_type')
+    context = {
+        'vars': {var_item['var_type']: var_item for var_item in vars},
+        'device': instance
+    }
+    var_types = [var_item['var_type'] for var_item in vars]  # Device var_types
+    for alarm in alarms:
+        condition = False
+        try:
+            # example -> {{ vars.voltaje.value }} > 12, eval the formula with values in context dictionary
+            condition = get_formula(alarm).evaluate(context)
+        except:
+            print('Error al ejecutar formula de alarma ' + alarm.name)
+            condition = None
+            break  # if formula false, next alarm or variable
+
+        n_vars_in_formula = 0  # count the vars in formula field
+        var_in_formula = None
+        if condition:  # if formula expression return True
+            for var_type in var_types:
+                if var_type in alarm.formula:
+                    n_vars_in_formula += 1
+                    var_in_formula = Var.objects.get(var_type=var_type, device=instance)
+            # Only work for one var in formula, if two or more, is hard to determinate which generate alarm
+            # in case two or more variables are in formula, 'variables' field get null value.
+            if n_vars_in_formula == 1:
+                create_event(alarm, instance, var_in_formula)
+            else:
+                create_event(alarm, instance, None)
+            print('Evento creado')
+        elif condition == False:  # if formula return False, NO CASE IF FORMULA FAULTS
+            for var_type in var_types:
+                if var_type in alarm.formula:
+                    n_vars_in_formula += 1
+                    var_in_formula = Var.objects.get(var_type=var_type, device=instance)
+            # only works for only one var, too.
+            # In this, we want to set finished date to the events with same var and device, don't have finished date,
+            # and because false, have a good value for variable.
+            if n_vars_in_formula == 1:
+                finish_events(alarm, instance.pk, var_in_formula.pk, now)
+
+
+def create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(instance, now=None):
+
+    """
+    Create event by alarm formula field for alarm type, no only variable instance
+    :param instance: Var, or list of Vars updated in the same transaction. Each alarm is evaluated once by var
+    :param now: evaluation date, the date of the var update
+    """
+    now = now or timezone.now()
+    if not routing_index.lookup_alarms_exist():  # no alarm is monitoring vars by lookups
+        return
+    instances = instance if isinstance(instance, (list, tuple)) else [instance]
+    # Monitors which lookups are satisfied by each var, saved in MonitorLookupVar by signals
+    var_monitors = {}
+    for var_id, monitor_id in MonitorLookupVar.objects.filter(var__in=[item.pk for item in instances])\
+            .values_list('var_id', 'monitor_id'):
+        var_monitors.setdefault(var_id, set()).add(monitor_id)
+
+    evaluated = set()  # (alarm id, var id) already evaluated by other var of the list
+    for monitors in sorted(set(frozenset(ids) for ids in var_monitors.values()), key=sorted):
+        if not routing_index.alarms_for_lookup_monitors(monitors):
+            continue
+        vars = Var.objects.filter(monitorlookupvar__monitor__in=monitors).distinct().order_by('pk')
+        alarms = Alarm.objects.filter(monitor__in=monitors, monitor__active=True).distinct().order_by('pk')
+        evaluate_alarms_for_lookups_vars(alarms, vars, now, evaluated)
+
+
+def evaluate_alarms_for_lookups_vars(alarms, vars, now, evaluated):
+
+    """
+    Create or finish the events of each alarm with each var of its lookup monitors.
+    Formulas which can be vectorized are evaluated for all the vars at once (see alarms.vectorized)
+    :param evaluated: set of (alarm id, var id) to skip, updated with the evaluated ones
+    """
+    vars = list(vars)
+    context = {'vars': {}, 'var': {}}
+    for alarm in alarms:
+        pending = [var_item for var_item in vars if (alarm.pk, var_item.pk) not in evaluated]
+        vectorized = vectorize(get_formula(alarm).expression) if len(pending) >= VECTORIZE_MIN_VARS else None
+        if vectorized is not None:
+            try:
+                true_mask, false_mask = vectorized.evaluate(pending)
+            except FormulaError:  # i.e some value is not a number, evaluate var by var
+                pass
+            else:
+                context['vars'].update((var_item.slug, var_item) for var_item in vars)
+                evaluated.update((alarm.pk, var_item.pk) for var_item in pending)
+                open_events_for_vars(alarm, [var_item for var_item, true in zip(pending, true_mask) if true], now)
+                finish_events_for_vars(alarm, [var_item for var_item, false in zip(pending, false_mask) if false], now)
+                continue
+
+        for var_item in vars:
+            context['vars'][var_item.slug] = var_item  # i.e -> {'food-al1': <Var: 'food-al1'>, 'food-other': <Var: 'food-other'>}
+            if (alarm.pk, var_item.pk) in evaluated:
+                continue
+            evaluated.add((alarm.pk, var_item.pk))
+            context['var'] = var_item  # Current var
+            # Evaluate the condition and take a boolean(True or False) if another result is another, nothing happens
+            try:
+                # example -> {{ var.value }} > 12
+                # Evaluate the condition and take a boolean(True or False) if another result is another, nothing happens
+                condition = get_formula(alarm).evaluate(context)
+            except:
+                print('Error evaluating formula of ' + alarm.name + ', variable: ' + var_item.slug)
+                condition = None
+                pass
+
+            if var_item.device_id is None:
+                continue
+            if condition == True:  # if formula evaluation return True
+                # a new event only if the last one was created more than alarm.duration hours before
+                if can_open(alarm, var_item.device_id, var_item.pk, now):
+                    create_event(alarm, var_item.device_id, var_item.pk)
+                    print('Event created')
+            elif condition == False:  # if formula evaluation return False, NO CASE IF FORMULA FAULT
+                # In this, we want to set finished date to the events with same var and device, don't have finished date
+                # and because false, have a good value for variable.
+                finish_events(alarm, var_item.device_id, var_item.pk, now)
+
+
+def chunks(items, size=QUERY_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def open_events_for_vars(alarm, vars, now):
+
+    """
+    Create events of an alarm which formula is True for the vars, unless the last event
+    of the var was created less than alarm.duration hours before
+    :param vars: Var instances
+    """
+    for var_item in vars:
+        if var_item.device_id is not None and can_open(alarm, var_item.device_id, var_item.pk, now):
+            create_event(alarm, var_item.device_id, var_item.pk)
+            print('Event created')
+
+
+def finish_events_for_vars(alarm, vars, now):
+
+    """
+    Set finished date to the open events of an alarm which formula is False for the vars
+    :param vars: Var instances
+    """
+    var_ids_by_device = {}
+    for var_item in vars:  # only the vars with open events of the alarm
+        if event_states.state(alarm.pk, var_item.device_id, var_item.pk).open:
+            var_ids_by_device.setdefault(var_item.device_id, []).append(var_item.pk)
+    for device_id, var_ids in var_ids_by_device.items():
+        for batch in chunks(var_ids):
+            AlarmEvent.objects.filter(alarm=alarm, variables__in=batch, device_id=device_id, finished=None)\
+                .update(finished=now, description=alarm.description)
+            for var_id in batch:
+                event_states.finished(alarm.pk, device_id, var_id)
+
+
+def create_event_for_alarm_formula_looking_var_for_monitor_var_selection(instance, now=None):
+
+    """
+    Create an event if var instance satisfy the condition in formula field of an alarm
+    :param instance: Var
+    :param now: evaluation date, the date of the var update
+    """
+    now = now or timezone.now()
+    # Only for alarms with monitors with selected variables in select box, and no with lookups
+    alarm_ids = routing_index.alarms_for_var(instance.pk)
+    if not alarm_ids:  # the var isn't monitored by an alarm
+        return
+    # Alarms like {{ var.value }} > 12 are triggered or cleared by bisection of their thresholds. Only the
+    # triggered ones, and the cleared ones with open events, are taken from database
+    thresholds = routing_index.thresholds_for_var(instance.pk)
+    triggered = None
+    if thresholds and thresholds.accepts(instance.value):
+        triggered = thresholds.triggered(instance.value)
+        open_alarm_ids = [alarm_id for alarm_id, state in event_states.get(instance.device_id, instance.pk).items()
+                          if state.open]
+        alarm_ids = set(alarm_id for alarm_id in alarm_ids if alarm_id not in thresholds) | triggered | \
+            set(alarm_id for alarm_id in open_alarm_ids if alarm_id in thresholds)
+        if not alarm_ids:
+            return
+    alarms = Alarm.objects.filter(pk__in=alarm_ids, monitor__variables=instance, monitor__active=True,
+                                  monitor__lookups="").distinct()
+    context = {
+        'vars': {instance.slug: {'slug': instance.slug, 'var_type': instance.var_type, 'value': instance.value,
+                                 'device': instance.device}},
+        'var': {'slug': instance.slug, 'value': instance.value, 'device': instance.device}
+    }
+
+    for alarm in alarms:
+        condition = False
+        if triggered is not None and thresholds.matches(alarm):
+            condition = alarm.pk in triggered
+        else:
+            try:
+                # example -> {{ vars.voltaje.value }} > 12, eval the formula with values in context dictionary
+                condition = get_formula(alarm).evaluate(context)
+            except:
+                print('Error al ejecutar formula de alarma ' + alarm.name)
+                break
+
+        if condition == True:
+            if can_open(alarm, instance.device_id, instance.pk, now):
+                create_event(alarm, instance.device_id, instance.pk)
+        elif condition == False:
+            finish_events(alarm, instance.device_id, instance.pk, now)
+
+
+def create_event_for_not_specific_model_and_signal(sender_instance, alarm_instance):
+
+    """
+    Create an event for not specific signal, setting the instance in ContentType field of event.
+    This function should to be call by a post_save signal, to create an event with content_type field
+    The signal should call the function and pass the object instance and the alarm instance
+    :param sender_instance: Generic object
+    :param alarm_instance: Alarm instance
+    """
+    context = {
+        'var': sender_instance
+    }
+    # key 'var' take the object value, for this reason in alarm template,
+    # user can access to any field of it. Remember that template execution should return True or False
+
+    condition = False
+    try:
+        condition = get_formula(alarm_instance).evaluate(context)
+    except:
+        print('Formula error: ' + alarm_instance.name)
+        return
+
+    if condition == True:   # Create the new event
+        event = AlarmEvent.objects.create(alarm=alarm_instance)
+        event.content_type = [sender_instance]
+        event.save()
+    if condition == False:  # Update finished date to event
+        events = AlarmEvent.objects.filter(alarm=alarm_instance)
+        for event in events:
+            event.update(finished=timezone.now()) if list(event.content_type) == [sender_instance] else None
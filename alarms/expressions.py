@@ -0,0 +1,380 @@
+# coding=utf-8
+import ast
+import re
+import operator
+from functools import lru_cache
+from django.db.models import Q
+from django.template import Template, Context, TemplateSyntaxError
+from django.template.base import VariableNode, Variable
+from django.template.context import BaseContext
+
+# {{ vars.voltaje.value | bit:2 }} -> variable: vars.voltaje.value, filters: bit:2
+PLACEHOLDER_REGEX = re.compile(r'\{\{\s*(.*?)\s*\}\}')
+PLACEHOLDER_NAME = '_v%d'
+# Placeholders are parsed by the template engine, with built-in filters and the alarms filters available
+FORMULA_LIBRARIES = "{% load alarms_template_filters %}"
+
+BOOL_OPERATORS = (ast.And, ast.Or)
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+}
+
+UNARY_OPERATORS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Invert: operator.invert,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+CONSTANT_NAMES = {'True': True, 'False': False, 'None': None}
+MISSING = object()
+
+
+class FormulaError(Exception):
+
+    """
+    The formula or lookup can't be parsed, uses a not allowed expression, or can't be evaluated
+    """
+    pass
+
+
+def literal_argument(lookup, arg):
+
+    """
+    True if a filter argument is a constant, i.e 2 in bit:2
+    """
+    return not lookup or (isinstance(arg, Variable) and arg.lookups is None and not arg.translate)
+
+
+class Placeholder(object):
+
+    """
+    A {{ variable | filter:arg }} reference in a formula. It is parsed by the template engine only once,
+    and resolved against the context without rendering it, so the template rules apply:
+    no attributes beginning with underscores, and methods which alter data aren't called.
+    """
+
+    def __init__(self, text):
+        try:
+            template = Template('%s{{ %s }}' % (FORMULA_LIBRARIES, text))
+        except TemplateSyntaxError as e:
+            raise FormulaError('Invalid variable reference %s: %s' % (text, e))
+        nodes = [node for node in template.nodelist if isinstance(node, VariableNode)]
+        if len(nodes) != 1:
+            raise FormulaError('Invalid variable reference: %s' % text)
+        self.filter_expression = nodes[0].filter_expression
+        # Filters with literal arguments can be applied directly to values taken from plain dicts
+        self.simple_filters = []
+        for function, args in self.filter_expression.filters:
+            if getattr(function, 'needs_autoescape', False) or getattr(function, 'expects_localtime', False) \
+                    or not all(literal_argument(lookup, arg) for lookup, arg in args):
+                self.simple_filters = None
+                break
+            self.simple_filters.append((function, [arg.literal if lookup else arg for lookup, arg in args]))
+
+    @property
+    def path(self):
+        variable = self.filter_expression.var
+        return tuple(variable.lookups) if isinstance(variable, Variable) and variable.lookups else ()
+
+    @property
+    def filters(self):
+        return [function.__name__ for function, args in self.filter_expression.filters]
+
+    def resolve_values(self, values):
+
+        """
+        Resolve the placeholder walking plain dicts, i.e {'var': {'value': 5}}
+        :return: resolved value or MISSING if the values aren't plain dicts
+        """
+        path = self.path
+        if not path or self.simple_filters is None:
+            return MISSING
+        value = values
+        for name in path:
+            if type(value) is not dict or name not in value:
+                return MISSING
+            value = value[name]
+        if callable(value):
+            return MISSING
+        for function, args in self.simple_filters:
+            value = function(value, *args)
+        return to_value(value)
+
+    def resolve(self, context):
+        return to_value(self.filter_expression.resolve(context))
+
+
+def to_value(value):
+
+    """
+    Text values (i.e string fields or filter results) are used as python literals when is possible,
+    as the rendered formula was evaluated before.
+    """
+    if isinstance(value, str):
+        try:
+            return ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            return value
+    return value
+
+
+def constant_value(node):
+
+    """
+    Value of constant nodes (Num, Str, NameConstant or Constant, depending of python version)
+    """
+    for name, attribute in (('Constant', 'value'), ('Num', 'n'), ('Str', 's'), ('NameConstant', 'value')):
+        node_class = getattr(ast, name, None)
+        if node_class is not None and isinstance(node, node_class):
+            return getattr(node, attribute)
+    raise FormulaError('Not allowed expression: %s' % type(node).__name__)
+
+
+def compile_node(node, placeholders):
+
+    """
+    Compile a whitelisted AST node into a function which take the values of placeholders
+    :param node: AST node
+    :param placeholders: dict with placeholder names -> index in values list
+    :return: function(values) -> result
+    """
+    if isinstance(node, ast.Expression):
+        return compile_node(node.body, placeholders)
+
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, BOOL_OPERATORS):
+        operands = [compile_node(value, placeholders) for value in node.values]
+        stop_on = not isinstance(node.op, ast.And)
+
+        def evaluate_bool(values):
+            result = None
+            for operand in operands:
+                result = operand(values)
+                if bool(result) is stop_on:
+                    return result
+            return result
+        return evaluate_bool
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        function = BINARY_OPERATORS[type(node.op)]
+        left, right = compile_node(node.left, placeholders), compile_node(node.right, placeholders)
+        return lambda values: function(left(values), right(values))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        function = UNARY_OPERATORS[type(node.op)]
+        operand = compile_node(node.operand, placeholders)
+        return lambda values: function(operand(values))
+
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARE_OPERATORS for op in node.ops):
+        left = compile_node(node.left, placeholders)
+        comparisons = [(COMPARE_OPERATORS[type(op)], compile_node(comparator, placeholders))
+                       for op, comparator in zip(node.ops, node.comparators)]
+
+        def evaluate_compare(values):
+            current = left(values)
+            for function, comparator in comparisons:
+                other = comparator(values)
+                if not function(current, other):
+                    return False
+                current = other
+            return True
+        return evaluate_compare
+
+    if isinstance(node, (ast.Tuple, ast.List)):
+        items = [compile_node(item, placeholders) for item in node.elts]
+        return lambda values: tuple(item(values) for item in items)
+
+    if isinstance(node, ast.Name):
+        if node.id in placeholders:
+            index = placeholders[node.id]
+            return lambda values: values[index]
+        if node.id in CONSTANT_NAMES:
+            constant = CONSTANT_NAMES[node.id]
+            return lambda values: constant
+        raise FormulaError('Name %s is not allowed' % node.id)
+
+    constant = constant_value(node)
+    return lambda values: constant
+
+
+class Expression(object):
+
+    """
+    Alarm formula parsed into a whitelisted AST, i.e "{{ var.value | bit:2 }} and {{ vars.food.value }} < 5".
+    Placeholders are resolved against the context and the AST is evaluated with the resolved values,
+    without rendering or eval the formula.
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.placeholders = []
+        names = {}
+
+        def replace(match):
+            name = PLACEHOLDER_NAME % len(self.placeholders)
+            names[name] = len(self.placeholders)
+            self.placeholders.append(Placeholder(match.group(1)))
+            return ' %s ' % name
+
+        text = PLACEHOLDER_REGEX.sub(replace, formula).strip()
+        if '{' in text or '}' in text:
+            raise FormulaError('Unclosed placeholder in formula: %s' % formula)
+        try:
+            tree = ast.parse(text, mode='eval')
+        except SyntaxError as e:
+            raise FormulaError('Invalid formula %s: %s' % (formula, e))
+        self.tree = tree
+        self.names = names
+        self.function = compile_node(tree, names)
+
+    @property
+    def paths(self):
+
+        """
+        Variable paths referenced by the formula, i.e [('vars', 'food', 'value'), ('var', 'value')]
+        """
+        return [placeholder.path for placeholder in self.placeholders]
+
+    def evaluate(self, context):
+
+        """
+        Evaluate the expression
+        :param context: dict with values or objects, i.e {'var': {'value': 5}}
+        :return: expression result
+        """
+        values = context
+        template_context = context if isinstance(context, BaseContext) else None
+        try:
+            resolved = []
+            for placeholder in self.placeholders:
+                value = MISSING if template_context is not None else placeholder.resolve_values(values)
+                if value is MISSING:
+                    if template_context is None:
+                        template_context = Context(values)
+                    value = placeholder.resolve(template_context)
+                resolved.append(value)
+            return self.function(resolved)
+        except FormulaError:
+            raise
+        except Exception as e:
+            raise FormulaError('Error evaluating formula %s: %s' % (self.formula, e))
+
+
+@lru_cache(maxsize=1024)
+def parse_formula(formula):
+
+    """
+    Parse a formula into an Expression, cached by formula text
+    """
+    return Expression(formula)
+
+
+def compile_lookup_node(node):
+
+    """
+    Compile a Q objects expression node, i.e Q(slug__startswith='food') | ~Q(device__id__in=[1, 2])
+    :return: function() -> Q object
+    """
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'Q':
+        args = [compile_lookup_node(arg) for arg in node.args]
+        kwargs = {}
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                raise FormulaError('Not allowed expression: **kwargs')
+            try:
+                kwargs[keyword.arg] = ast.literal_eval(keyword.value)
+            except ValueError:
+                raise FormulaError('Lookup %s should be a literal value' % keyword.arg)
+        return lambda: Q(*[arg() for arg in args], **kwargs)
+
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        function = BINARY_OPERATORS[type(node.op)]
+        left, right = compile_lookup_node(node.left), compile_lookup_node(node.right)
+        return lambda: function(left(), right())
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        operand = compile_lookup_node(node.operand)
+        return lambda: ~operand()
+
+    raise FormulaError('Not allowed expression in lookups: %s' % type(node).__name__)
+
+
+class Lookups(object):
+
+    """
+    Monitor lookups parsed into a whitelisted AST, i.e "Q(slug__startswith='food'), Q(device__id__in=[1,3])".
+    Only Q objects with literal values, combined with &, |, ~ or separated by commas, are allowed.
+    """
+
+    def __init__(self, lookups):
+        self.lookups = lookups
+        try:
+            tree = ast.parse('filter(%s)' % lookups, mode='eval')
+        except SyntaxError as e:
+            raise FormulaError('Invalid lookups %s: %s' % (lookups, e))
+        call = tree.body
+        if not isinstance(call, ast.Call) or call.keywords or getattr(call, 'starargs', None) \
+                or getattr(call, 'kwargs', None):
+            raise FormulaError('Invalid lookups: %s' % lookups)
+        self.builders = [compile_lookup_node(arg) for arg in call.args]
+
+    def q_objects(self):
+
+        """
+        New Q objects for filter a queryset, i.e Var.objects.filter(*lookups.q_objects())
+        """
+        return [builder() for builder in self.builders]
+
+    @property
+    def fields(self):
+
+        """
+        Fields used by the lookups, i.e ['slug__startswith', 'device__id__in']
+        """
+        fields = []
+
+        def collect(q):
+            for child in q.children:
+                if isinstance(child, Q):
+                    collect(child)
+                else:
+                    fields.append(child[0])
+        for q in self.q_objects():
+            collect(q)
+        return fields
+
+    def filter(self, queryset):
+        return queryset.filter(*self.q_objects())
+
+
+@lru_cache(maxsize=1024)
+def parse_lookups(lookups):
+
+    """
+    Parse lookups text into Lookups, cached by lookups text
+    """
+    return Lookups(lookups)
@@ -31,10 +31,16 @@ class NotificationFilter(django_filters.FilterSet):
     ''' Filter class for Notification APIView '''
     event__created = django_filters.DateTimeFromToRangeFilter(
                                 widget=django_filters.widgets.RangeWidget(attrs={'placeholder': 'YYYY/MM/DD HH:MM:SS'}))
+    status = django_filters.ChoiceFilter(choices=Notification.CHECKED_CHOICES, method='status_function')
+
+    def status_function(self, queryset, name, value):  # group notifications have the status of the user (state)
+        if 'state' in queryset.query.annotations:
+            return queryset.filter(state=value)
+        return queryset.filter(status=value)
 
     class Meta:
         model = Notification
-        fields = ['user_id', 'status', 'event__created']
+        fields = ['user_id', 'status', 'event__created', 'event__alarm']
 
 class AlarmEventFilter(django_filters.FilterSet):
 
@@ -7,7 +7,7 @@ class SubscriptionModelForm(forms.ModelForm):
 
     class Meta:
         model = Subscription
-        fields = ('active', 'user', 'group', 'alarm', 'email', 'staff_template', 'user_template')
+        fields = ('active', 'user', 'group', 'alarm', 'email', 'delivery', 'staff_template', 'user_template')
 
 class MonitorModelForm(forms.ModelForm):
 
@@ -0,0 +1,80 @@
+# coding=utf-8
+from threading import Lock
+from .expressions import parse_formula
+
+
+class CompiledFormula(object):
+
+    """
+    Alarm formula parsed only once, ready to be evaluated with many contexts.
+    If the formula can't be parsed, the error is kept and raised in each evaluation.
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.expression = None
+        self.error = None
+        try:
+            self.expression = parse_formula(formula)
+        except Exception as e:
+            self.error = e
+
+    def evaluate(self, context):
+
+        """
+        Evaluate the formula with the values in context
+        :param context: dict with the values used by the formula, i.e {'var': var, 'vars': {...}}
+        :return: evaluation result, it should be a boolean
+        """
+        if self.error is not None:
+            raise self.error
+        return self.expression.evaluate(context)
+
+
+class FormulaCache(object):
+
+    """
+    Compiled formulas by alarm pk. Each entry keeps the hash of the formula which was compiled,
+    so an alarm with a changed formula is compiled again even if it wasn't invalidated.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.formulas = {}  # alarm pk -> (formula hash, CompiledFormula)
+
+    def get(self, alarm):
+
+        """
+        Get the compiled formula of an alarm, compiling it if is not cached yet
+        :param alarm: Alarm instance
+        :return: CompiledFormula
+        """
+        formula = alarm.formula or ''
+        formula_hash = hash(formula)
+        entry = self.formulas.get(alarm.pk)
+        if entry is not None and entry[0] == formula_hash:
+            return entry[1]
+        compiled = CompiledFormula(formula)
+        if alarm.pk is not None:
+            with self.lock:
+                self.formulas[alarm.pk] = (formula_hash, compiled)
+        return compiled
+
+    def invalidate(self, alarm_pk):
+        with self.lock:
+            self.formulas.pop(alarm_pk, None)
+
+    def clear(self):
+        with self.lock:
+            self.formulas.clear()
+
+
+formula_cache = FormulaCache()
+
+
+def get_formula(alarm):
+
+    """
+    Shortcut to get the compiled formula of an alarm from the process cache
+    """
+    return formula_cache.get(alarm)
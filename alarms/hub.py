@@ -0,0 +1,131 @@
+# coding=utf-8
+from queue import Queue, Empty, Full
+from threading import Lock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from .models import Notification
+
+# Messages kept for a listener which doesn't read them, the following ones are dropped (see Listener.lost)
+LISTENER_SIZE = getattr(settings, 'ALARMS_STREAM_LISTENER_SIZE', 1000)
+
+
+class Listener(object):
+
+    """
+    Messages published for a user to one of its streams, from its subscription to the hub until it's closed.
+    Used as a context manager, it's unsubscribed at the end.
+    """
+
+    def __init__(self, hub, user_id):
+        self.hub = hub
+        self.user_id = user_id
+        self.messages = Queue(LISTENER_SIZE)
+        self.lost = False  # messages were dropped because the queue was full
+
+    def put(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except Full:
+            self.lost = True
+
+    def get(self, timeout):
+
+        """
+        Wait for messages
+        :param timeout: seconds
+        :return: list of the published messages, empty if none was published before the timeout
+        """
+        try:
+            messages = [self.messages.get(timeout=timeout)]
+        except Empty:
+            return []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except Empty:
+                return messages
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NotificationHub(object):
+
+    """
+    In-process publish/subscribe of the new notifications: the streams of a user listen for its messages,
+    and the notifications of the events created in the process are published to the listening users.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.listeners = {}  # user id -> set of Listener
+
+    def subscribe(self, user_id):
+        listener = Listener(self, user_id)
+        with self.lock:
+            self.listeners.setdefault(user_id, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            listeners = self.listeners.get(listener.user_id, set())
+            listeners.discard(listener)
+            if not listeners:
+                self.listeners.pop(listener.user_id, None)
+
+    def users(self):
+
+        """
+        :return: set of the ids of the listening users
+        """
+        with self.lock:
+            return set(self.listeners)
+
+    def publish(self, user_id, message):
+        with self.lock:
+            listeners = list(self.listeners.get(user_id, ()))
+        for listener in listeners:
+            listener.put(message)
+
+    def publish_notifications(self, event_id, user_ids, group_ids=()):
+
+        """
+        Publish the notifications of an event to their listening users, with their ids taken with up to two
+        queries (none if nobody is listening). A user notified by its own notification and by group notifications
+        gets its own one, or else the first group one, like in the notifications list
+        :param event_id: AlarmEvent id
+        :param user_ids: ids of the users notified by their own notification
+        :param group_ids: ids of the groups notified with one notification (fan-out on read)
+        """
+        listening = self.users()
+        user_ids = set(user_ids) & listening
+        groups = {}  # user id -> ids of its notified groups
+        if group_ids and listening:
+            for group_id, user_id in User.groups.through.objects\
+                    .filter(group_id__in=group_ids, user_id__in=listening).values_list('group_id', 'user_id'):
+                groups.setdefault(user_id, set()).add(group_id)
+        if not user_ids and not groups:
+            return
+        own, by_group = {}, {}  # user id -> notification id, group id -> notification id
+        for pk, user_id, group_id in Notification.objects.filter(event_id=event_id)\
+                .filter(Q(user__in=user_ids) | Q(group__in=group_ids)).order_by('-pk')\
+                .values_list('pk', 'user_id', 'group_id'):
+            if user_id is not None:
+                own[user_id] = pk
+            else:
+                by_group[group_id] = pk
+        for user_id in user_ids | set(groups):
+            pks = [by_group[group_id] for group_id in groups.get(user_id, ()) if group_id in by_group]
+            pk = own.get(user_id) or (min(pks) if pks else None)
+            if pk is not None:
+                self.publish(user_id, {'notification': pk, 'event': event_id})
+
+
+notification_hub = NotificationHub()
@@ -0,0 +1,121 @@
+# coding=utf-8
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value
+from .membership import refresh_vars
+from .queues import EvaluationTask, enqueue_many, VAR, DEVICE
+from .routing import routing_index
+from .tracking import fields_changed
+
+from django.apps import apps
+Var = apps.get_model(settings.VAR_MODEL)
+VarLog = apps.get_model(settings.VARLOG_MODEL)
+
+# Vars updated by query, keeping the query parameters under the SQLite limit
+UPDATE_BATCH_SIZE = 200
+
+
+def resolve_vars(references):
+
+    """
+    Vars referenced by slug or id. A reference is taken as a slug first, so vars with digit-only slugs can be
+    referenced, and as an id if no var has that slug. Slugs used by more than one var aren't resolved
+    :param references: list of var slugs or ids
+    :return: dict reference -> Var, with its device. References to the same var get the same instance
+    """
+    references = set(str(reference) for reference in references)
+    by_slug = {}
+    for var in Var.objects.select_related('device').filter(slug__in=references):
+        by_slug.setdefault(var.slug, []).append(var)
+    vars = {slug: found[0] for slug, found in by_slug.items() if len(found) == 1}
+    ids = set(int(reference) for reference in references if reference.isdigit() and reference not in by_slug)
+    if ids:
+        for var in Var.objects.select_related('device').filter(pk__in=ids):
+            vars[str(var.pk)] = var
+    instances = {}
+    return {reference: instances.setdefault(var.pk, var) for reference, var in vars.items()}
+
+
+def update_values(values):
+
+    """
+    Update the value of many vars with one query by batch, without signals
+    :param values: dict var id -> value
+    """
+    ids = sorted(values)
+    for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+        batch = ids[start:start + UPDATE_BATCH_SIZE]
+        Var.objects.filter(pk__in=batch).update(value=Case(*[When(pk=pk, then=Value(values[pk])) for pk in batch]))
+
+
+def evaluation_tasks(vars, timestamps):
+
+    """
+    Evaluation tasks of updated vars, for var alarms and for device alarms using them
+    :param vars: updated Vars, with their new value
+    :param timestamps: dict var id -> timestamp of the last value
+    :return: list of EvaluationTask, dict of instances by (kind, object id)
+    """
+    tasks, instances = [], {}
+    changed = {'value'}
+    evaluate_vars = fields_changed(changed, routing_index.fields_for_var())
+    evaluate_devices = fields_changed(changed, routing_index.var_fields_for_device())
+    devices = OrderedDict()
+    for var in vars:
+        if evaluate_vars and (routing_index.alarms_for_var(var.pk) or routing_index.lookup_alarms_exist()):
+            tasks.append(EvaluationTask(VAR, var.pk, var.value, timestamps[var.pk]))
+            instances[(VAR, var.pk)] = var
+        if evaluate_devices and var.device_id and \
+                routing_index.alarms_for_var_type(var.var_type) & routing_index.alarms_for_device(var.device_id):
+            devices[var.device_id] = max(devices.get(var.device_id, 0), timestamps[var.pk])
+            instances[(DEVICE, var.device_id)] = var.device
+    tasks.extend(EvaluationTask(DEVICE, device_id, None, timestamp) for device_id, timestamp in devices.items())
+    return tasks, instances
+
+
+def ingest_values(values):
+
+    """
+    Save a batch of var values: a VarLog by value, the last value of each var in Var, and evaluate
+    the alarms of the changed vars once, in a batch. Var signals aren't sent.
+    :param values: list of dicts with var (id or slug), value and timestamp (seconds, now if None),
+    or (var, value, timestamp) tuples
+    :return: dict with the number of received values, saved logs, updated vars, evaluation tasks,
+    and the list of unknown vars
+    """
+    now = time.time()
+    items = []
+    for item in values:
+        if not isinstance(item, dict):
+            item = dict(zip(('var', 'value', 'timestamp'), item))
+        items.append((str(item['var']), item['value'], item.get('timestamp') or now))
+
+    with transaction.atomic():
+        vars = resolve_vars(set(reference for reference, value, timestamp in items))
+        unknown = sorted(set(reference for reference, value, timestamp in items if reference not in vars))
+        known = sorted(((vars[reference], value, timestamp) for reference, value, timestamp in items
+                        if reference in vars), key=lambda item: item[2])  # last value of each var at the end
+        VarLog.objects.bulk_create([VarLog(var_id=var.pk, value=value) for var, value, timestamp in known])
+
+        last_values, timestamps = {}, {}
+        for var, value, timestamp in known:
+            last_values[var.pk], timestamps[var.pk] = value, timestamp
+        instances = {var.pk: var for var in vars.values()}
+        updated = {pk: value for pk, value in last_values.items() if value != instances[pk].value}
+        updated_vars = [instances[pk] for pk in sorted(updated)]
+        for var in updated_vars:
+            var.value = updated[var.pk]
+        update_values(updated)
+
+        tasks = []
+        if updated_vars:
+            if routing_index.lookup_monitors_exist():
+                refresh_vars(Var.objects.filter(pk__in=list(updated)))
+            tasks, task_instances = evaluation_tasks(updated_vars, timestamps)
+            if tasks:
+                enqueue_many(tasks, task_instances)
+
+    return {'received': len(items), 'logged': len(known), 'updated': len(updated_vars),
+            'evaluated': len(tasks), 'unknown': unknown}
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from alarms.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+
+    """
+    Run the alarms benchmarks, i.e: python manage.py alarms_benchmark formulas --iterations 10000
+    """
+    help = 'Run alarms benchmarks: %s' % ', '.join(sorted(BENCHMARKS))
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS))
+        parser.add_argument('--iterations', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        for name in options['benchmarks']:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark %s, choices: %s' % (name, ', '.join(sorted(BENCHMARKS))))
+            function, headers = BENCHMARKS[name]
+            self.stdout.write('== %s ==' % name)
+            self.stdout.write(' | '.join(headers))
+            for row in function(iterations=options['iterations']):
+                self.stdout.write(' | '.join('%.2f' % item if isinstance(item, float) else str(item) for item in row))
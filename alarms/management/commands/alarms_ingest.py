@@ -0,0 +1,45 @@
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from alarms.ingest import ingest_values
+from alarms.serializers import VarValueSerializer
+
+
+class Command(BaseCommand):
+
+    """
+    Save var values read as NDJSON from stdin and evaluate their alarms by batches, i.e:
+    echo '{"var": 1, "value": 3, "timestamp": 1525000000.0}' | python manage.py alarms_ingest
+    """
+    help = 'Save var values from NDJSON lines ({"var": id or slug, "value": value, "timestamp": seconds})'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        totals = {'received': 0, 'logged': 0, 'updated': 0, 'evaluated': 0}
+        batch = []
+        for number, line in enumerate(options.get('stdin', sys.stdin), 1):
+            if not line.strip():
+                continue
+            try:
+                batch.append(json.loads(line))
+            except ValueError as e:
+                raise CommandError('Invalid JSON in line %d: %s' % (number, e))
+            if len(batch) >= options['batch_size']:
+                self.ingest(batch, totals)
+                batch = []
+        if batch:
+            self.ingest(batch, totals)
+        self.stdout.write('%(received)d values, %(logged)d logs, %(updated)d vars updated, '
+                          '%(evaluated)d evaluations' % totals)
+
+    def ingest(self, batch, totals):
+        serializer = VarValueSerializer(data=batch, many=True)
+        if not serializer.is_valid():
+            raise CommandError('Invalid values: %s' % [errors for errors in serializer.errors if errors])
+        result = ingest_values(serializer.validated_data)
+        for key in totals:
+            totals[key] += result[key]
+        if result['unknown']:
+            self.stderr.write('Unknown vars: %s' % ', '.join(result['unknown']))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from alarms.outbox import outbox_sender, deliver_all
+from alarms.digests import flush_digests
+
+
+class Command(BaseCommand):
+
+    """
+    Deliver the emails of the alarms outbox, i.e: python manage.py alarms_outbox --burst
+    """
+    help = 'Deliver the emails of the alarms outbox and the due digests, retrying the failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true', help='Exit when there are no due emails or digests')
+        parser.add_argument('--batch-size', type=int, default=None, help='Emails sent by connection')
+
+    def handle(self, *args, **options):
+        if options['burst']:
+            kwargs = {'batch_size': options['batch_size']} if options['batch_size'] else {}
+            flush_digests()
+            sent, failed = deliver_all(**kwargs)
+            self.stdout.write('%d emails sent, %d failed' % (sent, failed))
+            return
+        outbox_sender.start()
+        try:
+            outbox_sender.thread.join()
+        except KeyboardInterrupt:
+            outbox_sender.stop()
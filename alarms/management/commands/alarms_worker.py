@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from alarms.queues import get_evaluation_queue, SQLiteQueue
+
+
+class Command(BaseCommand):
+
+    """
+    Evaluate alarms from the sqlite evaluation queue, i.e: python manage.py alarms_worker --workers 4
+    """
+    help = 'Evaluate alarms of var and device updates saved in the sqlite evaluation queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--burst', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        queue = get_evaluation_queue()
+        if not isinstance(queue, SQLiteQueue):
+            raise CommandError("ALARMS_EVALUATION_QUEUE should be 'sqlite' to run workers in other process")
+        if options['burst']:
+            queue.work(burst=True)
+            return
+        queue.workers = options['workers']
+        queue.start()
+        try:
+            for thread in queue.threads:
+                thread.join()
+        except KeyboardInterrupt:
+            queue.stop()
@@ -0,0 +1,107 @@
+# coding=utf-8
+from django.conf import settings
+from django.apps import apps
+from django.db.models import Q, Case, When, Value, BooleanField
+from .models import Monitor, MonitorLookupVar
+from .expressions import parse_lookups
+
+Var = apps.get_model(settings.VAR_MODEL)
+
+
+def lookup_monitors():
+
+    """
+    Monitors with lookups field
+    """
+    return Monitor.objects.exclude(lookups=None).exclude(lookups='')
+
+
+def lookups_through_device(monitor):
+
+    """
+    True if the monitor lookups use fields of the var device, i.e Q(device__name__startswith='Airador')
+    """
+    try:
+        fields = parse_lookups(monitor.lookups).fields
+    except Exception:
+        return False
+    return any(field.startswith('device__') and field.split('__')[1] not in ('id', 'pk', 'in', 'exact', 'isnull')
+               for field in fields)
+
+
+def refresh_monitor(monitor):
+
+    """
+    Save again the vars which satisfy the monitor lookups, i.e when the lookups field is changed
+    :param monitor: Monitor instance
+    """
+    MonitorLookupVar.objects.filter(monitor=monitor).delete()
+    if not monitor.lookups:
+        return
+    try:
+        var_ids = list(parse_lookups(monitor.lookups).filter(Var.objects.all()).values_list('pk', flat=True))
+    except Exception as e:
+        print("Error executing lookup %s in monitor %s. Details: %s" % (monitor.lookups, monitor, e))
+        return
+    MonitorLookupVar.objects.bulk_create([MonitorLookupVar(monitor=monitor, var_id=var_id) for var_id in var_ids])
+
+
+def refresh_vars(vars_query, monitors=None):
+
+    """
+    Update the monitors of the vars in vars_query. Lookups of all monitors are evaluated
+    in a single query, annotating each var with a boolean by monitor.
+    :param vars_query: Var queryset, i.e Var.objects.filter(pk=var.pk)
+    :param monitors: lookup monitors to check, all of them if None
+    """
+    monitors = list(lookup_monitors()) if monitors is None else monitors
+    conditions = {}  # annotation name -> (monitor pk, Case expression)
+    for monitor in monitors:
+        name = 'monitor_%d' % monitor.pk
+        try:
+            condition = Case(When(Q(*parse_lookups(monitor.lookups).q_objects()), then=Value(True)),
+                             default=Value(False), output_field=BooleanField())
+            vars_query.annotate(**{name: condition})  # raise if lookups use unknown fields
+        except Exception as e:
+            print("Error executing lookup %s in monitor %s. Details: %s" % (monitor.lookups, monitor, e))
+            continue
+        conditions[name] = (monitor.pk, condition)
+
+    rows = vars_query.annotate(**{name: condition for name, (pk, condition) in conditions.items()})\
+        .values('pk', *conditions.keys())
+    var_ids = set()
+    members = set()  # (monitor pk, var pk)
+    for row in rows:
+        var_ids.add(row['pk'])
+        for name, (monitor_pk, condition) in conditions.items():
+            if row[name]:
+                members.add((monitor_pk, row['pk']))
+
+    current = set(MonitorLookupVar.objects.filter(var_id__in=var_ids, monitor__in=[m.pk for m in monitors])
+                  .values_list('monitor_id', 'var_id'))
+    removed = current - members
+    for monitor_pk in set(monitor_pk for monitor_pk, var_pk in removed):
+        MonitorLookupVar.objects.filter(monitor_id=monitor_pk,
+                                        var_id__in=[var_pk for m_pk, var_pk in removed if m_pk == monitor_pk]).delete()
+    MonitorLookupVar.objects.bulk_create([MonitorLookupVar(monitor_id=monitor_pk, var_id=var_pk)
+                                          for monitor_pk, var_pk in members - current])
+
+
+def refresh_var(var):
+
+    """
+    Update the monitors of a saved var
+    """
+    monitors = list(lookup_monitors())
+    if monitors:
+        refresh_vars(Var.objects.filter(pk=var.pk), monitors)
+
+
+def refresh_device_vars(device):
+
+    """
+    Update the monitors of the device vars, only for monitors which lookups use device fields
+    """
+    monitors = [monitor for monitor in lookup_monitors() if lookups_through_device(monitor)]
+    if monitors:
+        refresh_vars(Var.objects.filter(device=device), monitors)
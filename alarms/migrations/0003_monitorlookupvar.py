@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+VAR_APP = settings.VAR_MODEL.split('.')[0]
+
+
+def fill_monitor_lookup_vars(apps, schema_editor):
+    ''' Save the vars which satisfy the lookups of existing monitors '''
+    from alarms.expressions import parse_lookups
+
+    Monitor = apps.get_model('alarms', 'Monitor')
+    MonitorLookupVar = apps.get_model('alarms', 'MonitorLookupVar')
+    Var = apps.get_model(settings.VAR_MODEL)
+
+    for monitor in Monitor.objects.exclude(lookups=None).exclude(lookups=''):
+        try:
+            var_ids = parse_lookups(monitor.lookups).filter(Var.objects.all()).values_list('pk', flat=True)
+            MonitorLookupVar.objects.bulk_create([MonitorLookupVar(monitor_id=monitor.pk, var_id=var_id)
+                                                  for var_id in var_ids])
+        except Exception as e:
+            print("Error executing lookup %s in monitor %s. Details: %s" % (monitor.lookups, monitor.pk, e))
+
+
+class Migration(migrations.Migration):
+
+    # the fill reads fields of the vars added by later migrations of the var app, i.e slug and device__profile
+    dependencies = [
+        (VAR_APP, '__latest__'),
+        ('alarms', '0002_auto_20180427_1740'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorLookupVar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('monitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='alarms.Monitor')),
+                ('var', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.VAR_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='monitorlookupvar',
+            unique_together=set([('monitor', 'var')]),
+        ),
+        migrations.RunPython(fill_monitor_lookup_vars, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Partial index of the open events, which are a small part of the table. Django 1.11 indexes can't have
+# a condition, so it's created with SQL in the databases which support it
+OPEN_EVENTS_INDEX = 'alarms_event_open_idx'
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_open_events_index(apps, schema_editor):
+    ''' Index of the open events by alarm, device and var '''
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        schema_editor.execute('CREATE INDEX %s ON alarms_alarmevent (alarm_id, device_id, variables_id) '
+                              'WHERE finished IS NULL' % OPEN_EVENTS_INDEX)
+
+
+def drop_open_events_index(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        schema_editor.execute('DROP INDEX %s' % OPEN_EVENTS_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alarms', '0003_monitorlookupvar'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alarmevent',
+            index=models.Index(fields=['device', 'variables', 'alarm', 'finished'], name='alarms_event_dev_var_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarmevent',
+            index=models.Index(fields=['alarm', 'finished'], name='alarms_event_finished_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alarmevent',
+            index=models.Index(fields=['created'], name='alarms_event_created_idx'),
+        ),
+        migrations.RunPython(create_open_events_index, drop_open_events_index),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('alarms', '0005_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='delivery',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('digest', 'Digest')], default='immediate', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='DigestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(max_length=254)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='alarms.AlarmEvent')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='digestentry',
+            index=models.Index(fields=['user', 'created'], name='alarms_digest_user_idx'),
+        ),
+    ]
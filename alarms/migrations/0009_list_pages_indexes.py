@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alarms', '0008_notificationcounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alarmevent',
+            index=models.Index(fields=['alarm', 'created'], name='alarms_event_alarm_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'created'], name='alarms_notif_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['group', 'created'], name='alarms_notif_group_created_idx'),
+        ),
+    ]
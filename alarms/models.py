@@ -92,6 +92,23 @@ class Monitor(models.Model):
         return 'Monitor ' + str(self.pk)
 
 
+class MonitorLookupVar(models.Model):
+
+    """
+    Vars which satisfy the lookups field of a Monitor. Maintained by signals when a Var or a Monitor change,
+    to get the monitors of a Var with an indexed query instead of running the lookups of every Monitor.
+    """
+
+    monitor = models.ForeignKey(Monitor, on_delete=models.CASCADE)
+    var = models.ForeignKey(settings.VAR_MODEL, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('monitor', 'var')
+
+    def __str__(self):
+        return str(self.monitor) + '-' + str(self.var)
+
+
 class Alarm(models.Model):
 
     help_text_alarm = '''Por ejemplo: "{{ var.value }} < 5" |
@@ -156,15 +173,38 @@ class AlarmEvent(models.Model):
     def __str__(self):
         return self.alarm_type + '-' + str(self.pk)
 
+    class Meta:
+        indexes = [
+            # events of a device and var by alarm: open events to finish, last event to re-arm
+            models.Index(fields=['device', 'variables', 'alarm', 'finished'], name='alarms_event_dev_var_idx'),
+            # events list filtered by the subscribed alarms and finished date
+            models.Index(fields=['alarm', 'finished'], name='alarms_event_finished_idx'),
+            # events of the re-arm window
+            models.Index(fields=['created'], name='alarms_event_created_idx'),
+            # pages of the events list by the subscribed alarms (see pagination.KeysetPagination)
+            models.Index(fields=['alarm', 'created'], name='alarms_event_alarm_created_idx'),
+        ]
+
 
 class Subscription(models.Model):
 
+    # Email delivery modes
+    IMMEDIATE = 'immediate'
+    DIGEST = 'digest'
+
+    DELIVERY_CHOICES = (
+        (IMMEDIATE, 'Immediate'),
+        (DIGEST, 'Digest')
+    )
+
     active = models.BooleanField(default=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     group = models.ForeignKey(Group, on_delete=models.CASCADE, blank=True, null=True)
     created = models.DateTimeField(default=timezone.now)
     alarm = models.ForeignKey(Alarm, on_delete=models.CASCADE, null=True)
     email = models.BooleanField(default=True)
+    # immediate: an email by event, digest: one email with the events of a window (ALARMS_EMAIL_DIGEST_WINDOW)
+    delivery = models.CharField(default=IMMEDIATE, choices=DELIVERY_CHOICES, max_length=10)
     staff_template = models.CharField(max_length=50, null=True, blank=True)  # Template name from template folder
     user_template = models.CharField(max_length=50, null=True, blank=True)
     staff_template_text = models.TextField(null=True, blank=True)  # raw HTML
@@ -212,9 +252,110 @@ class Notification(models.Model):
     )
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # Notification of all the users of a group (fan-out on read), their status is kept in NotificationState
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True)
     event = models.ForeignKey(AlarmEvent, on_delete=models.CASCADE, null=True)
     created = models.DateTimeField(auto_now_add=True)
     status = models.CharField(default=UNCHECKED, choices=CHECKED_CHOICES, max_length=10)
 
     def __str__(self):
         return 'Notification ' + str(self.pk)
+
+    class Meta:
+        indexes = [
+            # pages of the notifications list of a user and its groups (see pagination.KeysetPagination)
+            models.Index(fields=['user', 'created'], name='alarms_notif_user_created_idx'),
+            models.Index(fields=['group', 'created'], name='alarms_notif_group_created_idx'),
+        ]
+
+
+class NotificationState(models.Model):
+
+    """
+    Status of a group notification for one of its users, saved only when the user changes it
+    """
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(default=Notification.UNCHECKED, choices=Notification.CHECKED_CHOICES, max_length=10)
+    hidden = models.BooleanField(default=False)  # deleted by the user
+
+    def __str__(self):
+        return 'Notification state ' + str(self.pk)
+
+    class Meta:
+        unique_together = ('notification', 'user')
+
+
+class OutboxEmail(models.Model):
+
+    # Delivery status
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed')
+    )
+
+    event = models.ForeignKey(AlarmEvent, on_delete=models.SET_NULL, null=True)
+    subject = models.CharField(max_length=255)
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField()  # one email by line
+    body = models.TextField()  # plain text
+    html = models.TextField(null=True, blank=True)  # HTML alternative rendered with the subscription template
+    status = models.CharField(default=PENDING, choices=STATUS_CHOICES, max_length=10)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)  # next delivery, or end of the sender lease
+    claim = models.CharField(max_length=32, blank=True, default='')  # sender which is delivering the email
+    error = models.TextField(blank=True, default='')  # last delivery error
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    def recipient_list(self):
+        return [email for email in self.recipients.split('\n') if email]
+
+    def __str__(self):
+        return 'Email ' + str(self.pk)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='alarms_outbox_due_idx'),
+        ]
+
+
+class DigestEntry(models.Model):
+
+    """
+    Event waiting for the digest email of a user
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    event = models.ForeignKey(AlarmEvent, on_delete=models.CASCADE)
+    email = models.CharField(max_length=254)
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return 'Digest entry ' + str(self.pk)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created'], name='alarms_digest_user_idx'),
+        ]
+
+
+class NotificationCounter(models.Model):
+
+    """
+    Unchecked notifications of a user and id of its latest notification, kept by alarms.counters
+    so the notifications badge doesn't count the notifications
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    unchecked = models.IntegerField(default=0)
+    latest = models.IntegerField(null=True, blank=True)  # id of the latest notification
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return 'Notification counter ' + str(self.pk)
@@ -0,0 +1,77 @@
+# coding=utf-8
+from django.conf import settings
+from django.db.models import Q, F, Case, When, Value, CharField, BooleanField, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .models import Notification, NotificationState
+
+# Group subscriptions with at least this number of users create one notification for the group (fan-out on read)
+# instead of one by user. None creates always one by user
+FAN_OUT_ON_READ_MIN_GROUP = getattr(settings, 'ALARMS_FAN_OUT_ON_READ_MIN_GROUP', None)
+
+
+def fan_out_on_read(sub):
+
+    """
+    True if the events of a subscription are notified with one notification for its group
+    :param sub: SubscriptionAudience
+    """
+    return sub.group_id is not None and FAN_OUT_ON_READ_MIN_GROUP is not None \
+        and len(sub.user_ids) >= FAN_OUT_ON_READ_MIN_GROUP
+
+
+def user_notifications(user):
+
+    """
+    Notifications of a user: its own notifications, and the notifications of its groups computed on read, once
+    by event, with the status saved by the user (see NotificationState). Hidden ones are excluded.
+    :return: queryset of Notification annotated with the status for the user as state
+    """
+    group_ids = list(user.groups.values_list('pk', flat=True))
+    if not group_ids:
+        return Notification.objects.filter(user=user).annotate(state=F('status'))
+    own = Notification.objects.filter(event=OuterRef('event'), user=user)
+    first = Notification.objects.filter(event=OuterRef('event'), group__in=group_ids).order_by('pk').values('pk')[:1]
+    states = NotificationState.objects.filter(notification=OuterRef('pk'), user=user)
+    state = Case(When(user=None, then=Coalesce(Subquery(states.values('status')[:1]), Value(Notification.UNCHECKED))),
+                 default=F('status'), output_field=CharField())
+    hidden = Coalesce(Subquery(states.values('hidden')[:1]), Value(False), output_field=BooleanField())
+    return Notification.objects.filter(Q(user=user) | Q(group__in=group_ids))\
+        .annotate(own=Exists(own), first=Subquery(first), state=state, hidden=hidden)\
+        .filter(Q(user=user) | Q(own=False, pk=F('first'), hidden=False))
+
+
+def is_recipient(notification, user):
+
+    """
+    True if the notification is of the user, or of one of its groups
+    """
+    if notification.group_id is not None:
+        return user.groups.filter(pk=notification.group_id).exists()
+    return notification.user_id == user.pk
+
+
+def set_state(notification, user, **fields):
+
+    """
+    Save the status of a group notification for a user
+    :param fields: status and/or hidden
+    """
+    NotificationState.objects.update_or_create(notification=notification, user=user, defaults=fields)
+
+
+def update_status(notifications, user, value):
+
+    """
+    Change the status of notifications of a user: its own notifications with one update, and the states
+    of its group notifications with one update and one insert. Signals aren't sent
+    :param notifications: queryset of user_notifications(user)
+    :param value: Notification.CHECKED or Notification.UNCHECKED
+    :return: number of changed notifications
+    """
+    own = Notification.objects.filter(user=user, pk__in=notifications.values('pk')).update(status=value)
+    groups = Notification.objects.filter(user=None, pk__in=notifications.values('pk'))
+    states = NotificationState.objects.filter(user=user, notification__in=groups).update(status=value)
+    missing = groups.exclude(notificationstate__user=user).values_list('pk', flat=True)
+    created = NotificationState.objects.bulk_create([NotificationState(notification_id=pk, user=user, status=value)
+                                                     for pk in missing])
+    return own + states + len(created)
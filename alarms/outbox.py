@@ -0,0 +1,192 @@
+# coding=utf-8
+import uuid
+from datetime import timedelta
+from threading import Thread, Lock, Event
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from .models import OutboxEmail
+from .digests import flush_digests
+
+# Deliver the outbox in a thread of the process, with False only "python manage.py alarms_outbox" delivers it
+OUTBOX_SENDER = getattr(settings, 'ALARMS_EMAIL_OUTBOX_SENDER', True)
+# Emails sent by connection
+OUTBOX_BATCH_SIZE = getattr(settings, 'ALARMS_EMAIL_OUTBOX_BATCH_SIZE', 100)
+# Failed deliveries are retried after OUTBOX_BACKOFF seconds, doubled by attempt up to OUTBOX_MAX_BACKOFF
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'ALARMS_EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+OUTBOX_BACKOFF = getattr(settings, 'ALARMS_EMAIL_OUTBOX_BACKOFF', 60)
+OUTBOX_MAX_BACKOFF = 3600
+# Seconds a sender keeps the claimed emails, after them other sender can deliver them (i.e. the process died)
+OUTBOX_LEASE = 300
+# Seconds between checks of the outbox, for emails to retry or put by other processes
+OUTBOX_POLL_INTERVAL = 10
+
+
+def backoff(attempts):
+
+    """
+    Seconds before the next delivery of an email which failed attempts times
+    """
+    return min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * 2 ** (attempts - 1))
+
+
+def email_message(email, connection=None):
+
+    """
+    Message of an outbox email, with its HTML alternative if it has one
+    :param email: OutboxEmail
+    :return: EmailMultiAlternatives
+    """
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email, email.recipient_list(),
+                                     connection=connection)
+    if email.html:
+        message.attach_alternative(email.html, 'text/html')
+    return message
+
+
+def claim_due(batch_size=OUTBOX_BATCH_SIZE, now=None):
+
+    """
+    Take the oldest emails to deliver: pending ones which next attempt is due, and the ones of senders which
+    lease ended. They are claimed with one update, so other senders don't deliver them.
+    :return: list of OutboxEmail
+    """
+    now = now or timezone.now()
+    due = Q(status=OutboxEmail.PENDING) | Q(status=OutboxEmail.SENDING)
+    ids = list(OutboxEmail.objects.filter(due, next_attempt__lte=now).order_by('pk')
+               .values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return []
+    claim = uuid.uuid4().hex
+    OutboxEmail.objects.filter(due, pk__in=ids, next_attempt__lte=now)\
+        .update(status=OutboxEmail.SENDING, claim=claim, next_attempt=now + timedelta(seconds=OUTBOX_LEASE))
+    return list(OutboxEmail.objects.filter(claim=claim, status=OutboxEmail.SENDING).order_by('pk'))
+
+
+def failed(email, error, now):
+
+    """
+    Save a failed delivery: the email is retried with backoff, or failed after OUTBOX_MAX_ATTEMPTS
+    """
+    email.attempts += 1
+    email.error = str(error)
+    if email.attempts >= OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.status = OutboxEmail.PENDING
+        email.next_attempt = now + timedelta(seconds=backoff(email.attempts))
+    email.save(update_fields=['attempts', 'error', 'status', 'next_attempt'])
+    print('Error sending %s to %s. Details: %s' % (email, ', '.join(email.recipient_list()), error))
+
+
+def deliver_due(batch_size=OUTBOX_BATCH_SIZE, connection=None):
+
+    """
+    Send a batch of due emails over one connection of the email backend
+    :param connection: email backend connection, get_connection() by default
+    :return: (sent emails, failed emails)
+    """
+    emails = claim_due(batch_size)
+    if not emails:
+        return 0, 0
+    now = timezone.now()
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for email in emails:
+            failed(email, e, now)
+        return 0, len(emails)
+    sent = []
+    try:
+        for email in emails:
+            try:
+                email_message(email, connection).send()
+            except Exception as e:
+                failed(email, e, now)
+            else:
+                sent.append(email.pk)
+    finally:
+        connection.close()
+        OutboxEmail.objects.filter(pk__in=sent).update(status=OutboxEmail.SENT, sent=timezone.now(), error='')
+    return len(sent), len(emails) - len(sent)
+
+
+def deliver_all(batch_size=OUTBOX_BATCH_SIZE):
+
+    """
+    Deliver batches until there are no due emails
+    :return: (sent emails, failed emails)
+    """
+    total_sent = total_failed = 0
+    while True:
+        sent, failed_emails = deliver_due(batch_size)
+        if not sent and not failed_emails:
+            return total_sent, total_failed
+        total_sent, total_failed = total_sent + sent, total_failed + failed_emails
+
+
+class OutboxSender(object):
+
+    """
+    Background thread which delivers the outbox. It's woken when emails are put, and checks the outbox
+    every poll interval for retries, emails put by other processes and digests to send (see alarms.digests).
+    """
+
+    def __init__(self, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.thread = None
+        self.lock = Lock()
+        self.pending = Event()
+        self.stopping = Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopping.clear()
+            self.thread = Thread(target=self.work, name='alarms-outbox')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def wake(self):
+        self.start()
+        self.pending.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.pending.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def work(self):
+        while not self.stopping.is_set():
+            self.pending.wait(self.poll_interval)
+            self.pending.clear()
+            try:
+                flush_digests()
+                deliver_all()
+            except Exception as e:
+                print('Error delivering the email outbox. Details: %s' % e)
+            finally:
+                close_old_connections()
+
+
+outbox_sender = OutboxSender()
+
+
+def put_emails(emails):
+
+    """
+    Save emails in the outbox. The sender thread delivers them after commit, so the event creation
+    doesn't wait the mail server
+    :param emails: list of unsaved OutboxEmail
+    """
+    if not emails:
+        return
+    OutboxEmail.objects.bulk_create(emails)
+    if OUTBOX_SENDER:
+        transaction.on_commit(outbox_sender.wake)
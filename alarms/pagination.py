@@ -0,0 +1,85 @@
+# coding=utf-8
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _positive_int
+
+# Items by page of the events and notifications lists, clients can ask up to MAX_PAGE_SIZE with ?page_size=
+PAGE_SIZE = getattr(settings, 'ALARMS_PAGE_SIZE', 100)
+MAX_PAGE_SIZE = 1000
+
+
+class KeysetPagination(CursorPagination):
+
+    """
+    Cursor pagination by (created, id), newest first. The cursor has the creation date and id of the
+    first or last item of the page, and the next page is taken with (created, id) < cursor (> for the
+    previous page) on the ordered query, so a deep page costs the same as the first one. Unlike
+    CursorPagination, the cursors never have offsets: (created, id) is unique.
+    """
+    page_size = PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+    ordering = ('-created', '-id')
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True,
+                                 cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+    def _get_position_from_instance(self, instance, ordering):
+        return '%s|%s' % (instance.created.isoformat(), instance.pk)
+
+    def decode_position(self, position):
+
+        """
+        :return: (created, id) of a cursor position
+        """
+        try:
+            created, pk = position.rsplit('|', 1)
+            created, pk = parse_datetime(created), int(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if created is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = self.cursor.position if self.cursor is not None else None
+
+        if position is not None:
+            created, pk = self.decode_position(position)
+            if reverse:
+                queryset = queryset.filter(Q(created__gt=created) | Q(created=created, pk__gt=pk))
+            else:
+                queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+        queryset = queryset.order_by(*(('created', 'id') if reverse else self.ordering))
+
+        # an extra item tells if there is a following page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following = self._get_position_from_instance(results[-1], self.ordering) \
+            if len(results) > len(self.page) else None
+
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.next_position = True, position
+            self.has_previous, self.previous_position = following is not None, following
+        else:
+            self.has_next, self.next_position = following is not None, following
+            self.has_previous, self.previous_position = position is not None, position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
@@ -0,0 +1,486 @@
+# coding=utf-8
+import json
+import sqlite3
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread, Lock, Event, local
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+from .evaluation import create_event_for_alarm_formula_by_device_update, \
+    create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field, \
+    create_event_for_alarm_formula_looking_var_for_monitor_var_selection
+from .states import common_prefix
+
+from django.apps import apps
+Device = apps.get_model(settings.DEVICE_MODEL)
+Var = apps.get_model(settings.VAR_MODEL)
+
+# Queue types, selected with ALARMS_EVALUATION_QUEUE setting
+SYNC = 'sync'  # evaluate in the post_save, in the same thread
+LOCAL = 'local'  # evaluate in worker threads of the process
+SQLITE = 'sqlite'  # evaluate in worker threads of the process or other processes (manage.py alarms_worker)
+
+VAR = 'var'
+DEVICE = 'device'
+
+BATCH_SIZE = 100
+# Seconds the sqlite queue tasks taken by a worker are reserved for it. If the worker doesn't finish them
+# before (i.e. it crashed), they are taken again by other worker
+LEASE = getattr(settings, 'ALARMS_EVALUATION_LEASE', 60)
+
+# Evaluation requested by a save: kind (var or device), object id, new value (for vars) and save timestamp
+EvaluationTask = namedtuple('EvaluationTask', ['kind', 'object_id', 'value', 'timestamp'])
+
+
+def get_instances(tasks, instances=None):
+
+    """
+    Vars and devices of the tasks, by (kind, object id)
+    :param instances: instances already known, i.e saved instances in the current process
+    """
+    instances = {key: instance for key, instance in (instances or {}).items() if instance is not None}
+    var_ids = [task.object_id for task in tasks if task.kind == VAR and (VAR, task.object_id) not in instances]
+    device_ids = [task.object_id for task in tasks if task.kind == DEVICE and (DEVICE, task.object_id) not in instances]
+    if var_ids:
+        for pk, var in Var.objects.select_related('device').in_bulk(var_ids).items():
+            instances[(VAR, pk)] = var
+    if device_ids:
+        for pk, device in Device.objects.in_bulk(device_ids).items():
+            instances[(DEVICE, pk)] = device
+    return instances
+
+
+def run_tasks(tasks, instances=None):
+
+    """
+    Evaluate the alarms of var and device updates, each task in its own transaction. Alarms of monitors
+    with lookups are evaluated once for all the vars of the tasks, because they read the vars from database.
+    :param tasks: list of EvaluationTask
+    :param instances: saved Vars and Devices by (kind, object id). The others are got from database
+    """
+    instances = get_instances(tasks, instances)
+    updated_vars = []
+    for task in tasks:
+        instance = instances.get((task.kind, task.object_id))
+        if instance is None:  # deleted after the update
+            continue
+        now = datetime.fromtimestamp(task.timestamp, timezone.utc)
+        try:
+            with transaction.atomic():
+                if task.kind == VAR:
+                    instance.value = task.value  # evaluate the value of the update
+                    create_event_for_alarm_formula_looking_var_for_monitor_var_selection(instance, now)
+                    updated_vars.append(instance)
+                elif task.kind == DEVICE:
+                    create_event_for_alarm_formula_by_device_update(instance, now)
+        except Exception as e:
+            print('Error evaluating %s %s. Details: %s' % (task.kind, task.object_id, e))
+
+    if updated_vars:
+        now = datetime.fromtimestamp(max(task.timestamp for task in tasks), timezone.utc)
+        try:
+            with transaction.atomic():
+                create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(updated_vars, now)
+        except Exception as e:
+            print('Error evaluating lookups of vars %s. Details: %s' % ([var.pk for var in updated_vars], e))
+
+
+class SyncQueue(object):
+
+    """
+    Tasks are evaluated when are put, in the same thread of the save. Used in tests.
+    """
+
+    def put(self, task, instance=None):
+        run_tasks([task], {(task.kind, task.object_id): instance} if instance is not None else None)
+
+    def put_many(self, tasks, instances=None):
+        run_tasks(tasks, instances)
+
+    def get(self, worker=None, batch_size=BATCH_SIZE, timeout=None):
+        return []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class WorkersMixin(object):
+
+    """
+    Worker threads which drain the queue
+    """
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.stopping.clear()
+            for n in range(self.workers):
+                thread = Thread(target=self.work, args=(n, ), name='alarms-evaluation-%d' % n)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def put_many(self, tasks, instances=None):
+        for task in tasks:
+            self.put(task)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def work(self, worker=None, burst=False):
+
+        """
+        Evaluate tasks until the queue is stopped
+        :param worker: number of worker, to get tasks only from its partition if the queue has them
+        :param burst: stop when the queue is empty
+        """
+        while not self.stopping.is_set():
+            tasks = self.get(worker=worker, timeout=0 if burst else 1)
+            if tasks:
+                try:
+                    run_tasks(tasks)
+                except Exception as e:
+                    print('Error evaluating %d tasks. Details: %s' % (len(tasks), e))
+                    self.failed(worker, tasks)
+                else:
+                    self.done(worker, tasks)
+                finally:
+                    close_old_connections()
+            elif burst:
+                return
+
+
+class LocalQueue(WorkersMixin):
+
+    """
+    Tasks in memory, drained by worker threads of the process. Each worker has its own queue
+    and the tasks of a var or device always go to the same worker, so they are evaluated in order.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = [Queue() for n in range(workers)]
+        self.threads = []
+        self.lock = Lock()
+        self.stopping = Event()
+
+    def put(self, task, instance=None):
+        self.start()
+        self.queues[hash((task.kind, task.object_id)) % self.workers].put(task)
+
+    def get(self, worker=0, batch_size=BATCH_SIZE, timeout=1):
+        queue = self.queues[worker or 0]
+        try:
+            tasks = [queue.get(timeout=timeout) if timeout else queue.get_nowait()]
+        except Empty:
+            return []
+        while len(tasks) < batch_size:
+            try:
+                tasks.append(queue.get_nowait())
+            except Empty:
+                break
+        return tasks
+
+    def done(self, worker, tasks):
+        for task in tasks:
+            self.queues[worker or 0].task_done()
+
+    failed = done  # tasks in memory aren't retried
+
+    def join(self):
+
+        """
+        Wait until all the put tasks are evaluated
+        """
+        for queue in self.queues:
+            queue.join()
+
+
+class SQLiteQueue(WorkersMixin):
+
+    """
+    Tasks saved in a SQLite file, so they survive restarts and can be drained by other processes
+    with "python manage.py alarms_worker". No external broker is needed.
+    A worker claims its tasks for LEASE seconds and deletes them after they are evaluated, so the tasks of a
+    worker which crashes are evaluated again by other one. A task isn't claimed while an older task of the same
+    var or device is claimed by other worker, so the updates of an object are evaluated in order.
+    """
+
+    def __init__(self, path, workers, lease=LEASE):
+        self.path = path
+        self.workers = workers
+        self.lease = lease
+        self.threads = []
+        self.lock = Lock()
+        self.stopping = Event()
+        self.local = local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('CREATE TABLE IF NOT EXISTS alarms_evaluation_task ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, object_id INTEGER, '
+                               'value TEXT, timestamp REAL)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(alarms_evaluation_task)')]
+            if 'claim' not in columns:  # queue file of a previous version
+                connection.execute("ALTER TABLE alarms_evaluation_task ADD COLUMN claim TEXT NOT NULL DEFAULT ''")
+                connection.execute('ALTER TABLE alarms_evaluation_task ADD COLUMN lease REAL NOT NULL DEFAULT 0')
+            connection.execute('CREATE INDEX IF NOT EXISTS alarms_evaluation_task_object '
+                               'ON alarms_evaluation_task (kind, object_id, id)')
+            self.local.connection = connection
+            self.local.claimed = None  # (claim, task ids) of the last tasks taken by get
+        return connection
+
+    def put(self, task, instance=None):
+        self.connection.execute('INSERT INTO alarms_evaluation_task (kind, object_id, value, timestamp) '
+                                'VALUES (?, ?, ?, ?)', (task.kind, task.object_id, json.dumps(task.value),
+                                                        task.timestamp))
+
+    def put_many(self, tasks, instances=None):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT INTO alarms_evaluation_task (kind, object_id, value, timestamp) '
+                                   'VALUES (?, ?, ?, ?)', [(task.kind, task.object_id, json.dumps(task.value),
+                                                            task.timestamp) for task in tasks])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def get(self, worker=None, batch_size=BATCH_SIZE, timeout=1):
+
+        """
+        Claim the oldest tasks which aren't claimed (or whose lease expired), skipping the vars and devices
+        with older tasks claimed by other worker. The tasks are deleted by done, or released by failed
+        """
+        deadline = time.time() + (timeout or 0)
+        while True:
+            connection = self.connection
+            now = time.time()
+            claim = uuid.uuid4().hex
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute(
+                    'SELECT id, kind, object_id, value, timestamp FROM alarms_evaluation_task AS task '
+                    'WHERE lease < ? AND NOT EXISTS (SELECT 1 FROM alarms_evaluation_task AS older '
+                    'WHERE older.kind = task.kind AND older.object_id = task.object_id AND older.id < task.id '
+                    'AND older.lease >= ?) ORDER BY id LIMIT ?', (now, now, batch_size)).fetchall()
+                if rows:
+                    ids = [row[0] for row in rows]
+                    connection.execute('UPDATE alarms_evaluation_task SET claim = ?, lease = ? WHERE id IN (%s)'
+                                       % ', '.join('?' * len(ids)), [claim, now + self.lease] + ids)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            if rows:
+                self.local.claimed = (claim, ids)
+            if rows or time.time() >= deadline:
+                return [EvaluationTask(kind, object_id, json.loads(value), timestamp)
+                        for id, kind, object_id, value, timestamp in rows]
+            time.sleep(0.1)
+
+    def end_claim(self, sql):
+        if self.local.claimed is not None:
+            claim, ids = self.local.claimed
+            self.local.claimed = None
+            self.connection.execute(sql % ', '.join('?' * len(ids)), [claim] + ids)
+
+    def done(self, worker, tasks):
+
+        """
+        Delete the evaluated tasks, the last ones taken by the thread
+        """
+        self.end_claim('DELETE FROM alarms_evaluation_task WHERE claim = ? AND id IN (%s)')
+
+    def failed(self, worker, tasks):
+
+        """
+        Release the last tasks taken by the thread, to be evaluated again
+        """
+        self.end_claim('UPDATE alarms_evaluation_task SET lease = 0 WHERE claim = ? AND id IN (%s)')
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM alarms_evaluation_task').fetchone()[0]
+
+
+queues = {}
+queues_lock = Lock()
+
+
+def get_evaluation_queue():
+
+    """
+    Queue configured in settings:
+    ALARMS_EVALUATION_QUEUE: 'sync' (default), 'local' or 'sqlite'
+    ALARMS_EVALUATION_WORKERS: number of worker threads, 2 by default. With 0, the sqlite queue
+    is only drained by "python manage.py alarms_worker"
+    ALARMS_EVALUATION_QUEUE_PATH: SQLite file of the sqlite queue
+    """
+    kind = getattr(settings, 'ALARMS_EVALUATION_QUEUE', SYNC)
+    workers = getattr(settings, 'ALARMS_EVALUATION_WORKERS', 2)
+    path = getattr(settings, 'ALARMS_EVALUATION_QUEUE_PATH', 'alarms_queue.sqlite3')
+    key = (kind, workers, path)
+    with queues_lock:
+        if key not in queues:
+            if kind == SYNC:
+                queues[key] = SyncQueue()
+            elif kind == LOCAL:
+                queues[key] = LocalQueue(max(workers, 1))
+            elif kind == SQLITE:
+                queues[key] = SQLiteQueue(path, workers)
+            else:
+                raise ValueError('Unknown ALARMS_EVALUATION_QUEUE: %s' % kind)
+        return queues[key]
+
+
+class PendingTasks(OrderedDict):
+
+    """
+    Tasks put inside a savepoint: (kind, object id) -> (last EvaluationTask, last saved instance or None).
+    It's registered with on_commit, so Django discards it when the savepoint is rolled back, and it's
+    marked as committed when it's called, before PendingEvaluations.flush.
+    """
+
+    def __init__(self, savepoint_ids, index):
+        super(PendingTasks, self).__init__()
+        self.savepoint_ids = savepoint_ids
+        self.index = index  # position in connection.run_on_commit
+        self.committed = False
+
+    def __call__(self):
+        self.committed = True
+
+    def registered(self, connection):
+        run_on_commit = connection.run_on_commit
+        return self.index < len(run_on_commit) and run_on_commit[self.index][1] is self
+
+
+class PendingEvaluations(local):
+
+    """
+    Tasks put in the current transaction of the thread, coalesced by var or device. They are put in the
+    queue on commit, with the last value of each var, so a transaction which updates the same vars many
+    times evaluates their alarms once. Tasks are kept apart by savepoint (see PendingTasks), so the ones
+    of rolled back savepoints (or transactions) are discarded.
+    """
+
+    def __init__(self):
+        self.pending = []  # PendingTasks from the oldest to the current savepoint
+        self.flushes = 0  # flush callbacks registered in the transaction
+
+    @property
+    def tasks(self):
+
+        """
+        Tasks of the current transaction of the thread
+        :return: OrderedDict (kind, object id) -> EvaluationTask
+        """
+        connection = transaction.get_connection()
+        tasks = OrderedDict()
+        for item in self.pending:
+            if item.registered(connection):
+                tasks.update((key, task) for key, (task, instance) in item.items())
+        return tasks
+
+    def savepoints(self):
+
+        """
+        Tasks of the current transaction of the thread, from the oldest to the current savepoint, like
+        EventStates.changes. Each new savepoint registers again the flush, so it runs after all of them
+        :return: list of PendingTasks
+        """
+        connection = transaction.get_connection()
+        pending = self.pending
+        # Tasks of rolled back savepoints (or transactions) are the last ones not registered anymore
+        while pending and not pending[-1].registered(connection):
+            pending.pop()
+        if not pending:
+            self.flushes = 0
+        # Tasks of released savepoints are joined with the tasks of the enclosing savepoint
+        savepoint_ids = tuple(connection.savepoint_ids)
+        joined = []
+        for item in pending:
+            item.savepoint_ids = common_prefix(item.savepoint_ids, savepoint_ids)
+            if joined and joined[-1].savepoint_ids == item.savepoint_ids:
+                joined[-1].update(item)
+                item.clear()  # it's still called on commit
+            else:
+                joined.append(item)
+        if not joined or joined[-1].savepoint_ids != savepoint_ids:
+            item = PendingTasks(savepoint_ids, len(connection.run_on_commit))
+            transaction.on_commit(item)
+            joined.append(item)
+            # The flush is discarded with the oldest savepoint, not with the current one, so it's added
+            # like on_commit does it outside the current savepoint
+            connection.run_on_commit.append((connection.run_on_commit[joined[0].index][0], self.flush))
+            self.flushes += 1
+        self.pending = joined
+        return joined
+
+    def add(self, task, instance):
+        self.savepoints()[-1][(task.kind, task.object_id)] = (task, instance)
+
+    def flush(self):
+        self.flushes -= 1
+        if self.flushes:  # other flush was registered after the tasks of a following savepoint
+            return
+        pending = OrderedDict()
+        for item in self.pending:
+            if item.committed:
+                pending.update(item)
+        self.pending = []
+        if pending:
+            get_evaluation_queue().put_many([task for task, instance in pending.values()],
+                                            {key: instance for key, (task, instance) in pending.items()
+                                             if instance is not None})
+
+
+pending_evaluations = PendingEvaluations()
+
+
+def enqueue_many(tasks, instances=None):
+
+    """
+    Put evaluation tasks in the configured queue. Inside a transaction, tasks are coalesced and put after
+    the commit (see PendingEvaluations) unless ALARMS_EVALUATION_COALESCE is False. Except for the sync queue,
+    tasks are always put after the commit, so workers can read the saved rows.
+    :param tasks: list of EvaluationTask
+    :param instances: saved Vars and Devices by (kind, object id)
+    """
+    instances = instances or {}
+    queue = get_evaluation_queue()
+    if isinstance(queue, SQLiteQueue) and queue.workers:
+        queue.start()
+    if getattr(settings, 'ALARMS_EVALUATION_COALESCE', True) and transaction.get_connection().in_atomic_block:
+        for task in tasks:
+            pending_evaluations.add(task, instances.get((task.kind, task.object_id)))
+    elif isinstance(queue, SyncQueue):
+        queue.put_many(tasks, instances)
+    else:
+        transaction.on_commit(lambda: queue.put_many(tasks))
+
+
+def enqueue(kind, instance, value=None):
+
+    """
+    Put the evaluation of a saved var or device in the configured queue, see enqueue_many
+    :param kind: VAR or DEVICE
+    :param instance: saved Var or Device
+    :param value: value of the var
+    """
+    enqueue_many([EvaluationTask(kind, instance.pk, value, time.time())], {(kind, instance.pk): instance})
@@ -0,0 +1,212 @@
+# coding=utf-8
+import time
+from threading import Lock
+from django.conf import settings
+from .models import Monitor, Alarm
+from .formulas import get_formula
+from .tracking import model_attnames
+from .thresholds import ThresholdSet
+
+from django.apps import apps
+Device = apps.get_model(settings.DEVICE_MODEL)
+Var = apps.get_model(settings.VAR_MODEL)
+
+# Seconds before the index is built again, to take changes made by other processes
+ROUTING_INDEX_TTL = getattr(settings, 'ALARMS_ROUTING_INDEX_TTL', 60)
+
+
+class AlarmRoutingIndex(object):
+
+    """
+    In process index of the alarms which should be evaluated for a var, device or var type,
+    built from active monitors. It's invalidated by signals when monitors or alarms change,
+    and built again in the next use. Handlers use it to skip the database when nothing is monitored.
+    """
+
+    def __init__(self, ttl=ROUTING_INDEX_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.built = None
+        self.version = 0  # incremented when monitors or alarms change
+        self.by_var = {}  # var id -> alarm ids, for monitors with selected variables (lookups == '')
+        self.by_device = {}  # device id -> alarm ids, for monitors with selected devices
+        self.by_var_type = {}  # var type -> alarm ids, for device monitors which formula use vars.<var_type>
+        self.by_lookup_monitor = {}  # lookup monitor id -> alarm ids
+        self.has_lookup_monitors = False  # any monitor, active or not, with lookups
+        # Fields used by formulas, a save which doesn't change them isn't evaluated. None for all fields
+        self.var_fields = set()  # var fields used by alarms evaluated with a var (selected vars and lookups)
+        self.device_var_fields = set()  # var fields used by device alarms
+        self.device_fields = set()  # device fields used by device alarms
+        self.formulas = {}  # alarm id -> formula, of active alarms
+        self.thresholds = {}  # alarm ids of a var -> ThresholdSet, built in the first use
+
+    def build(self):
+
+        """
+        Build the index from database. If it's invalidated while it's built, the result is discarded and
+        the index is left unbuilt, so the next use builds it with the change
+        """
+        version = self.version
+        by_var, by_device, by_var_type, by_lookup_monitor = {}, {}, {}, {}
+        monitors = {}  # active monitor id -> alarm ids
+        alarms = {}
+        for alarm in Alarm.objects.filter(monitor__active=True).distinct():
+            alarms[alarm.pk] = alarm
+        for alarm_id, monitor_id in Alarm.monitor.through.objects.filter(monitor__active=True)\
+                .values_list('alarm_id', 'monitor_id'):
+            monitors.setdefault(monitor_id, set()).add(alarm_id)
+
+        has_lookup_monitors = False
+        for monitor_id, lookups in Monitor.objects.values_list('pk', 'lookups'):
+            if lookups:
+                has_lookup_monitors = True
+                if monitor_id in monitors:
+                    by_lookup_monitor[monitor_id] = set(monitors[monitor_id])
+        for monitor_id, var_id in Monitor.variables.through.objects\
+                .filter(monitor__active=True, monitor__lookups='').values_list('monitor_id', 'var_id'):
+            by_var.setdefault(var_id, set()).update(monitors.get(monitor_id, ()))
+        for monitor_id, device_id in Monitor.devices.through.objects.filter(monitor__active=True)\
+                .values_list('monitor_id', 'device_id'):
+            alarm_ids = monitors.get(monitor_id, set())
+            by_device.setdefault(device_id, set()).update(alarm_ids)
+            for alarm_id in alarm_ids:
+                for var_type in formula_var_types(alarms[alarm_id]):
+                    by_var_type.setdefault(var_type, set()).add(alarm_id)
+
+        var_alarms = set().union(*by_var.values(), *by_lookup_monitor.values())
+        device_alarms = set().union(*by_device.values())
+        var_fields = union_fields(formula_fields(alarms[pk])[0] for pk in var_alarms)
+        device_var_fields = union_fields(formula_fields(alarms[pk])[0] for pk in device_alarms)
+        if device_var_fields is not None:  # vars are taken by device and var_type
+            device_var_fields.update(model_attnames(Var, ['device', 'var_type']))
+        device_fields = union_fields(formula_fields(alarms[pk])[1] for pk in device_alarms)
+
+        with self.lock:
+            if self.version != version:
+                return
+            self.by_var, self.by_device, self.by_var_type = by_var, by_device, by_var_type
+            self.by_lookup_monitor = by_lookup_monitor
+            self.has_lookup_monitors = has_lookup_monitors
+            self.var_fields, self.device_var_fields = var_fields, device_var_fields
+            self.device_fields = device_fields
+            self.formulas = {pk: alarm.formula for pk, alarm in alarms.items()}
+            self.thresholds = {}
+            self.built = time.time()
+
+    def ensure_built(self):
+        built = self.built
+        if built is None or (self.ttl is not None and time.time() - built > self.ttl):
+            self.build()
+
+    def invalidate(self):
+        with self.lock:
+            self.built = None
+            self.version += 1
+
+    def alarms_for_var(self, var_id):
+        self.ensure_built()
+        return self.by_var.get(var_id, set())
+
+    def thresholds_for_var(self, var_id):
+
+        """
+        ThresholdSet of the alarms of a selected var. Vars with the same alarms share it
+        """
+        self.ensure_built()
+        with self.lock:  # the formulas and the thresholds of the same build
+            alarm_ids = frozenset(self.by_var.get(var_id, ()))
+            formulas, cache = self.formulas, self.thresholds
+        thresholds = cache.get(alarm_ids)
+        if thresholds is None:
+            thresholds = ThresholdSet([(pk, formulas[pk]) for pk in alarm_ids if pk in formulas])
+            with self.lock:
+                thresholds = cache.setdefault(alarm_ids, thresholds)
+        return thresholds
+
+    def alarms_for_device(self, device_id):
+        self.ensure_built()
+        return self.by_device.get(device_id, set())
+
+    def alarms_for_var_type(self, var_type):
+        self.ensure_built()
+        return self.by_var_type.get(var_type, set())
+
+    def alarms_for_lookup_monitors(self, monitor_ids):
+        self.ensure_built()
+        alarm_ids = set()
+        for monitor_id in monitor_ids:
+            alarm_ids.update(self.by_lookup_monitor.get(monitor_id, ()))
+        return alarm_ids
+
+    def lookup_monitors_exist(self):
+        self.ensure_built()
+        return self.has_lookup_monitors
+
+    def lookup_alarms_exist(self):
+        self.ensure_built()
+        return bool(self.by_lookup_monitor)
+
+    def fields_for_var(self):
+        self.ensure_built()
+        return self.var_fields
+
+    def var_fields_for_device(self):
+        self.ensure_built()
+        return self.device_var_fields
+
+    def fields_for_device(self):
+        self.ensure_built()
+        return self.device_fields
+
+
+def formula_var_types(alarm):
+
+    """
+    Var types used by a device formula, i.e {{ vars.food.value }} < 5 -> ['food']
+    """
+    expression = get_formula(alarm).expression
+    if expression is None:
+        return []
+    # literals like {{ 5 }} have an empty path
+    return [path[1] for path in expression.paths if path and len(path) > 1 and path[0] == 'vars']
+
+
+def formula_fields(alarm):
+
+    """
+    Var and Device fields used by a formula, i.e {{ var.value }} > 5 and {{ device.connected }} ->
+    ({'value'}, {'connected'}). Vars are referenced by var or vars.<key>, and device by device
+    :return: (var attnames, device attnames), None instead of a set if the fields can't be known
+    """
+    expression = get_formula(alarm).expression
+    if expression is None:
+        return None, None
+    var_names, device_names = set(), set()
+    for path in expression.paths:
+        if not path:  # literal, i.e {{ 5 }}
+            continue
+        if path[0] == 'var':
+            var_names.add(path[1] if len(path) > 1 else None)
+        elif path[0] == 'vars':
+            var_names.add(path[2] if len(path) > 2 else None)
+        elif path[0] == 'device':
+            device_names.add(path[1] if len(path) > 1 else None)
+        else:
+            return None, None
+    return model_attnames(Var, var_names), model_attnames(Device, device_names)
+
+
+def union_fields(field_sets):
+
+    """
+    Union of sets of fields, None if some of them is None
+    """
+    fields = set()
+    for field_set in field_sets:
+        if field_set is None:
+            return None
+        fields.update(field_set)
+    return fields
+
+
+routing_index = AlarmRoutingIndex()
@@ -1,8 +1,9 @@
-
+from threading import Lock
+from django.db import models
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
-from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification
-from django.contrib.contenttypes.models import ContentType
-from django.apps import apps
+from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification, NotificationCounter
+from .streams import STREAM_TIMEOUT
 
 
 class GenericSerializer(serializers.ModelSerializer):
@@ -12,6 +13,49 @@ class GenericSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ContentSerializers(object):
+
+    """
+    GenericSerializer subclass of each content model, built in its first use. The serializers are kept
+    by process, so the model isn't changed in a shared Meta class
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.serializers = {}  # model -> serializer class
+
+    def get(self, model):
+        serializer = self.serializers.get(model)
+        if serializer is None:
+            meta = type(str('Meta'), (GenericSerializer.Meta, ), {'model': model})
+            serializer = type(str('%sContentSerializer' % model.__name__), (GenericSerializer, ), {'Meta': meta})
+            with self.lock:
+                serializer = self.serializers.setdefault(model, serializer)
+        return serializer
+
+
+content_serializers = ContentSerializers()
+
+
+def prefetch_contents(events):
+
+    """
+    Prefetch the content objects of events (content_type field), with one query by content type, and the many
+    to many fields of the content objects which their serializers show, with one query by field
+    :param events: list of AlarmEvent, or None items
+    """
+    events = [event for event in events if event is not None]
+    prefetch_related_objects(events, 'content_type')
+    by_model = {}  # model -> content objects
+    for event in events:
+        for content in event.content_type.all():
+            by_model.setdefault(type(content), []).append(content)
+    for model, contents in by_model.items():
+        names = [field.name for field in model._meta.many_to_many if isinstance(field, models.ManyToManyField)]
+        if names:
+            prefetch_related_objects(contents, *names)
+
+
 class ContentTypeSerializer(serializers.ModelSerializer):
 
     '''
@@ -20,15 +64,12 @@ class ContentTypeSerializer(serializers.ModelSerializer):
     '''
 
     def to_representation(self, value):
-        content = ContentType.objects.get_for_model(type(value), for_concrete_model=True)  # getting contentType of object
+        model = type(value)._meta.concrete_model  # model of the content type of the object
         dic = {
-            "app_label": content.app_label,
-            "model": content.model,
+            "app_label": model._meta.app_label,
+            "model": model._meta.model_name,
         }
-        content_object = apps.get_model(content.app_label, content.model)  # getting object model
-        generic_serializer = GenericSerializer(value)
-        generic_serializer.Meta.model = content_object
-        dic['data'] = generic_serializer.data
+        dic['data'] = content_serializers.get(model)(value, context=self.context).data
 
         return dic
 
@@ -66,4 +107,51 @@ class NotificationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Notification
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+    def to_representation(self, instance):
+
+        """
+        Notifications taken by user (see alarms.notifications.user_notifications) have the status of the user
+        """
+        data = super(NotificationSerializer, self).to_representation(instance)
+        if getattr(instance, 'state', None) is not None:
+            data['status'] = instance.state
+        return data
+
+
+class NotificationCounterSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = NotificationCounter
+        fields = ('unchecked', 'latest', 'updated')
+
+
+class VarValueSerializer(serializers.Serializer):
+
+    '''
+    Value of a var sent to the ingest endpoint. The var is referenced by slug or id (if no var has that slug),
+    and timestamp is the date of the value in seconds since epoch (now, if it's not sent)
+    '''
+    var = serializers.CharField()
+    value = serializers.IntegerField()
+    timestamp = serializers.FloatField(required=False)
+
+
+class SinceSerializer(serializers.Serializer):
+
+    '''
+    Watermark of the incremental sync of the events and notifications lists (see alarms.sync.delta):
+    the date of the last change, or the id of the last row
+    '''
+    since = serializers.DateTimeField(required=False)
+    since_id = serializers.IntegerField(required=False, min_value=0)
+
+
+class StreamSerializer(serializers.Serializer):
+
+    '''
+    Parameters of the new notifications stream: id of the last notification known by the client,
+    and seconds a long-poll waits
+    '''
+    since_id = serializers.IntegerField(required=False, min_value=0)
+    timeout = serializers.IntegerField(required=False, min_value=0, max_value=STREAM_TIMEOUT)
@@ -1,16 +1,26 @@
 from django.conf import settings
 from django.dispatch import receiver, Signal
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, pre_save, pre_delete, post_delete, m2m_changed
 from django.contrib.auth.models import User, Group
-from django.core.mail import EmailMultiAlternatives
 from django.core.exceptions import ValidationError
-from django.template import Template, Context
-from django.template.loader import get_template
-from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification
-from .serializers import SubscriptionSerializer
+from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification, NotificationState, OutboxEmail
+from .formulas import formula_cache
+from .membership import refresh_monitor, refresh_var, refresh_device_vars
+from .routing import routing_index
+from .audience import subscriber_audience
+from .email_templates import template_cache, EventRenderer
+from .outbox import put_emails, outbox_sender, OUTBOX_SENDER
+from .digests import put_digest
+from .notifications import fan_out_on_read
+from .counters import notified, reset_counters
+from .hub import notification_hub
+from .states import event_states
+from .tracking import remember_values, remember_changed_fields, changed_fields, fields_changed
+from .queues import enqueue, VAR, DEVICE
+from .evaluation import create_event_for_not_specific_model_and_signal
 from guardian.shortcuts import get_user_perms, get_group_perms
 from django.utils import timezone
-from django.db.models import Q  # don't delete me
 
 from django.apps import apps
 Device = apps.get_model(settings.DEVICE_MODEL)
@@ -18,107 +28,119 @@ Var = apps.get_model(settings.VAR_MODEL)
 VarLog = apps.get_model(settings.VARLOG_MODEL)
 
 
+# Sent once by event with the ids of the notified users, after their notifications are created
+notifications_created = Signal(providing_args=['event', 'user_ids', 'group_ids'])
+
+
+def create_notifications(event, user_ids, group_ids=()):
+
+    """
+    Create the notifications of an event with bulk inserts, and send notifications_created.
+    Notification post_save isn't sent
+    :param user_ids: list of user ids, without repeated ids
+    :param group_ids: list of ids of the groups notified with one notification (fan-out on read)
+    """
+    if not user_ids and not group_ids:
+        return
+    Notification.objects.bulk_create([Notification(user_id=user_id, event=event) for user_id in user_ids] +
+                                     [Notification(group_id=group_id, event=event) for group_id in group_ids])
+    notifications_created.send(sender=Notification, event=event, user_ids=user_ids, group_ids=group_ids)
+
+
+def event_email(instance, context, recipients, sub, renderer):
+
+    """
+    Email of an event for the outbox, with the HTML template of the subscription if it can be rendered
+    :param recipients: list of emails
+    :param sub: SubscriptionAudience
+    :param renderer: EventRenderer of the event, templates are rendered once by event or user
+    :return: unsaved OutboxEmail
+    """
+    html_content = None
+    if sub.template is not None:
+        try:
+            html_content = renderer.html(sub.pk, sub.template, context)  # Rendering the templates with context information
+        except Exception as e:  # the email is sent only with plain text
+            print('Error rendering the email template of %s. Details: %s' % (instance, e))
+    return OutboxEmail(event=instance, subject='Event Alert: ' + instance.__str__(), from_email='noreply@localhost.com',
+                       recipients='\n'.join(recipients), body=renderer.plain_text(context), html=html_content)
+
+
 @receiver(post_save, sender=AlarmEvent)
 def notifications_n_email_after_event_creation(sender, instance, **kwargs):
 
     """
-    Create a Notification and send email (if case), when a event is created
+    Create a Notification and send email (if case), when a event is created.
+    The subscribed users are taken from the audience cache of the alarm (see alarms.audience),
+    their notifications are created at once (one by group for large groups, see alarms.notifications), and
+    the emails are put in the outbox (see alarms.outbox) or, for digest subscriptions, saved for the digest
+    of the user (see alarms.digests)
     :param sender: AlarmEvent
     """
-    alarm = instance.alarm  # Alarm which generated the event
-
-    subscriptions = Subscription.objects.filter(alarm=alarm)  # Getting the subscriptions associated with alarms
-    sub_serializer = SubscriptionSerializer(subscriptions, many=True)
-    send = []   # list of emails which the mail was send
-    notificated = []  # list with users notificated
-
     # If no device, no variable and no content_type, there is nothing to send yet. Cancel notification and email
-    if instance.device is None and instance.variables is None and len(instance.content_type.all()) == 0 :
+    if instance.device_id is None and instance.variables_id is None and len(instance.content_type.all()) == 0:
         return
-    for sub in sub_serializer.data:  # Itering for subscription
-        if sub['user'] is not None:  # if user field isn't NULL AND not Group
-            user = User.objects.get(id=sub['user'])
-            if sub['active'] and user not in notificated: # if subscription is active
-                Notification.objects.create(user=user, event=instance)  # creating notification
-                notificated.append(user)    # adding user to the notified list
-                if sub['email']:  # if email option is checked
-                    email = user.email
-                    if email not in send:  # for dont repeat email
+    audience = subscriber_audience.get(instance.alarm_id)
+    send = set()   # emails which the mail was send
+    notificated = set()  # ids of the notified users
+    notify = []  # ids of the users to notify, in subscriptions order
+    mails = []  # (context, emails, subscription) of the emails to put in the outbox after the notifications
+    digests = []  # (user id, email) of the users which receive the event in their digest
+    groups = []  # ids of the groups notified with one notification, their users aren't notified one by one
+    for sub in audience.subscriptions:
+        if fan_out_on_read(sub) and sub.group_id not in groups:
+            groups.append(sub.group_id)
+            notificated.update(sub.user_ids)
+
+    for sub in audience.subscriptions:  # Active subscriptions of the alarm
+        if sub.user_id is not None:  # if user field isn't NULL AND not Group
+            if sub.user_id not in notificated:
+                notificated.add(sub.user_id)    # adding user to the notified list
+                notify.append(sub.user_id)
+                email = audience.emails.get(sub.user_id)
+                if sub.email and email not in send:  # if email option is checked, for dont repeat email
+                    if sub.digest:
+                        send.add(email)
+                        digests.append((sub.user_id, email))
+                    else:
                         # Get a dict with relevant information about the event
                         context = {'event': instance,
                                    'alarm': instance.alarm,
-                                   'user': user,
+                                   'user': User.objects.get(id=sub.user_id),
                                    'device': instance.device,
                                    'var': instance.variables,
                                    'content_type': instance.content_type.all()}
-                        plain_text = get_template('mail.txt')  # Plain text template
-                        text_content = plain_text.render(context)
-                        subject = 'Event Alert: ' + instance.__str__()
-                        from_email = 'noreply@localhost.com'
-                        to = email
-                        msg = EmailMultiAlternatives(subject, text_content, from_email, [to])
-                        try:
-                            if sub['staff_template'] is not None:
-                                htmly = get_template(sub['staff_template'])  # Define the HTML template
-                                html_content = htmly.render(context)  # Rendering the templates with context information
-                            elif sub['staff_template_text'] != "":
-                                htmly = Template(sub['staff_template_text'])
-                                html_content = htmly.render(Context(context))
-                            elif sub['user_template'] is not None:
-                                htmly = get_template(sub['user_template'])  # Define the HTML template
-                                html_content = htmly.render(context)  # Rendering the templates with context information
-                            elif sub['user_template_text'] != "":
-                                htmly = Template(sub['user_template_text'])
-                                html_content = htmly.render(Context(context))
-                            msg.attach_alternative(html_content, 'text/html')
-                            msg.send()
-                        except:
-                            msg.send()
-                        print('Mail send to %s' % email)
-
-        if sub['group'] is not None:  # if is group and not user
-            users_mail_list = []  # list with staff users instances
-            if sub['active']:  # if subscription is active
-                group = Group.objects.get(pk=sub['group'])  # Getting the group by id
-                users = User.objects.filter(groups__name=group)  # getting the users for group
+                        mails.append((context, [email], sub))
+
+        else:  # if is group and not user
+            users_mail_list = []  # list with the emails of the group users
+            for user_id in sub.user_ids:  # Iterating users
+                if user_id not in notificated:
+                    notificated.add(user_id)  # adding user to notificated list
+                    notify.append(user_id)
+                if sub.email:
+                    mail = audience.emails.get(user_id)  # Adding the email for users in the user list
+                    if mail not in send:  # for don't repeat email
+                        send.add(mail)
+                        if sub.digest:
+                            digests.append((user_id, mail))
+                        else:
+                            users_mail_list.append(mail)
+            if users_mail_list:
                 context = {'event': instance,
                            'alarm': instance.alarm,
-                           'user': group,
+                           'user': Group.objects.get(pk=sub.group_id),
                            'device': instance.device,
                            'var': instance.variables}
-                for user in users:  # Iterating users
-                    if user not in notificated:
-                        Notification.objects.create(user=user, event=instance) # creating notification
-                        notificated.append(user) # adding user to notificated list
-                    if sub['email']:
-                        mail = user.email  # Adding the email for users in the user list
-                        if mail not in send:  # for don't repeat email
-                            users_mail_list.append(mail)
-                            send.append(mail)
-                # After getting all the emails and classifying it for staff and not staff members
-                plain_text = get_template('mail.txt')  # Plain text template
-                text_content = plain_text.render(context)
-                subject = 'Event Alert: ' + instance.__str__()
-                from_email = 'noreply@localhost.com'
-                msg = EmailMultiAlternatives(subject, text_content, from_email, users_mail_list)
-                try:
-                    if sub['staff_template'] is not None:
-                        htmly = get_template(sub['staff_template'])  # Define the HTML template
-                        html_content = htmly.render(context)  # Rendering the templates with context information
-                    elif sub['staff_template_text'] != "":
-                        htmly = Template(sub['staff_template_text'])
-                        html_content = htmly.render(Context(context))
-                    elif sub['user_template'] is not None:
-                        htmly = get_template(sub['user_template'])  # Define the HTML template
-                        html_content = htmly.render(context)  # Rendering the templates with context information
-                    elif sub['user_template_text'] != "":
-                        htmly = Template(sub['user_template_text'])
-                        html_content = htmly.render(Context(context))
-                    msg.attach_alternative(html_content, 'text/html')
-                    msg.send()
-                except:
-                    msg.send()
-                print('Mail send to %s' % str(users_mail_list))
+                mails.append((context, users_mail_list, sub))
+
+    create_notifications(instance, notify, groups)  # creating notifications
+    renderer = EventRenderer()
+    put_emails([event_email(instance, context, recipients, sub, renderer) for context, recipients, sub in mails])
+    if digests:
+        put_digest(instance, digests)
+        if OUTBOX_SENDER:  # the sender flushes the digests when their window ends
+            transaction.on_commit(outbox_sender.start)
 
 
 @receiver(pre_save, sender=Subscription)
@@ -184,190 +206,312 @@ def no_save_subscription_if_dont_have_permissions(sender, instance, **kwargs):
         raise ValidationError("BAD REQUEST. Check your selections.")
 
 
+@receiver(post_save, sender=Alarm)
+@receiver(post_delete, sender=Alarm)
+def invalidate_compiled_formula(sender, instance, **kwargs):
+
+    """
+    Discard the compiled formula of an alarm when it is changed or deleted,
+    it will be compiled again in the next evaluation
+    :param sender: Alarm
+    """
+    formula_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Monitor)
+@receiver(post_delete, sender=Monitor)
+@receiver(post_save, sender=Alarm)
+@receiver(post_delete, sender=Alarm)
+@receiver(m2m_changed, sender=Monitor.devices.through)
+@receiver(m2m_changed, sender=Monitor.variables.through)
+@receiver(m2m_changed, sender=Alarm.monitor.through)
+def invalidate_alarm_routing_index(sender, **kwargs):
+
+    """
+    Build the alarms routing index again in the next use, when monitors, alarms or their relations change.
+    It's invalidated again after commit, in case other thread built it before the changes were committed
+    """
+    routing_index.invalidate()
+    transaction.on_commit(routing_index.invalidate)
+
+
+def invalidate_audience(alarm_ids):
+
+    """
+    Resolve again the audience of the alarms in the next event. It's invalidated again after commit,
+    in case other thread resolved it before the changes were committed
+    """
+    if alarm_ids:
+        subscriber_audience.invalidate(alarm_ids)
+        transaction.on_commit(lambda: subscriber_audience.invalidate(alarm_ids))
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_audience_by_subscription(sender, instance, **kwargs):
+
+    """
+    Audience of the alarm of a changed subscription
+    :param sender: Subscription
+    """
+    invalidate_audience(subscriber_audience.alarms_for_subscription(instance))
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_subscription_template(sender, instance, **kwargs):
+
+    """
+    Compile again the template text of a changed subscription in the next email
+    :param sender: Subscription
+    """
+    template_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_audience_by_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+
+    """
+    Audience of the alarms of the groups which users changed
+    :param sender: User.groups.through
+    """
+    if not action.startswith('post_'):
+        return
+    if reverse:  # group.user_set changed
+        invalidate_audience(subscriber_audience.alarms_for_groups([instance.pk]))
+    elif pk_set is not None:  # user.groups add or remove
+        invalidate_audience(subscriber_audience.alarms_for_groups(pk_set))
+    else:  # user.groups clear
+        invalidate_audience(subscriber_audience.alarms_for_users([instance.pk]))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_audience_by_user(sender, instance, **kwargs):
+
+    """
+    Audience of the alarms which notify a changed (i.e email) or deleted user
+    :param sender: User
+    """
+    invalidate_audience(subscriber_audience.alarms_for_users([instance.pk]))
+
+
+@receiver(post_save, sender=Alarm)
+@receiver(post_delete, sender=Alarm)
+def invalidate_audience_by_alarm(sender, instance, **kwargs):
+
+    """
+    Audience of a new or deleted alarm, its id could have been used by other alarm
+    :param sender: Alarm
+    """
+    invalidate_audience([instance.pk])
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_audience_by_group(sender, instance, **kwargs):
+
+    """
+    Audience of the alarms of a deleted group
+    :param sender: Group
+    """
+    invalidate_audience(subscriber_audience.alarms_for_groups([instance.pk]))
+
+
+@receiver(notifications_created)
+def count_created_notifications(sender, event, user_ids, group_ids=(), **kwargs):
+
+    """
+    Add the notifications of an event to the notification counters of their users
+    """
+    notified(event, user_ids, group_ids)
+
+
+@receiver(notifications_created)
+def publish_created_notifications(sender, event, user_ids, group_ids=(), **kwargs):
+
+    """
+    Publish the notifications of an event to the streams of their users after the commit, so the users
+    can read them. Nothing is done if nobody is listening
+    """
+    if notification_hub.users():
+        transaction.on_commit(lambda: notification_hub.publish_notifications(event.pk, user_ids, group_ids))
+
+
+@receiver(post_save, sender=Notification)
+def publish_saved_notification(sender, instance, created, **kwargs):
+
+    """
+    Publish a notification created one by one (not by the fan-out of an event)
+    """
+    if created and instance.event_id is not None and notification_hub.users():
+        user_ids = [instance.user_id] if instance.user_id is not None else []
+        group_ids = [instance.group_id] if instance.group_id is not None else []
+        transaction.on_commit(lambda: notification_hub.publish_notifications(instance.event_id, user_ids, group_ids))
+
+
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def reset_counters_by_notification(sender, instance, **kwargs):
+
+    """
+    Count again the notifications of the users of a created (one by one), changed or deleted notification
+    :param sender: Notification
+    """
+    if instance.group_id is not None:
+        reset_counters(group_ids=[instance.group_id])
+    elif instance.user_id is not None:
+        reset_counters(user_ids=[instance.user_id])
+
+
+@receiver(post_save, sender=NotificationState)
+@receiver(post_delete, sender=NotificationState)
+def reset_counters_by_notification_state(sender, instance, **kwargs):
+
+    """
+    Count again the notifications of a user which changed the status of a group notification
+    :param sender: NotificationState
+    """
+    reset_counters(user_ids=[instance.user_id])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def reset_counters_by_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+
+    """
+    Count again the notifications of the users which groups changed, they see other group notifications
+    :param sender: User.groups.through
+    """
+    if reverse:  # group.user_set changed
+        if action == 'pre_clear':
+            reset_counters(group_ids=[instance.pk])
+        elif action in ('post_add', 'post_remove'):
+            reset_counters(user_ids=pk_set)
+    elif action.startswith('post_'):  # user.groups changed
+        reset_counters(user_ids=[instance.pk])
+
+
+@receiver(pre_delete, sender=Group)
+def reset_counters_by_group(sender, instance, **kwargs):
+
+    """
+    Count again the notifications of the users of a deleted group, before its users are removed
+    :param sender: Group
+    """
+    reset_counters(group_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Alarm)
+@receiver(post_delete, sender=Alarm)
+def invalidate_event_states(sender, **kwargs):
+
+    """
+    Build the event states again in the next use, the re-arm window depends on the duration of the alarms
+    :param sender: Alarm
+    """
+    event_states.invalidate()
+    transaction.on_commit(event_states.invalidate)
+
+
+@receiver(post_save, sender=AlarmEvent)
+@receiver(post_delete, sender=AlarmEvent)
+def update_event_states(sender, instance, created=False, **kwargs):
+
+    """
+    Keep the event states of the device and var of an event: a new open event is saved in them,
+    other changes (finished by the API or the admin, deleted events) take the states again from database
+    :param sender: AlarmEvent
+    """
+    if created and instance.finished is None:
+        event_states.opened(instance.alarm_id, instance.device_id, instance.variables_id, instance.created)
+    else:
+        event_states.reload(instance.device_id, instance.variables_id)
+
+
+@receiver(post_save, sender=Monitor)
+def update_lookup_vars_by_monitor(sender, instance, **kwargs):
+
+    """
+    Save the vars which satisfy the lookups field of the monitor
+    :param sender: Monitor
+    """
+    refresh_monitor(instance)
+
+
 @receiver(post_save, sender=Device)
-def create_event_for_alarm_formula_by_device_update(sender, instance, **kwargs):
+def update_lookup_monitors_by_device(sender, instance, created, **kwargs):
 
     """
-    Create event by formula field in alarm referenced by updated device
+    Update the lookup monitors of the device vars, if lookups use device fields (i.e device__name)
     :param sender: Device
     """
-    alarms = Alarm.objects.filter(monitor__devices=instance, monitor__active=True) # Get the alarms reference by monitors list
-    #vars = instance.vars.values('value', 'slug', 'var_type')
-    vars = Var.objects.filter(device=instance).values('value', 'slug', 'var_type')
-    context = {
-        'vars': {var_item['var_type']: var_item for var_item in vars},
-        'device': instance
-    }
-    var_types = [var_item['var_type'] for var_item in vars]  # Device var_types
-    for alarm in alarms:
-        condition = False
-        try:
-            template = Template(alarm.formula)  # example -> {{ vars.voltaje.value }} > 12
-            condition = eval(template.render(Context(context)))  # eval the formula with values in context dictionary
-        except:
-            print('Error al ejecutar formula de alarma ' + alarm.name)
-            condition = None
-            break  # if formula false, next alarm or variable
-
-        n_vars_in_formula = 0  # count the vars in formula field
-        var_in_formula = None
-        if condition:  # if formula expression return True
-            for var_type in var_types:
-                if var_type in alarm.formula:
-                    n_vars_in_formula += 1
-                    var_in_formula = Var.objects.get(var_type=var_type, device=instance)
-            # Only work for one var in formula, if two or more, is hard to determinate which generate alarm
-            # in case two or more variables are in formula, 'variables' field get null value.
-            if n_vars_in_formula == 1:
-                AlarmEvent.objects.create(alarm=alarm, device=instance, variables=var_in_formula, description=alarm.description)
-            else:
-                AlarmEvent.objects.create(alarm=alarm, device=instance, description=alarm.description)
-            print('Evento creado')
-        elif condition == False:  # if formula return False, NO CASE IF FORMULA FAULTS
-            for var_type in var_types:
-                if var_type in alarm.formula:
-                    n_vars_in_formula += 1
-                    var_in_formula = Var.objects.get(var_type=var_type, device=instance)
-            # only works for only one var, too.
-            # In this, we want to set finished date to the events with same var and device, don't have finished date,
-            # and because false, have a good value for variable.
-            if n_vars_in_formula == 1:
-                AlarmEvent.objects.filter(alarm=alarm, device=instance, variables=var_in_formula,
-                                          finished=None).update(finished=timezone.now(), description=alarm.description)
+    if not created and routing_index.lookup_monitors_exist():
+        refresh_device_vars(instance)
 
 
 @receiver(post_save, sender=Var)
-def create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(sender, instance, **kwargs):
+def update_lookup_monitors_by_var(sender, instance, **kwargs):
 
     """
-    Create event by alarm formula field for alarm type, no only variable instance
+    Update the lookup monitors satisfied by the var. Connected before the formula evaluation receivers,
+    because they use the updated monitors
     :param sender: Var
     """
-    monitors = []
-    vars = []
-    for monitor in Monitor.objects.all():
-        if monitor.lookups:
-            try:
-                vars_query = eval('Var.objects.filter(%s)' % monitor.lookups)
-            except Exception as e:
-                vars_query = []
-                print("Error executing lookup %s in monitor %s. Details: %s" % (monitor.lookups, monitor, e))
-
-            if instance in vars_query:
-                monitors.append(monitor)
-                values = vars_query.all()
-                for value in values:
-                    vars.append(value) if value not in vars else next
-
-    context = {'vars': {}, 'var': {}}
-    alarms = Alarm.objects.filter(monitor__in=monitors, monitor__active=True)
-    for alarm in alarms:
-        for var_item in vars:
-            load = "{% load alarms_template_filters %}"
-            context['vars'][var_item.slug] = var_item  # i.e -> {'food-al1': <Var: 'food-al1'>, 'food-other': <Var: 'food-other'>}
-            context['var'] = var_item  # Current var
-            # Evaluate the condition and take a boolean(True or False) if another result is another, nothing happens
-            try:
-                template = Template(load + alarm.formula)  # example -> {{ var.value }} > 12
-                # Evaluate the condition and take a boolean(True or False) if another result is another, nothing happens
-                condition = eval(template.render(Context(context)))
-            except:
-                print('Error evaluating formula of ' + alarm.name + ', variable: ' + var_item.slug)
-                condition = None
-                pass
-
-            if condition == True:  # if formula evaluation return True
-                variable = Var.objects.get(id=var_item.id)
-                device = Device.objects.get(id=var_item.device.id)
-                last_event = AlarmEvent.objects.filter(alarm=alarm, variables=variable, device=device).last()
-                if last_event is not None:
-                    new_date = last_event.created + timezone.timedelta(hours=alarm.duration)
-                    if timezone.now() > new_date:
-                        AlarmEvent.objects.create(alarm=alarm, variables=variable, device=device,
-                                                  description=alarm.description)
-                        print('Event created')
-                else:
-                    AlarmEvent.objects.create(alarm=alarm, variables=variable, device=device,
-                                              description=alarm.description)
-                    print('Event created')
-            elif condition == False:  # if formula evaluation return False, NO CASE IF FORMULA FAULT
-                # In this, we want to set finished date to the events with same var and device, don't have finished date
-                # and because false, have a good value for variable.
-                variable = Var.objects.get(id=var_item.id)
-                device = Device.objects.get(id=var_item.device.id)
-                AlarmEvent.objects.filter(alarm=alarm, variables=variable, device=device,
-                                          finished=None).update(finished=timezone.now(), description=alarm.description)
+    if routing_index.lookup_monitors_exist():
+        refresh_var(instance)
+
+
+@receiver(post_init, sender=Var)
+@receiver(post_init, sender=Device)
+def track_loaded_fields(sender, instance, **kwargs):
+
+    """
+    Remember the field values of a loaded var or device, to know which fields are changed when it's saved
+    :param sender: Var or Device
+    """
+    remember_values(instance, routing_index.version)
+
+
+@receiver(pre_save, sender=Var)
+@receiver(pre_save, sender=Device)
+def track_changed_fields(sender, instance, update_fields=None, **kwargs):
+
+    """
+    Save in the instance the fields changed by the save, used by the evaluation receivers
+    :param sender: Var or Device
+    """
+    remember_changed_fields(instance, update_fields, routing_index.version)
 
 
 @receiver(post_save, sender=Var)
-def create_event_for_alarm_formula_looking_var_for_monitor_var_selection(sender, instance, **kwargs):
+def enqueue_var_evaluation(sender, instance, **kwargs):
 
     """
-    Create an event if var instance satisfy the condition in formula field of an alarm
+    Put the evaluation of the alarms for the updated var in the evaluation queue, if it's selected
+    in monitors or there are alarms for lookup monitors, and the save changed fields used by formulas.
+    The device of the var is evaluated too, if its alarms use the var
+    :param sender: Var
     """
-    # Only for alarms with monitors with selected variables in select box, and no with lookups
-    alarms = Alarm.objects.filter(monitor__variables=instance, monitor__active=True, monitor__lookups="")
-    context = {
-        'vars': {instance.slug: {'slug': instance.slug, 'var_type': instance.var_type, 'value': instance.value,
-                                 'device': instance.device}},
-        'var': {'slug': instance.slug, 'value': instance.value, 'device': instance.device}
-    }
+    changed = changed_fields(instance)
+    if (routing_index.alarms_for_var(instance.pk) or routing_index.lookup_alarms_exist()) and \
+            fields_changed(changed, routing_index.fields_for_var()):
+        enqueue(VAR, instance, instance.value)
+    if instance.device_id and fields_changed(changed, routing_index.var_fields_for_device()) and \
+            routing_index.alarms_for_var_type(instance.var_type) & routing_index.alarms_for_device(instance.device_id):
+        enqueue(DEVICE, instance.device)
 
-    for alarm in alarms:
-        condition = False
-        try:
-            template = Template(alarm.formula)  # example -> {{ vars.voltaje.value }} > 12
-            condition = eval(template.render(Context(context)))  # eval the formula with values in context dictionary
-        except:
-            print('Error al ejecutar formula de alarma ' + alarm.name)
-            break
-
-        if condition == True:
-            last_event = AlarmEvent.objects.filter(alarm=alarm, device=instance.device, variables=instance).last()
-            if last_event is not None:
-                new_date = last_event.created + timezone.timedelta(hours=alarm.duration)
-                if timezone.now() > new_date:
-                    AlarmEvent.objects.create(alarm=alarm, device=instance.device, variables=instance,
-                                      description=alarm.description)
-            else:
-                AlarmEvent.objects.create(alarm=alarm, device=instance.device, variables=instance,
-                                          description=alarm.description)
-        elif condition == False:
-            AlarmEvent.objects.filter(alarm=alarm, device=instance.device, variables=instance, finished=None).update(
-                finished=timezone.now(), description=alarm.description)
-
-
-def create_event_for_not_specific_model_and_signal(sender_instance, alarm_instance):
-
-    """
-    Create an event for not specific signal, setting the instance in ContentType field of event.
-    This function should to be call by a post_save signal, to create an event with content_type field
-    The signal should call the function and pass the object instance and the alarm instance
-    :param sender_instance: Generic object
-    :param alarm_instance: Alarm instance
-    """
-    context = {
-        'var': sender_instance
-    }
-    # key 'var' take the object value, for this reason in alarm template,
-    # user can access to any field of it. Remember that template execution should return True or False
-
-    condition = False
-    try:
-        template = Template(alarm_instance.formula)
-        condition = eval(template.render(Context(context)))
-    except:
-        print('Formula error: ' + alarm_instance.name)
-        return
 
-    if condition == True:   # Create the new event
-        event = AlarmEvent.objects.create(alarm=alarm_instance)
-        event.content_type = [sender_instance]
-        event.save()
-    if condition == False:  # Update finished date to event
-        events = AlarmEvent.objects.filter(alarm=alarm_instance)
-        for event in events:
-            event.update(finished=timezone.now()) if list(event.content_type) == [sender_instance] else None
+@receiver(post_save, sender=Device)
+def enqueue_device_evaluation(sender, instance, **kwargs):
+
+    """
+    Put the evaluation of the alarms referenced by the updated device in the evaluation queue,
+    if the save changed device fields used by formulas. Changes of its vars are evaluated by the var receiver
+    :param sender: Device
+    """
+    if routing_index.alarms_for_device(instance.pk) and \
+            fields_changed(changed_fields(instance), routing_index.fields_for_device()):
+        enqueue(DEVICE, instance)
+
 
 """
 # TODO: Remove this code from previous version
@@ -0,0 +1,281 @@
+# coding=utf-8
+import time
+from collections import namedtuple
+from datetime import timedelta
+from threading import Lock, local
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Max, Sum, Case, When, Value, IntegerField
+from django.utils import timezone
+from .models import Alarm, AlarmEvent
+
+# Seconds before the states are built again, to take events changed by other processes
+EVENT_STATES_TTL = getattr(settings, 'ALARMS_EVENT_STATES_TTL', 60)
+
+# State of the events of an alarm for a device and var: True if some event isn't finished,
+# and creation date of the last event (None if there are no events in the re-arm window)
+EventState = namedtuple('EventState', ['open', 'last_created'])
+NO_EVENTS = EventState(False, None)
+RELOAD = object()  # states changed outside the evaluation, taken again from database
+
+
+def aggregate_states(queryset, *fields):
+
+    """
+    Event states from AlarmEvent rows, grouped by alarm and fields
+    :return: list of (alarm id, field values..., EventState)
+    """
+    open_events = Sum(Case(When(finished=None, then=Value(1)), default=Value(0), output_field=IntegerField()))
+    rows = queryset.values('alarm', *fields).annotate(last_created=Max('created'), open_events=open_events)\
+        .order_by().values_list('alarm', *(fields + ('last_created', 'open_events')))
+    return [row[:-2] + (EventState(bool(row[-1]), row[-2]), ) for row in rows]
+
+
+def load_states(device_id, var_id):
+
+    """
+    Event states of a device and var from database
+    :return: dict alarm id -> EventState
+    """
+    queryset = AlarmEvent.objects.filter(device_id=device_id, variables_id=var_id)
+    return {alarm_id: state for alarm_id, state in aggregate_states(queryset)}
+
+
+def common_prefix(first, second):
+    prefix = []
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        prefix.append(a)
+    return tuple(prefix)
+
+
+class StateChanges(dict):
+
+    """
+    States changed inside a savepoint: key (device id, var id) -> {alarm id: EventState} or RELOAD.
+    It's registered with on_commit, so it's applied to the table when the transaction is committed,
+    and Django discards it when the savepoint is rolled back.
+    """
+
+    def __init__(self, table, savepoint_ids, index):
+        super(StateChanges, self).__init__()
+        self.table = table
+        self.savepoint_ids = savepoint_ids
+        self.index = index  # position in connection.run_on_commit
+
+    def __call__(self):
+        self.table.apply(self)
+
+    def registered(self, connection):
+        run_on_commit = connection.run_on_commit
+        return self.index < len(run_on_commit) and run_on_commit[self.index][1] is self
+
+
+class EventStates(object):
+
+    """
+    In process table of the open events and last creation date by alarm, device and var. The evaluation
+    use it to know if there is an event to finish, and if the last event is in the re-arm window
+    (Alarm.duration), so the database is only written when an event is created or finished.
+
+    The table is built from AlarmEvent with the open events and the events of the re-arm window of
+    the alarms, and again after ttl seconds. Changes made inside a transaction are kept apart by thread
+    and savepoint, and applied to the table on commit, so rolled back changes are discarded. A transaction
+    which already changed events doesn't build the table, it takes the states from database by device and var.
+    """
+
+    def __init__(self, ttl=EVENT_STATES_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.built = None
+        self.version = 0  # incremented when the table is invalidated
+        self.writes = 0  # number of states written to the table
+        self.written = {}  # (device id, var id) -> number of the write of its states, since the last build
+        self.states = {}  # (device id, var id) -> {alarm id: EventState}
+        self.local = local()
+
+    def build(self):
+
+        """
+        Build the table from database. States written while it's built are kept, they are newer than the
+        query. If the table is invalidated meanwhile, the result isn't stored and the table stays unbuilt
+        :return: dict (device id, var id) -> {alarm id: EventState}, the built table
+        """
+        with self.lock:
+            version, writes = self.version, self.writes
+        durations = Alarm.objects.aggregate(max_duration=Max('duration'))['max_duration'] or 0
+        since = timezone.now() - timedelta(hours=durations)
+        queryset = AlarmEvent.objects.filter(Q(finished=None) | Q(created__gte=since))
+        states = {}
+        for alarm_id, device_id, var_id, state in aggregate_states(queryset, 'device', 'variables'):
+            states.setdefault((device_id, var_id), {})[alarm_id] = state
+        with self.lock:
+            if self.version != version:
+                return states
+            for key, write in list(self.written.items()):
+                if write > writes:
+                    states[key] = self.states[key]
+                else:
+                    del self.written[key]
+            self.states = states
+            self.built = time.time()
+        return states
+
+    def store(self, key, states):
+
+        """
+        Write the states of a device and var in the table, with the lock
+        """
+        self.writes += 1
+        self.written[key] = self.writes
+        self.states[key] = states
+
+    def invalidate(self):
+        with self.lock:
+            self.built = None
+            self.version += 1
+
+    def is_built(self):
+        return self.built is not None and (self.ttl is None or time.time() - self.built <= self.ttl)
+
+    def changes(self):
+
+        """
+        Changes of the current transaction of the thread, from the oldest to the current savepoint
+        :return: list of StateChanges, None outside transactions
+        """
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return None
+        changes = getattr(self.local, 'changes', None) or []
+        # Changes of rolled back savepoints (or transactions) are the last ones not registered anymore
+        while changes and not changes[-1].registered(connection):
+            changes.pop()
+        # Changes of released savepoints are joined with the changes of the enclosing savepoint
+        savepoint_ids = tuple(connection.savepoint_ids)
+        joined = []
+        for item in changes:
+            item.savepoint_ids = common_prefix(item.savepoint_ids, savepoint_ids)
+            if joined and joined[-1].savepoint_ids == item.savepoint_ids:
+                joined[-1].update(item)
+                item.clear()  # it's still called on commit
+            else:
+                joined.append(item)
+        if not joined or joined[-1].savepoint_ids != savepoint_ids:
+            item = StateChanges(self, savepoint_ids, len(connection.run_on_commit))
+            transaction.on_commit(item)
+            joined.append(item)
+        self.local.changes = joined
+        return joined
+
+    def apply(self, changes):
+
+        """
+        Apply the changes of a committed transaction to the table
+        """
+        for key, states in changes.items():
+            if states is RELOAD:
+                states = load_states(*key)
+            with self.lock:
+                self.store(key, states)
+
+    def get(self, device_id, var_id):
+
+        """
+        Event states of a device and var
+        :return: dict alarm id -> EventState, it shouldn't be modified
+        """
+        key = (device_id, var_id)
+        changes = self.changes()
+        if changes is not None:
+            for item in reversed(changes):
+                states = item.get(key)
+                if states is RELOAD:
+                    states = item[key] = load_states(device_id, var_id)
+                if states is not None:
+                    return states
+            if not self.is_built():
+                if any(changes):  # the transaction changed events, the table can't be built with them
+                    states = changes[-1][key] = load_states(device_id, var_id)
+                    return states
+                return self.build().get(key, {})
+        elif not self.is_built():
+            return self.build().get(key, {})
+        return self.states.get(key, {})
+
+    def state(self, alarm_id, device_id, var_id):
+        return self.get(device_id, var_id).get(alarm_id, NO_EVENTS)
+
+    def set(self, alarm_id, device_id, var_id, state):
+        states = dict(self.get(device_id, var_id))
+        states[alarm_id] = state
+        changes = self.changes()
+        if changes is not None:
+            changes[-1][(device_id, var_id)] = states
+        else:
+            with self.lock:
+                self.store((device_id, var_id), states)
+
+    def opened(self, alarm_id, device_id, var_id, created):
+
+        """
+        Save the creation of an event
+        """
+        self.set(alarm_id, device_id, var_id, EventState(True, created))
+
+    def finished(self, alarm_id, device_id, var_id):
+
+        """
+        Save that the events of an alarm for a device and var are finished
+        """
+        self.set(alarm_id, device_id, var_id, self.state(alarm_id, device_id, var_id)._replace(open=False))
+
+    def reload(self, device_id, var_id):
+
+        """
+        Take again from database the states of a device and var, i.e when an event is changed outside the evaluation
+        """
+        changes = self.changes()
+        if changes is not None:
+            changes[-1][(device_id, var_id)] = RELOAD
+        else:
+            states = load_states(device_id, var_id)
+            with self.lock:
+                self.store((device_id, var_id), states)
+
+
+event_states = EventStates()
+
+
+def can_open(alarm, device_id, var_id, now):
+
+    """
+    True if a new event of the alarm can be created: there are no events for the device and var,
+    or the last one was created more than alarm.duration hours before now
+    """
+    last_created = event_states.state(alarm.pk, device_id, var_id).last_created
+    return last_created is None or now > last_created + timedelta(hours=alarm.duration)
+
+
+def create_event(alarm, device, var, **kwargs):
+
+    """
+    Create an event of the alarm, its state is saved by the post_save signal
+    :param device: Device or its id
+    :param var: Var, its id or None
+    """
+    return AlarmEvent.objects.create(alarm=alarm, device_id=getattr(device, 'pk', device),
+                                     variables_id=getattr(var, 'pk', var), description=alarm.description, **kwargs)
+
+
+def finish_events(alarm, device_id, var_id, now):
+
+    """
+    Set finished date to the open events of the alarm for the device and var, if there are
+    """
+    if not event_states.state(alarm.pk, device_id, var_id).open:
+        return
+    AlarmEvent.objects.filter(alarm=alarm, device_id=device_id, variables_id=var_id, finished=None)\
+        .update(finished=now, description=alarm.description)
+    event_states.finished(alarm.pk, device_id, var_id)
@@ -0,0 +1,101 @@
+# coding=utf-8
+import json
+import time
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer
+from .hub import notification_hub
+from .notifications import user_notifications
+from .sync import SYNC_SIZE
+
+# Seconds a long-poll waits for new notifications by default, and the maximum asked with ?timeout=
+STREAM_TIMEOUT = getattr(settings, 'ALARMS_STREAM_TIMEOUT', 30)
+# Seconds a server-sent events stream is open before it's closed (the client reconnects with Last-Event-ID),
+# and seconds between its keep-alive comments
+STREAM_DURATION = getattr(settings, 'ALARMS_STREAM_DURATION', 300)
+STREAM_KEEPALIVE = 15
+
+
+class EventStreamRenderer(BaseRenderer):
+
+    """
+    Accepts text/event-stream, the stream is rendered by event_stream
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data)
+
+
+def pending(user, since_id):
+
+    """
+    Notifications of a user created after an id, from database
+    :return: list of messages {'notification': id, 'event': id}, oldest first
+    """
+    return [{'notification': pk, 'event': event_id} for pk, event_id in user_notifications(user)
+            .filter(pk__gt=since_id).order_by('pk').values_list('pk', 'event_id')[:SYNC_SIZE]]
+
+
+def newest(user):
+
+    """
+    Id of the newest notification of a user, 0 if it has none
+    """
+    return user_notifications(user).order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def long_poll(user, since_id=None, timeout=STREAM_TIMEOUT):
+
+    """
+    Wait for new notifications of a user. The user listens to the hub before looking for the notifications created
+    after since_id, so the ones created meanwhile aren't lost
+    :param since_id: id of the last notification known by the client, None to wait only for new ones
+    :param timeout: seconds
+    :return: list of messages, empty if no notification was created before the timeout
+    """
+    with notification_hub.subscribe(user.pk) as listener:
+        if since_id is not None:
+            messages = pending(user, since_id)
+            if messages:
+                return messages
+        return listener.get(timeout)
+
+
+def sse(message):
+    return 'id: %d\nevent: notification\ndata: %s\n\n' % (message['notification'], json.dumps(message))
+
+
+def event_stream(user, since_id=None, duration=STREAM_DURATION, keepalive=STREAM_KEEPALIVE):
+
+    """
+    Server-sent events of the new notifications of a user, with the notification id as event id. If the listener
+    of the user drops messages (the client doesn't read them), they are taken from database
+    :param since_id: id of the last notification known by the client (Last-Event-ID), None for only new ones
+    :param duration: seconds before the stream ends
+    :return: generator of text
+    """
+    listener = notification_hub.subscribe(user.pk)
+    try:
+        # without since_id, the newest notification when the stream opens is the one the dropped messages follow
+        messages = pending(user, since_id) if since_id is not None else []
+        last_id = since_id if since_id is not None else newest(user)
+        yield 'retry: %d\n\n' % (keepalive * 1000)
+        end = time.time() + duration
+        while True:
+            for message in messages:
+                if message['notification'] > last_id:
+                    last_id = message['notification']
+                    yield sse(message)
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            if listener.lost:
+                listener.lost = False
+                messages = pending(user, last_id)
+                continue
+            messages = listener.get(min(keepalive, remaining))
+            if not messages:
+                yield ': keepalive\n\n'
+    finally:
+        listener.close()
@@ -0,0 +1,50 @@
+# coding=utf-8
+from django.conf import settings
+from django.db.models import Q, F, Case, When, DateTimeField
+from django.utils import timezone
+
+# Maximum rows of a delta of the incremental sync, the client asks again from the returned watermark if there are more
+SYNC_SIZE = getattr(settings, 'ALARMS_SYNC_SIZE', 1000)
+
+
+def changed_since(queryset, since, finished=False, now=None):
+
+    """
+    Rows created after a date, or (events) finished after it, oldest change first. A finish date in the future
+    isn't a change yet, so it doesn't move the watermark past the rows created before it
+    :param finished: True if the rows have a finished date
+    :return: queryset annotated with the date of the change as changed
+    """
+    if not finished:
+        return queryset.filter(created__gt=since).annotate(changed=F('created')).order_by('changed', 'pk')
+    now = now or timezone.now()
+    changed = Case(When(finished__lte=now, then=F('finished')), default=F('created'), output_field=DateTimeField())
+    return queryset.filter(Q(created__gt=since) | Q(finished__gt=since, finished__lte=now))\
+        .annotate(changed=changed).order_by('changed', 'pk')
+
+
+def delta(queryset, since=None, since_id=None, size=SYNC_SIZE, finished=False):
+
+    """
+    Rows changed after a watermark, for the clients which keep a copy of a list
+    :param queryset: rows of the list, with its filters
+    :param since: date, the rows created or finished after it (see changed_since)
+    :param since_id: id, the rows created after it (used if since is None)
+    :param finished: True if the rows have a finished date
+    :return: (rows, watermark, more) watermark is a dict with the since or since_id of the next delta, and more
+             is True if there are more changed rows after it
+    """
+    if since is None:
+        rows = list(queryset.filter(pk__gt=since_id).order_by('pk')[:size + 1])
+        more = len(rows) > size
+        rows = rows[:size]
+        return rows, {'since_id': rows[-1].pk if rows else since_id}, more
+
+    queryset = changed_since(queryset, since, finished)
+    rows = list(queryset[:size + 1])
+    more = len(rows) > size
+    if more:
+        # the rows changed at the same time as the first one left out go in the next delta, so none is skipped
+        following = rows[size].changed
+        rows = [row for row in rows[:size] if row.changed != following] or list(queryset.filter(changed=following))
+    return rows, {'since': rows[-1].changed if rows else since}, more
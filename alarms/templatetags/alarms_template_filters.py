@@ -3,8 +3,8 @@ from django.conf import settings
 from django.apps import apps
 from django import template
 from django.utils import timezone
-from django.template import Template, Context
 from django.db.models import Q
+from ..expressions import parse_lookups
 VarLog = apps.get_model(settings.VARLOG_MODEL)
 
 register = template.Library()
@@ -40,9 +40,5 @@ def qs_filter(query, arg):
     for log in query:
         log_ids.append(log.pk)
 
-    context = {'lookups': arg, 'log_ids': log_ids}  # i.e {'conditions': 'var.value > 5 and ...', 'stuff': [22,24,56]}
-    template_text = "VarLog.objects.filter(Q(id__in={{ log_ids }}) & {{ lookups }})"
-
-    template = Template(template_text)
-    evaluated = eval(template.render(Context(context)))
-    return evaluated
\ No newline at end of file
+    lookups = parse_lookups(arg)  # i.e "Q(value__gte=5), Q(var__slug='food')"
+    return VarLog.objects.filter(Q(id__in=log_ids), *lookups.q_objects())
\ No newline at end of file
@@ -1,18 +1,55 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 from django.conf import settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
-from .models import Alarm, AlarmEvent, Subscription, Notification, Monitor
-from .serializers import AlarmSerializer, AlarmEventSerializer, SubscriptionSerializer, NotificationSerializer
+from .models import Alarm, AlarmEvent, Subscription, Notification, Monitor, OutboxEmail, DigestEntry, \
+    NotificationState, NotificationCounter
+from .serializers import AlarmSerializer, AlarmEventSerializer, SubscriptionSerializer, NotificationSerializer, \
+    GenericSerializer, content_serializers
 from .signals import *
+from .formulas import formula_cache, get_formula
+from .expressions import parse_formula, parse_lookups, FormulaError
+from .templatetags.alarms_template_filters import qs_filter
+from .routing import routing_index, AlarmRoutingIndex, formula_fields
+from . import evaluation
+from .queues import pending_evaluations, get_evaluation_queue, EvaluationTask, SyncQueue, LocalQueue, SQLiteQueue, \
+    VAR, DEVICE
+from .tracking import changed_fields
+from .ingest import ingest_values, resolve_vars
+from .vectorized import vectorize
+from .thresholds import formula_threshold, ThresholdSet
+from .states import event_states, EventState, EventStates, aggregate_states
+from .audience import subscriber_audience, AudienceCache, resolve_audience
+from .outbox import deliver_due, backoff, OUTBOX_MAX_ATTEMPTS
+from .email_templates import template_cache, CompiledTemplate
+from .digests import flush_digests, DIGEST_WINDOW
+from .pagination import MAX_PAGE_SIZE
+from .sync import delta
+from .hub import notification_hub, NotificationHub
+from django.template import Template
 from django.contrib.auth.models import User, Group
+from django.contrib.auth.management import create_permissions
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.test import Client, TestCase
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.apps import apps
 from guardian.shortcuts import assign_perm
 
 Device = apps.get_model(settings.DEVICE_MODEL)
 Var = apps.get_model(settings.VAR_MODEL)
+VarLog = apps.get_model(settings.VARLOG_MODEL)
 
 
 client = Client()
@@ -171,19 +208,19 @@ class EventsAPITest(APITestCase):
         ''' Test finished filter for AlarmEvent select True'''
         self.client.login(username='user', password='abcd')
         response = self.client.get('/api/alarms/events/?finished=3')
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_finished_filter_false(self):
         ''' Test finished filter for AlarmEvent select False '''
         self.client.login(username='user', password='abcd')
         response = self.client.get('/api/alarms/events/?finished=2')
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
     def test_finished_filter_bad_url(self):
         ''' Test finished filter for AlarmEvent select False '''
         self.client.login(username='user', password='abcd')
         response = self.client.get('/api/alarms/events/?finished=something')
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_create_event(self):
         ''' Create a new Event via POST method '''
@@ -220,14 +257,14 @@ class EventsAPITest(APITestCase):
         serializer = AlarmEventSerializer(events, many=True)
         self.client.login(username='user', password='abcd')
         response = self.client.get(url)
-        self.assertEqual(response.data, serializer.data)
+        self.assertEqual(response.data['results'], serializer.data)
 
     def test_get_events_without_user(self):
         ''' Get events if youre subscribed '''
         self.client.login(username='user_prueba', password='1234')
         url = reverse('events_list')
         response = self.client.get(url)
-        self.assertEqual(response.data, [])  # no user, no data
+        self.assertEqual(response.data['results'], [])  # no user, no data
 
     def test_failure_get_event(self):
         ''' Failure getting a not existing event '''
@@ -774,6 +811,8 @@ class SubscriptionTest(TestCase):
         self.assertNotEqual(Monitor.objects.all().count(), 3)
 
 
+# Evaluate in the save: on commit callbacks aren't run inside TestCase transaction
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
 class NotificationsTest(TestCase):
 
     def test_create_event_for_alarm_formula_by_device_update(self):
@@ -1337,6 +1376,8 @@ class NotificationsTest(TestCase):
 
 
 
+# Evaluate in the save: on commit callbacks aren't run inside TestCase transaction
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
 class AlarmsTest(TestCase):
 
     def setUp(self):
@@ -1819,3 +1860,1776 @@ class AlarmsTest(TestCase):
 
         self.assertNotEquals(n_event_after, n_event_before)
 
+
+
+class FormulaCacheTest(TestCase):
+
+    ''' Tests for compiled formulas cache '''
+
+    def setUp(self):
+        formula_cache.clear()
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+
+    def test_formula_is_compiled_once(self):
+        ''' The same compiled formula is used while the formula doesn't change '''
+        compiled = get_formula(self.alarm)
+
+        self.assertIs(get_formula(Alarm.objects.get(pk=self.alarm.pk)), compiled)
+        self.assertTrue(compiled.evaluate({'var': {'value': 2}}))
+        self.assertFalse(compiled.evaluate({'var': {'value': 7}}))
+
+    def test_formula_is_compiled_again_after_alarm_update(self):
+        ''' Saving an alarm discard its compiled formula '''
+        compiled = get_formula(self.alarm)
+        self.alarm.formula = '{{ var.value | bit:1 }}'
+        self.alarm.save()
+
+        self.assertNotIn(self.alarm.pk, formula_cache.formulas)
+        self.assertIsNot(get_formula(self.alarm), compiled)
+        self.assertEqual(get_formula(self.alarm).evaluate({'var': {'value': 2}}), 1)
+
+    def test_formula_is_discarded_after_alarm_delete(self):
+        ''' Deleting an alarm discard its compiled formula '''
+        pk = self.alarm.pk
+        get_formula(self.alarm)
+        self.alarm.delete()
+
+        self.assertNotIn(pk, formula_cache.formulas)
+
+    def test_bad_formula_raise_error_in_evaluation(self):
+        ''' A formula with syntax errors raise an exception in every evaluation '''
+        alarm = Alarm.objects.create(name='alarma2', formula='{{ var.value } < 5', duration=1)
+        compiled = get_formula(alarm)
+
+        self.assertRaises(Exception, compiled.evaluate, {'var': {'value': 2}})
+        self.assertRaises(Exception, compiled.evaluate, {'var': {'value': 7}})
+
+
+class ExpressionsTest(TestCase):
+
+    ''' Tests for formula and lookups expressions engine '''
+
+    def test_evaluate_comparison_formula(self):
+        ''' Evaluate a comparison with var values '''
+        expression = parse_formula('{{ var.value }} > 12')
+
+        self.assertTrue(expression.evaluate({'var': {'value': 15}}))
+        self.assertFalse(expression.evaluate({'var': {'value': 5}}))
+
+    def test_evaluate_formula_with_vars_and_bit_filter(self):
+        ''' Evaluate a formula with vars references, boolean operators and bit filter '''
+        expression = parse_formula('{{ vars.food.value }} < 5 and {{ var.value | bit:2 }}')
+
+        self.assertTrue(expression.evaluate({'vars': {'food': {'value': 0}}, 'var': {'value': 4}}))
+        self.assertFalse(expression.evaluate({'vars': {'food': {'value': 0}}, 'var': {'value': 2}}))
+        self.assertEqual(expression.paths, [('vars', 'food', 'value'), ('var', 'value')])
+
+    def test_evaluate_formula_with_model_instance(self):
+        ''' Placeholders are resolved with model instances attributes '''
+        device = Device.objects.create(serial='01', name='device', connected=False)
+
+        self.assertTrue(parse_formula('{{ var.connected }} == False').evaluate({'var': device}))
+
+    def test_not_allowed_formulas(self):
+        ''' Function calls, names and private attributes are not allowed '''
+        for formula in ("__import__('os')", '{{ var.value }} < len([1])', 'open', '{{ var.__class__ }}',
+                        '{{ var.value } < 5', '{{ var.value | unknown_filter }}'):
+            self.assertRaises(FormulaError, parse_formula, formula)
+
+    def test_evaluate_formula_with_template_filters(self):
+        ''' Built-in filters and method calls can be used as in templates '''
+        device = Device.objects.create(serial='0001', name='Airador1', connected=True)
+        var = Var.objects.create(var_type='food', name='food', value=0, device=device, slug='food')
+        VarLog.objects.create(var=var, value=1)
+        VarLog.objects.create(var=var, value=2)
+        formula = "{{ var.value }} < 5 and {{ var.varlog_set.all | dictsortreversed:'date' | slice:':2' " \
+                  "| qs_filter:'Q(value__lt=5)' | length_is:'2' }}"
+
+        self.assertTrue(parse_formula(formula).evaluate({'var': var}))
+
+    def test_evaluate_formula_with_missing_variable(self):
+        ''' A missing variable raise a formula error '''
+        expression = parse_formula('{{ vars.food.value }} < 5')
+
+        self.assertRaises(FormulaError, expression.evaluate, {'vars': {}})
+
+    def test_filter_with_lookups(self):
+        ''' Q objects lookups filter the queryset '''
+        device = Device.objects.create(serial='0001', name='Airador1', connected=True)
+        var = Var.objects.create(var_type='food', name='food', value=0, device=device, slug='food')
+        Var.objects.create(var_type='food', name='voltaje', value=0, device=device, slug='voltaje')
+        lookups = parse_lookups("Q(slug__startswith='food'), (Q(device__id__in=[1,3]) | ~Q(device__name='Airador1'))")
+
+        self.assertEqual(list(lookups.filter(Var.objects.all())), [var])
+        self.assertEqual(lookups.fields, ['slug__startswith', 'device__id__in', 'device__name'])
+
+    def test_not_allowed_lookups(self):
+        ''' Only Q objects with literal values are allowed in lookups '''
+        for lookups in ("Q(slug=open('file'))", "__import__('os')", "Q(slug='a'), slug='b'", "Q(slug='a'"):
+            self.assertRaises(FormulaError, parse_lookups, lookups)
+
+    def test_qs_filter_template_filter(self):
+        ''' qs_filter filter a queryset with lookups '''
+        device = Device.objects.create(serial='0001', name='Airador1', connected=True)
+        var = Var.objects.create(var_type='food', name='food', value=0, device=device, slug='food')
+        log = VarLog.objects.create(var=var, value=10)
+        VarLog.objects.create(var=var, value=1)
+
+        self.assertEqual(list(qs_filter(VarLog.objects.all(), 'Q(value__gte=5)')), [log])
+
+    def test_formulas_benchmark(self):
+        ''' The formulas benchmark compares the template path, parsed by evaluation or cached, with the expressions '''
+        out = io.StringIO()
+        call_command('alarms_benchmark', 'formulas', iterations=1, stdout=out)
+        self.assertIn('Template + eval (us) | Cached template + eval (us) | Expression (us)', out.getvalue())
+
+
+class MonitorLookupVarTest(TestCase):
+
+    ''' Tests for vars which satisfy the lookups of monitors '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='Airador1', connected=True)
+        self.monitor = Monitor.objects.create(lookups="Q(slug__startswith='food'), Q(device__name__startswith='Airador')",
+                                              duration=10, active=True)
+
+    def monitor_vars(self, monitor=None):
+        return list(Var.objects.filter(monitorlookupvar__monitor=monitor or self.monitor).order_by('pk'))
+
+    def test_new_var_satisfy_lookups(self):
+        ''' A created var is saved as member of monitors which lookups satisfy '''
+        var = Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+        Var.objects.create(var_type='voltaje', name='voltaje', value=0, device=self.device, slug='voltaje')
+
+        self.assertEqual(self.monitor_vars(), [var])
+
+    def test_updated_var_doesnt_satisfy_lookups(self):
+        ''' A var is removed from the monitor if after update it doesn't satisfy the lookups '''
+        var = Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+        var.slug = 'voltaje'
+        var.save()
+
+        self.assertEqual(self.monitor_vars(), [])
+
+    def test_monitor_lookups_update(self):
+        ''' Members are saved again when the lookups are changed '''
+        food = Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+        voltaje = Var.objects.create(var_type='voltaje', name='voltaje', value=0, device=self.device, slug='voltaje')
+        self.monitor.lookups = "Q(slug__startswith='voltaje')"
+        self.monitor.save()
+
+        self.assertEqual(self.monitor_vars(), [voltaje])
+        self.assertNotIn(food, self.monitor_vars())
+
+    def test_device_update_change_lookups_members(self):
+        ''' Vars of a device are updated when the lookups use device fields '''
+        var = Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+        self.device.name = 'Alimentador1'
+        self.device.save()
+
+        self.assertEqual(self.monitor_vars(), [])
+        self.device.name = 'Airador2'
+        self.device.save()
+        self.assertEqual(self.monitor_vars(), [var])
+
+    def test_bad_lookups_without_members(self):
+        ''' A monitor with lookups that can't be executed has no members '''
+        monitor = Monitor.objects.create(lookups="Q(slug_in=['food'])", duration=10, active=True)
+        Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+
+        self.assertEqual(self.monitor_vars(monitor), [])
+        self.assertEqual(len(self.monitor_vars()), 1)
+
+
+class AlarmRoutingIndexTest(TestCase):
+
+    ''' Tests for in process index of alarms by var, device and var type '''
+
+    def setUp(self):
+        Monitor.objects.all().delete()
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=0, device=self.device, slug='food')
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ vars.food.value }} < 5', duration=1)
+
+    def test_index_by_var_and_device(self):
+        ''' Alarms are indexed by selected vars and devices of active monitors '''
+        var_monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        var_monitor.variables.add(self.var)
+        device_monitor = Monitor.objects.create(duration=10, active=True)
+        device_monitor.devices.add(self.device)
+        self.alarm.monitor.add(var_monitor, device_monitor)
+
+        self.assertEqual(routing_index.alarms_for_var(self.var.pk), {self.alarm.pk})
+        self.assertEqual(routing_index.alarms_for_device(self.device.pk), {self.alarm.pk})
+        self.assertEqual(routing_index.alarms_for_var_type('food'), {self.alarm.pk})
+
+    def test_index_is_updated_on_monitor_changes(self):
+        ''' Deactivated monitors and removed relations are not indexed '''
+        monitor = Monitor.objects.create(duration=10, active=True)
+        monitor.devices.add(self.device)
+        self.alarm.monitor.add(monitor)
+        self.assertEqual(routing_index.alarms_for_device(self.device.pk), {self.alarm.pk})
+
+        monitor.active = False
+        monitor.save()
+        self.assertEqual(routing_index.alarms_for_device(self.device.pk), set())
+
+        monitor.active = True
+        monitor.save()
+        monitor.devices.remove(self.device)
+        self.assertEqual(routing_index.alarms_for_device(self.device.pk), set())
+
+    def test_formula_with_literal_placeholder(self):
+        ''' Literal placeholders like {{ 5 }} have no path, and don't break the index nor the saves '''
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(self.var)
+        alarm = Alarm.objects.create(name='literal', formula='{{ 5 }} > 3 and {{ var.value }} > 0', duration=1)
+        alarm.monitor.add(monitor)
+
+        self.var.value = 1
+        self.var.save()
+        self.assertEqual(routing_index.alarms_for_var(self.var.pk), {alarm.pk})
+        self.assertEqual(formula_fields(alarm)[0], {'value'})
+
+    def test_build_raced_by_invalidate(self):
+        ''' A build invalidated while it queries is discarded, and the next use builds the index again '''
+        index = AlarmRoutingIndex()
+        device_monitor = Monitor.objects.create(duration=10, active=True)
+        device_monitor.devices.add(self.device)
+        var_monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        self.alarm.monitor.add(device_monitor, var_monitor)
+
+        def change_monitors(alarm):  # other thread changes the monitors after the index read them
+            var_monitor.variables.add(self.var)
+            index.invalidate()
+            return []
+
+        with mock.patch('alarms.routing.formula_var_types', side_effect=change_monitors):
+            index.build()
+        self.assertIsNone(index.built)
+        self.assertEqual(index.alarms_for_var(self.var.pk), {self.alarm.pk})
+
+    def test_saves_without_alarms_skip_database(self):
+        ''' Saving vars or devices without alarms only execute the update query '''
+        routing_index.build()
+
+        with self.assertNumQueries(1):
+            self.var.save()
+        with self.assertNumQueries(1):
+            self.device.save()
+
+
+# Evaluate in the save: on commit callbacks aren't run inside TestCase transaction
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class EvaluationQueueTest(TestCase):
+
+    ''' Tests for evaluation queues '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(self.var)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(monitor)
+        self.path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+
+    def test_sync_queue_evaluate_in_save(self):
+        ''' With sync queue the event is created in the var save '''
+        self.var.value = 2
+        self.var.save()
+
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm, variables=self.var).count(), 1)
+
+    def test_sqlite_queue_evaluate_by_worker(self):
+        ''' Tasks in sqlite queue are evaluated by a worker with the enqueued value '''
+        queue = SQLiteQueue(self.path, workers=0)
+        queue.put(EvaluationTask(VAR, self.var.pk, 2, time.time()))
+        queue.put(EvaluationTask(VAR, self.var.pk, 30, time.time()))
+        self.assertEqual(queue.count(), 2)
+
+        queue.work(burst=True)
+        event = AlarmEvent.objects.get(alarm=self.alarm, variables=self.var)
+
+        self.assertEqual(queue.count(), 0)
+        self.assertIsNotNone(event.finished)
+
+    def test_sqlite_queue_lease(self):
+        ''' Claimed tasks are deleted only when they are done, and claimed again when their lease expires '''
+        queue = SQLiteQueue(self.path, workers=0, lease=60)
+        queue.put(EvaluationTask(VAR, self.var.pk, 2, time.time()))
+        self.assertEqual(len(queue.get(timeout=0)), 1)
+        self.assertEqual(queue.get(timeout=0), [])  # claimed
+        self.assertEqual(queue.count(), 1)
+        expired = SQLiteQueue(self.path, workers=0, lease=-1)
+        queue.connection.execute('UPDATE alarms_evaluation_task SET lease = 0')  # the worker crashed
+        tasks = expired.get(timeout=0)
+        self.assertEqual(len(tasks), 1)
+        expired.failed(None, tasks)
+        tasks = queue.get(timeout=0)
+        self.assertEqual(len(tasks), 1)
+        queue.done(None, tasks)
+        self.assertEqual(queue.count(), 0)
+
+    def test_sqlite_queue_failed_batch(self):
+        ''' The tasks of a batch which fails are kept in the queue and evaluated again '''
+        queue = SQLiteQueue(self.path, workers=0)
+        queue.put(EvaluationTask(VAR, self.var.pk, 2, time.time()))
+        with mock.patch('alarms.queues.run_tasks', side_effect=[Exception('database is gone'), None]) as run:
+            queue.work(burst=True)
+        self.assertEqual((run.call_count, queue.count()), (2, 0))
+
+    def test_sqlite_queue_order_by_object(self):
+        ''' The tasks of a var aren't taken while an older task of the var is claimed by other worker '''
+        var2 = Var.objects.create(var_type='food', name='food2', value=20, device=self.device, slug='food2')
+        queue = SQLiteQueue(self.path, workers=0)
+        queue.put(EvaluationTask(VAR, self.var.pk, 2, time.time()))
+        other = SQLiteQueue(self.path, workers=0)
+        first = other.get(batch_size=1, timeout=0)
+        queue.put(EvaluationTask(VAR, self.var.pk, 30, time.time()))
+        queue.put(EvaluationTask(VAR, var2.pk, 2, time.time()))
+        self.assertEqual([task.object_id for task in queue.get(timeout=0)], [var2.pk])
+        other.done(None, first)
+        self.assertEqual([task.value for task in queue.get(timeout=0)], [30])
+
+    def test_queue_from_settings(self):
+        ''' The configured queue is used '''
+        self.assertIsInstance(get_evaluation_queue(), SyncQueue)
+        with self.settings(ALARMS_EVALUATION_QUEUE='sqlite', ALARMS_EVALUATION_QUEUE_PATH=self.path):
+            self.assertIsInstance(get_evaluation_queue(), SQLiteQueue)
+        with self.settings(ALARMS_EVALUATION_QUEUE='local'):
+            self.assertIsInstance(get_evaluation_queue(), LocalQueue)
+
+
+class LocalEvaluationQueueTest(TransactionTestCase):
+
+    ''' Tests for evaluation in worker threads '''
+
+    def test_local_queue_evaluate_after_commit(self):
+        ''' Var updates are evaluated by worker threads after commit '''
+        device = Device.objects.create(serial='0001', name='device1', connected=True)
+        var = Var.objects.create(var_type='food', name='food', value=20, device=device, slug='food')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(var)
+        alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        alarm.monitor.add(monitor)
+
+        with self.settings(ALARMS_EVALUATION_QUEUE='local', ALARMS_EVALUATION_WORKERS=1):
+            queue = get_evaluation_queue()
+            var.value = 2
+            var.save()
+            queue.join()
+            queue.stop()
+
+        self.assertEqual(AlarmEvent.objects.filter(alarm=alarm, variables=var).count(), 1)
+
+
+class CoalescedEvaluationTest(TransactionTestCase):
+
+    ''' Tests for evaluation of the updates of a transaction on commit '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(self.var)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(monitor)
+
+    def test_evaluate_last_value_on_commit(self):
+        ''' Alarms are evaluated once after commit with the last value of the var '''
+        with transaction.atomic():
+            for value in (2, 3, 1):
+                self.var.value = value
+                self.var.save()
+            self.assertFalse(AlarmEvent.objects.exists())
+            self.assertEqual(len(pending_evaluations.tasks), 1)
+
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm, variables=self.var).count(), 1)
+
+    def test_evaluate_only_last_value_on_commit(self):
+        ''' Intermediate values of the transaction don't raise events '''
+        with transaction.atomic():
+            self.var.value = 2
+            self.var.save()
+            self.var.value = 30
+            self.var.save()
+
+        self.assertFalse(AlarmEvent.objects.exists())
+
+    def test_discard_on_rollback(self):
+        ''' Updates of rolled back transactions aren't evaluated '''
+        try:
+            with transaction.atomic():
+                self.var.value = 2
+                self.var.save()
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            self.var.value = 30
+            self.var.save()
+
+        self.assertFalse(AlarmEvent.objects.exists())
+        self.assertEqual(len(pending_evaluations.tasks), 0)
+
+    def test_discard_on_savepoint_rollback(self):
+        ''' Updates of rolled back savepoints aren't evaluated, the ones of the enclosing transaction are '''
+        other = Var.objects.create(var_type='food', name='other', value=20, device=self.device, slug='other')
+        self.alarm.monitor.get().variables.add(other)
+        with transaction.atomic():
+            other.value = 1
+            other.save()
+            try:
+                with transaction.atomic():
+                    self.var.value = 2
+                    self.var.save()
+                    other.value = 30
+                    other.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(list(pending_evaluations.tasks), [('var', other.pk)])
+
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm, variables=other).count(), 1)
+        self.assertFalse(AlarmEvent.objects.filter(variables=self.var).exists())
+
+    def test_released_savepoint(self):
+        ''' Updates of released savepoints are evaluated once with their last value '''
+        queue = get_evaluation_queue()
+        with mock.patch.object(queue, 'put_many', wraps=queue.put_many) as put_many:
+            with transaction.atomic():
+                self.var.value = 30
+                self.var.save()
+                with transaction.atomic():
+                    self.var.value = 2
+                    self.var.save()
+                with transaction.atomic():
+                    self.var.value = 1
+                    self.var.save()
+
+        self.assertEqual([task.value for task in put_many.call_args[0][0]], [1])
+        self.assertEqual(put_many.call_count, 1)
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm, variables=self.var).count(), 1)
+        self.assertEqual(len(pending_evaluations.tasks), 0)
+
+    def test_evaluate_lookups_once_by_var(self):
+        ''' Alarms of lookup monitors are evaluated once by var for all the vars of the transaction '''
+        monitor = Monitor.objects.create(duration=10, active=True, lookups="Q(var_type='food')")
+        alarm = Alarm.objects.create(name='lookups', formula='{{ var.value }} < 5', duration=1)
+        alarm.monitor.add(monitor)
+        other = Var.objects.create(var_type='food', name='food2', value=20, device=self.device, slug='food2')
+        with mock.patch.object(evaluation, 'get_formula', wraps=evaluation.get_formula) as get_formula:
+            with transaction.atomic():
+                for var in (self.var, other, self.var, other):
+                    var.value = 1
+                    var.save()
+
+        self.assertEqual([args[0] for args, kwargs in get_formula.call_args_list].count(alarm), 2)
+        self.assertEqual(AlarmEvent.objects.filter(alarm=alarm).count(), 2)
+
+
+class ChangedFieldsTest(TestCase):
+
+    ''' Tests for evaluation only when fields used by formulas change '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        self.monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        self.monitor.variables.add(self.var)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(self.monitor)
+
+    def test_changed_fields(self):
+        ''' Changed fields of a loaded var are tracked, value is changed by all the saves which write it,
+        new vars have unknown changes '''
+        var = Var.objects.get(pk=self.var.pk)
+        var.name = 'other'
+        var.save()
+        self.assertEqual(changed_fields(var), {'name', 'value'})
+        var.save()
+        self.assertEqual(changed_fields(var), {'value'})
+        var.save(update_fields=['name'])
+        self.assertEqual(changed_fields(var), set())
+        var.value = 3
+        var.save(update_fields=['name'])
+        self.assertEqual(changed_fields(var), set())
+        self.assertIsNone(changed_fields(Var.objects.create(var_type='food', name='food2', device=self.device)))
+
+    def test_skip_var_without_changes(self):
+        ''' Saving only fields not used by formulas doesn't evaluate alarms '''
+        var = Var.objects.get(pk=self.var.pk)
+        with mock.patch('alarms.signals.enqueue') as enqueue:
+            var.name = 'other'
+            var.save(update_fields=['name'])
+            self.assertFalse(enqueue.called)
+            var.value = 3
+            var.save(update_fields=['value'])
+            enqueue.assert_called_once_with(VAR, var, 3)
+
+    def test_value_changed_by_other_writer(self):
+        ''' A save of the value loaded before other writer changed it is evaluated '''
+        var = Var.objects.get(pk=self.var.pk)
+        Var.objects.filter(pk=var.pk).update(value=3)
+        with mock.patch('alarms.signals.enqueue') as enqueue:
+            var.save()
+            enqueue.assert_called_once_with(VAR, var, 20)
+
+    def test_evaluate_after_alarm_change(self):
+        ''' A var loaded before an alarm change is evaluated although it isn't changed '''
+        var = Var.objects.get(pk=self.var.pk)
+        self.alarm.save()
+        with mock.patch('alarms.signals.enqueue') as enqueue:
+            var.save()
+            self.assertTrue(enqueue.called)
+
+    def test_skip_device_without_changes(self):
+        ''' Device saves are evaluated if fields used by device formulas change '''
+        self.monitor.devices.add(self.device)
+        self.alarm.formula = '{{ vars.food.value }} < 5 and {{ device.connected }}'
+        self.alarm.save()
+        device = Device.objects.get(pk=self.device.pk)
+        with mock.patch('alarms.signals.enqueue') as enqueue:
+            device.name = 'other'
+            device.save()
+            self.assertFalse(enqueue.called)
+            device.connected = False
+            device.save()
+            enqueue.assert_called_once_with(DEVICE, device)
+
+    def test_evaluate_device_by_var_change(self):
+        ''' A change of a var used by device formulas evaluates the device '''
+        self.monitor.variables.clear()
+        self.monitor.devices.add(self.device)
+        self.alarm.formula = '{{ vars.food.value }} < 5'
+        self.alarm.save()
+        var = Var.objects.select_related('device').get(pk=self.var.pk)
+        with mock.patch('alarms.signals.enqueue') as enqueue:
+            var.device.save()
+            var.save(update_fields=['name'])
+            self.assertFalse(enqueue.called)
+            var.value = 3
+            var.save()
+            enqueue.assert_called_once_with(DEVICE, var.device)
+
+
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class IngestTest(APITestCase):
+
+    ''' Tests for bulk ingest of var values '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        self.other = Var.objects.create(var_type='voltaje', name='voltaje', value=20, device=self.device,
+                                        slug='voltaje')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(self.var, self.other)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(monitor)
+        User.objects.create_user(username='gateway', password='abcd')
+        self.client.login(username='gateway', password='abcd')
+
+    def test_ingest_values(self):
+        ''' Values are logged, vars get the last value and alarms are evaluated once by var '''
+        result = ingest_values([(self.var.pk, 3, 20.0), ('food', 30, 10.0), ('voltaje', 1, 10.0),
+                                {'var': 'unknown', 'value': 1}])
+
+        self.assertEqual(result, {'received': 4, 'logged': 3, 'updated': 2, 'evaluated': 2, 'unknown': ['unknown']})
+        self.assertEqual(VarLog.objects.filter(var=self.var).count(), 2)
+        self.assertEqual(Var.objects.get(pk=self.var.pk).value, 3)
+        self.assertEqual(Var.objects.get(pk=self.other.pk).value, 1)
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm).count(), 2)
+
+    def test_ingest_same_values(self):
+        ''' Values equal to the saved ones are logged and not evaluated '''
+        result = ingest_values([(self.var.pk, 20, None), (self.other.pk, 20, None)])
+
+        self.assertEqual((result['logged'], result['updated'], result['evaluated']), (2, 0, 0))
+        self.assertFalse(AlarmEvent.objects.exists())
+
+    def test_digit_slug(self):
+        ''' A reference is a slug before an id, so vars with digit-only slugs can be referenced '''
+        digits = Var.objects.create(var_type='food', name='digits', value=20, device=self.device,
+                                    slug=str(self.other.pk))
+        vars = resolve_vars([str(self.other.pk), self.var.pk])
+        self.assertEqual((vars[str(self.other.pk)], vars[str(self.var.pk)]), (digits, self.var))
+
+    def test_ingest_endpoint_anonymous(self):
+        ''' Anonymous users can't ingest values '''
+        self.client.logout()
+        response = self.client.post(reverse('values_ingest'), [{'var': self.var.pk, 'value': 2}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(VarLog.objects.exists())
+
+    def test_ingest_endpoint(self):
+        ''' Ingest values via POST method '''
+        url = reverse('values_ingest')
+        response = self.client.post(url, [{'var': self.var.pk, 'value': 2}, {'var': 'voltaje', 'value': 3}],
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm).count(), 2)
+
+    def test_ingest_endpoint_invalid(self):
+        ''' Invalid values are rejected '''
+        url = reverse('values_ingest')
+        response = self.client.post(url, [{'var': self.var.pk, 'value': 'high'}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(VarLog.objects.exists())
+
+    def test_ingest_command(self):
+        ''' Ingest NDJSON values from stdin '''
+        lines = '{"var": %d, "value": 2}\n\n{"var": "voltaje", "value": 30}\n' % self.var.pk
+        out = io.StringIO()
+        call_command('alarms_ingest', stdin=io.StringIO(lines), stdout=out, batch_size=1)
+
+        self.assertIn('2 values, 2 logs, 2 vars updated, 2 evaluations', out.getvalue())
+        self.assertEqual(AlarmEvent.objects.filter(alarm=self.alarm).count(), 1)
+
+
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class VectorizedTest(TestCase):
+
+    ''' Tests for evaluation of formulas over arrays of values '''
+
+    def test_same_result_than_expression(self):
+        ''' Vectorized formulas get the same conditions than evaluation var by var '''
+        formulas = ['{{ var.value }} > 12', '{{ var.value | bit:2 }}', '1 < {{ var.value }} <= 5',
+                    '{{ var.value }} < 5 and {{ var.value | bit:0 }}', 'not {{ var.value }} or {{ var.value }} > 30',
+                    '{{ var.value }} in (0, 4, 8)', '({{ var.value }} % 3 == 0) != ({{ var.value }} // 2 == 2)',
+                    '~{{ var.value }} & 2 == 2', '{{ var.value }} - 1', '-{{ var.value }} * 2 > -10']
+        values = [-3, -1, 0, 1, 2, 3, 4, 5, 8, 12, 13, 31, 40]
+        for formula in formulas:
+            expression = parse_formula(formula)
+            true_mask, false_mask = vectorize(expression).evaluate([{'value': value} for value in values])
+            for value, true, false in zip(values, true_mask, false_mask):
+                try:
+                    condition = expression.evaluate({'var': {'value': value}})
+                except FormulaError:
+                    condition = None
+                self.assertEqual((condition == True, condition == False), (true, false), (formula, value))
+
+    def test_not_vectorized(self):
+        ''' Formulas with other vars, filters or not constant divisors are evaluated var by var '''
+        for formula in ('{{ vars.food.value }} < 5', '{{ var.value }} is None', '{{ var.value | add:2 }} > 4',
+                        '10 / {{ var.value }} > 1', '{{ var.value }} in {{ var.value }}'):
+            self.assertIsNone(vectorize(parse_formula(formula)), formula)
+
+    def test_lookups_monitor_vectorized(self):
+        ''' Events of the vars of a lookup monitor are opened and finished with the vectorized formula '''
+        device = Device.objects.create(serial='0001', name='device1', connected=True)
+        vars = [Var.objects.create(var_type='food', name='food', value=value, device=device, slug='food%d' % value)
+                for value in range(20)]
+        monitor = Monitor.objects.create(duration=10, active=True, lookups="Q(var_type='food')")
+        alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        alarm.monitor.add(monitor)
+
+        evaluation.create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(vars[0])
+        evaluation.create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(vars[0])
+        self.assertEqual(sorted(AlarmEvent.objects.values_list('variables__value', flat=True)), [0, 1, 2, 3, 4])
+
+        Var.objects.filter(pk=vars[2].pk).update(value=10)
+        evaluation.create_event_for_alarm_formula_looking_vars_for_monitor_lookups_field(vars[0])
+        self.assertIsNotNone(AlarmEvent.objects.get(variables=vars[2]).finished)
+        self.assertEqual(AlarmEvent.objects.filter(finished=None).count(), 4)
+
+
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class ThresholdIndexTest(TestCase):
+
+    ''' Tests for alarms triggered by bisection of thresholds '''
+
+    def test_formula_threshold(self):
+        ''' Formulas which compare the var value with a number are indexed '''
+        self.assertEqual(formula_threshold('{{ var.value }} > 12'), ('>', 12))
+        self.assertEqual(formula_threshold('5 >= {{ var.value }}'), ('<=', 5))
+        self.assertEqual(formula_threshold('{{ var.value }} != -2.5'), ('!=', -2.5))
+        for formula in ('{{ var.value | bit:1 }}', '{{ var.value }} > 1 and {{ var.value }} < 5',
+                        '{{ vars.food.value }} < 5', '{{ var.value }} > True', '1 < {{ var.value }} < 5',
+                        '{{ var.value }} + 1 > 5', 'incorrect formula'):
+            self.assertIsNone(formula_threshold(formula), formula)
+
+    def test_triggered_same_than_formulas(self):
+        ''' Alarms triggered by bisection are the alarms which formula is True '''
+        formulas = ['{{ var.value }} > 12', '{{ var.value }} >= 12', '{{ var.value }} < 5', '{{ var.value }} <= 5',
+                    '{{ var.value }} == 7', '{{ var.value }} != 7', '3 < {{ var.value }}', '{{ var.value }} > 5',
+                    '{{ var.value }} < 2.5', '{{ var.value | bit:1 }}']
+        thresholds = ThresholdSet(list(enumerate(formulas)))
+        self.assertEqual(len(thresholds), 9)
+        for value in (-1, 0, 2, 2.5, 3, 4, 5, 6, 7, 11.5, 12, 13, 100):
+            expected = set(pk for pk, formula in enumerate(formulas[:9])
+                           if parse_formula(formula).evaluate({'var': {'value': value}}))
+            self.assertEqual(thresholds.triggered(value), expected, value)
+
+    def test_selected_var_thresholds(self):
+        ''' Events of threshold alarms are created and finished without evaluating their formulas '''
+        device = Device.objects.create(serial='0001', name='device1', connected=True)
+        var = Var.objects.create(var_type='food', name='food', value=20, device=device, slug='food')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(var)
+        low = Alarm.objects.create(name='low', formula='{{ var.value }} < 5', duration=1)
+        high = Alarm.objects.create(name='high', formula='{{ var.value }} > 50', duration=1)
+        bit = Alarm.objects.create(name='bit', formula='{{ var.value | bit:1 }}', duration=1)
+        for alarm in (low, high, bit):
+            alarm.monitor.add(monitor)
+
+        with mock.patch.object(evaluation, 'get_formula', wraps=evaluation.get_formula) as get_formula:
+            var.value = 2
+            var.save()
+            self.assertEqual([args[0] for args, kwargs in get_formula.call_args_list], [bit])
+        self.assertEqual(set(AlarmEvent.objects.filter(finished=None).values_list('alarm', flat=True)),
+                         {low.pk, bit.pk})
+
+        var.value = 60
+        var.save()
+        self.assertEqual(set(AlarmEvent.objects.filter(finished=None).values_list('alarm', flat=True)), {high.pk})
+
+
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class EventStatesTest(TestCase):
+
+    ''' Tests for the open events state of the evaluation '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        monitor.variables.add(self.var)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(monitor)
+
+    def save_value(self, value):
+        self.var.value = value
+        with CaptureQueriesContext(connection) as queries:
+            self.var.save()
+        return [query['sql'] for query in queries.captured_queries if 'alarms_alarmevent' in query['sql']]
+
+    def build_meanwhile(self, table, change):
+
+        """
+        Build the table while other thread changes it after the events were read
+        """
+        def aggregate(*args):
+            rows = aggregate_states(*args)
+            change()
+            return rows
+
+        with mock.patch('alarms.states.aggregate_states', side_effect=aggregate):
+            return table.build()
+
+    def test_build_raced_by_invalidate(self):
+        ''' A build invalidated while it queries isn't stored, the table stays unbuilt '''
+        table = EventStates()
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device, variables=self.var)
+        states = self.build_meanwhile(table, table.invalidate)
+        self.assertEqual(list(states), [(self.device.pk, self.var.pk)])
+        self.assertEqual((table.built, table.states), (None, {}))
+
+    def test_build_keeps_newer_states(self):
+        ''' States written while the table is built are kept instead of the states read before '''
+        table = EventStates()
+        created = AlarmEvent.objects.create(alarm=self.alarm, device=self.device, variables=self.var).created
+        key = (self.device.pk, self.var.pk)
+        finished = {key: {self.alarm.pk: EventState(False, created)}}
+        self.build_meanwhile(table, lambda: table.apply(finished))
+        self.assertIsNotNone(table.built)
+        self.assertEqual(table.states, finished)
+
+    def test_no_update_without_open_events(self):
+        ''' Cleared alarms without open events don't update events '''
+        self.save_value(30)
+        for value in (25, 26, 27):
+            self.assertEqual(self.save_value(value), [])
+
+    def test_rearm_window_without_queries(self):
+        ''' The last event creation date is kept, so triggered alarms in the re-arm window don't query events '''
+        self.save_value(2)
+        self.assertEqual(AlarmEvent.objects.count(), 1)
+        self.assertEqual(self.save_value(1), [])
+        self.assertEqual(AlarmEvent.objects.count(), 1)
+        self.assertEqual(event_states.state(self.alarm.pk, self.device.pk, self.var.pk),
+                         EventState(True, AlarmEvent.objects.get().created))
+
+    def test_finish_and_rearm(self):
+        ''' Events are finished once, and created again after the alarm duration '''
+        self.save_value(2)
+        self.assertEqual(len([sql for sql in self.save_value(30) if sql.startswith('UPDATE')]), 1)
+        self.assertEqual(self.save_value(31), [])
+        self.assertFalse(AlarmEvent.objects.filter(finished=None).exists())
+        AlarmEvent.objects.update(created=timezone.now() - timezone.timedelta(hours=2))
+        event_states.reload(self.device.pk, self.var.pk)
+        self.save_value(2)
+        self.assertEqual(AlarmEvent.objects.filter(finished=None).count(), 1)
+
+    def test_events_changed_outside_evaluation(self):
+        ''' Events saved or deleted by other code reload the states '''
+        self.save_value(2)
+        event = AlarmEvent.objects.get()
+        event.finished = timezone.now()
+        event.save()
+        self.assertFalse(event_states.state(self.alarm.pk, self.device.pk, self.var.pk).open)
+        event.delete()
+        self.assertEqual(event_states.state(self.alarm.pk, self.device.pk, self.var.pk), EventState(False, None))
+
+    def test_discard_rolled_back_savepoint(self):
+        ''' States changed in a rolled back savepoint are discarded '''
+        try:
+            with transaction.atomic():
+                self.save_value(2)
+                self.assertTrue(event_states.state(self.alarm.pk, self.device.pk, self.var.pk).open)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(AlarmEvent.objects.exists())
+        self.assertFalse(event_states.state(self.alarm.pk, self.device.pk, self.var.pk).open)
+        self.save_value(1)
+        self.assertEqual(AlarmEvent.objects.filter(finished=None).count(), 1)
+
+
+@override_settings(ALARMS_EVALUATION_COALESCE=False)
+class QueryBudgetTest(APITestCase):
+
+    ''' Upper bounds of queries of the hot paths, to catch N+1 regressions '''
+
+    VAR_SAVE_QUERIES = 23
+    DEVICE_SAVE_QUERIES = 4
+    EVENTS_LIST_QUERIES = 4
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        by_var = Monitor.objects.create(duration=10, active=True, lookups='')
+        by_var.variables.add(self.var)
+        by_device = Monitor.objects.create(duration=10, active=True, lookups='')
+        by_device.devices.add(self.device)
+        by_lookups = Monitor.objects.create(duration=10, active=True, lookups="Q(var_type='food')")
+        self.alarm = Alarm.objects.create(name='var', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(by_var)
+        Alarm.objects.create(name='device', formula='{{ vars.food.value }} < 5', duration=1).monitor.add(by_device)
+        Alarm.objects.create(name='lookups', formula='{{ var.value }} < 5', duration=1).monitor.add(by_lookups)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        # old events of the var
+        AlarmEvent.objects.bulk_create([AlarmEvent(alarm=self.alarm, device=self.device, variables=self.var,
+                                                   finished=timezone.now()) for i in range(50)])
+
+    def count_queries(self, function):
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        return len(queries)
+
+    def test_indexes(self):
+        ''' AlarmEvent has the indexes of the evaluation and the events list '''
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, AlarmEvent._meta.db_table)
+        for name in ('alarms_event_dev_var_idx', 'alarms_event_finished_idx', 'alarms_event_created_idx',
+                     'alarms_event_open_idx'):
+            self.assertIn(name, indexes)
+
+    def test_var_save(self):
+        ''' Var saves which create, keep or finish events '''
+        self.var.value = 10
+        self.var.save()  # build the routing index and the event states
+        for value in (2, 1, 30, 31):
+            self.var.value = value
+            self.assertLessEqual(self.count_queries(self.var.save), self.VAR_SAVE_QUERIES, value)
+        self.assertEqual(AlarmEvent.objects.filter(finished=None).count(), 0)
+
+    def test_device_save(self):
+        ''' Device saves which don't change fields of the formulas '''
+        self.device.save()
+        self.device.name = 'device2'
+        self.assertLessEqual(self.count_queries(self.device.save), self.DEVICE_SAVE_QUERIES)
+
+    def test_events_list(self):
+        ''' The events list queries don't depend on the number of events '''
+        self.client.login(username='user', password='abcd')
+        url = reverse('events_list')
+        queries = self.count_queries(lambda: self.client.get(url))
+        self.assertLessEqual(queries, self.EVENTS_LIST_QUERIES)
+        AlarmEvent.objects.bulk_create([AlarmEvent(alarm=self.alarm, device=self.device, variables=self.var)
+                                        for i in range(20)])
+        self.assertEqual(self.count_queries(lambda: self.client.get(url)), queries)
+
+
+class AudienceTest(TestCase):
+
+    ''' Tests for the cached audience of the alarms notifications '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd', email='user@localhost.com')
+        self.member = User.objects.create_user(username='member', password='abcd', email='member@localhost.com')
+        self.group = Group.objects.create(name='staff')
+        self.member.groups.add(self.group)
+        assign_perm('can_subscribe', self.user, self.alarm)
+        assign_perm('can_subscribe', self.group, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        Subscription.objects.create(active=True, group=self.group, alarm=self.alarm, email=False)
+
+    def notified(self):
+        event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        return sorted(Notification.objects.filter(event=event).values_list('user__username', flat=True))
+
+    def test_fan_out_from_cache(self):
+        ''' After the first event, subscriptions, groups and users aren't queried '''
+        self.assertEqual(self.notified(), ['member', 'user'])
+        with CaptureQueriesContext(connection) as queries:
+            event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(Notification.objects.filter(event=event).count(), 2)
+        tables = ('alarms_subscription', 'auth_user', 'auth_group')
+        self.assertEqual([query['sql'] for query in queries.captured_queries
+                          if any(table in query['sql'] for table in tables)
+                          and not query['sql'].startswith('INSERT')], [])
+
+    def test_group_members_changed(self):
+        ''' Users added to or removed from a subscribed group change the audience '''
+        self.notified()
+        other = User.objects.create_user(username='other', password='abcd')
+        self.group.user_set.add(other)
+        self.assertEqual(self.notified(), ['member', 'other', 'user'])
+        self.member.groups.clear()
+        self.assertEqual(self.notified(), ['other', 'user'])
+        self.user.groups.add(self.group)  # notified once
+        self.assertEqual(self.notified(), ['other', 'user'])
+
+    def test_resolve_raced_by_invalidate(self):
+        ''' An audience invalidated while it's resolved isn't cached, the next event resolves it again '''
+        cache = AudienceCache()
+
+        def unsubscribe_meanwhile(alarm_id):  # other thread unsubscribes after the audience was read
+            audience = resolve_audience(alarm_id)
+            Subscription.objects.filter(user=self.user).delete()
+            cache.invalidate([alarm_id])
+            return audience
+
+        with mock.patch('alarms.audience.resolve_audience', side_effect=unsubscribe_meanwhile):
+            self.assertEqual(len(cache.get(self.alarm.pk).subscriptions), 2)
+        self.assertNotIn(self.alarm.pk, cache.audiences)
+        self.assertEqual([item.group_id for item in cache.get(self.alarm.pk).subscriptions], [self.group.pk])
+
+    def test_subscription_changed(self):
+        ''' Deactivated subscriptions aren't notified '''
+        self.notified()
+        subscription = Subscription.objects.get(user=self.user)
+        subscription.active = False
+        subscription.save()
+        self.assertEqual(self.notified(), ['member'])
+        Subscription.objects.filter(group=self.group).delete()
+        self.assertEqual(self.notified(), [])
+
+    def test_email_changed(self):
+        ''' Emails are sent to the current email of the users '''
+        Subscription.objects.filter(group=self.group).update(email=True)
+        subscriber_audience.clear()
+        self.notified()
+        self.member.email = 'new@localhost.com'
+        self.member.save()
+        self.notified()
+        self.assertEqual(OutboxEmail.objects.last().recipient_list(), ['new@localhost.com'])
+
+    def test_bulk_notifications(self):
+        ''' Notifications of a large group are created with bulk inserts and one notifications_created signal '''
+        User.objects.bulk_create([User(username='member%d' % number) for number in range(300)])
+        self.group.user_set.add(*User.objects.filter(username__startswith='member'))
+        received = []
+
+        def notifications_receiver(sender, event, user_ids, **kwargs):
+            received.append((event, user_ids))
+        notifications_created.connect(notifications_receiver)
+        self.addCleanup(notifications_created.disconnect, notifications_receiver)
+        with CaptureQueriesContext(connection) as queries:
+            event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT INTO "alarms_notification"')]
+        self.assertLessEqual(len(inserts), 2)
+        self.assertEqual(Notification.objects.filter(event=event).count(), 302)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][0], event)
+        self.assertEqual(received[0][1][0], self.user.pk)
+        self.assertEqual(len(set(received[0][1])), 302)
+
+    def test_fan_out_benchmark(self):
+        ''' The fan-out benchmark rolls back its data '''
+        out = io.StringIO()
+        with mock.patch('alarms.benchmarks.FAN_OUT_SIZES', (10, )):
+            call_command('alarms_benchmark', 'fan_out', iterations=1, stdout=out)
+        self.assertIn('Group users', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='benchmark-').exists())
+
+
+class OutboxTest(TestCase):
+
+    ''' Tests for the email outbox of the events '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd', email='user@localhost.com')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        self.subscription = Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=True,
+                                                        user_template_text='<p>{{ alarm.name }}</p>')
+
+    def test_event_puts_email(self):
+        ''' Events put their emails in the outbox, they aren't sent in the event creation '''
+        event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.event, email.status, email.recipient_list()),
+                         (event, OutboxEmail.PENDING, ['user@localhost.com']))
+        self.assertEqual(email.html, '<p>alarma</p>')
+
+    def test_deliver_with_one_connection(self):
+        ''' A batch of emails is sent over one connection '''
+        for n in range(3):
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        with mock.patch('alarms.outbox.get_connection', wraps=mail.get_connection) as get_connection:
+            self.assertEqual(deliver_due(), (3, 0))
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>alarma</p>', 'text/html')])
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.SENT).count(), 3)
+        self.assertEqual(deliver_due(), (0, 0))
+
+    def test_retry_with_backoff(self):
+        ''' Failed deliveries are retried later, until the maximum of attempts '''
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=OSError('Connection refused')):
+            self.assertEqual(deliver_due(), (0, 1))
+            email = OutboxEmail.objects.get()
+            self.assertEqual((email.status, email.attempts, email.error), (OutboxEmail.PENDING, 1, 'Connection refused'))
+            self.assertGreater(email.next_attempt, timezone.now() + timezone.timedelta(seconds=backoff(1) - 5))
+            self.assertEqual(deliver_due(), (0, 0))  # not due yet
+            for attempt in range(OUTBOX_MAX_ATTEMPTS - 1):
+                OutboxEmail.objects.update(next_attempt=timezone.now())
+                deliver_due()
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, OUTBOX_MAX_ATTEMPTS))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_template_error_sends_plain_text(self):
+        ''' A subscription template which can't be rendered sends only the plain text, once '''
+        Subscription.objects.filter(pk=self.subscription.pk).update(user_template_text='{% if %}')
+        subscriber_audience.clear()
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(deliver_due(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].alternatives, [])
+
+    def test_outbox_command(self):
+        ''' alarms_outbox --burst delivers the due emails and exits '''
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        out = io.StringIO()
+        call_command('alarms_outbox', burst=True, stdout=out)
+        self.assertIn('1 emails sent, 0 failed', out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+
+class EmailTemplatesTest(TestCase):
+
+    ''' Tests for the compiled templates of the event emails '''
+
+    def setUp(self):
+        template_cache.clear()
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.users = []
+        for n in range(2):
+            user = User.objects.create_user(username='user%d' % n, password='abcd', email='user%d@localhost.com' % n)
+            assign_perm('can_subscribe', user, self.alarm)
+            self.users.append(user)
+        self.subscription = Subscription.objects.create(active=True, user=self.users[0], alarm=self.alarm, email=True,
+                                                        user_template_text='<p>{{ alarm.name }}</p>')
+
+    def test_text_compiled_once(self):
+        ''' A template text is compiled once for all the events, and again when the subscription changes '''
+        with mock.patch('alarms.email_templates.Template', wraps=Template) as compile_template:
+            for n in range(3):
+                AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+            self.assertEqual(compile_template.call_count, 1)
+            self.subscription.user_template_text = '<b>{{ alarm.name }}</b>'
+            self.subscription.save()
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+            self.assertEqual(compile_template.call_count, 2)
+        self.assertEqual(list(OutboxEmail.objects.order_by('pk').values_list('html', flat=True)),
+                         ['<p>alarma</p>'] * 3 + ['<b>alarma</b>'])
+
+    def test_rendered_once_by_event(self):
+        ''' A template which doesn't mention the user is rendered once by event, not by recipient '''
+        Subscription.objects.create(active=True, user=self.users[1], alarm=self.alarm, email=True,
+                                    user_template_text='<p>{{ alarm.name }}</p>')
+        with mock.patch.object(CompiledTemplate, 'render', autospec=True,
+                               side_effect=CompiledTemplate.render) as render:
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(render.call_count, 3)  # the plain text (mail.txt) mentions the user, by user
+        emails = OutboxEmail.objects.order_by('pk')
+        self.assertEqual([email.html for email in emails], ['<p>alarma</p>'] * 2)
+        self.assertNotEqual(emails[0].body, emails[1].body)
+
+
+class DigestTest(TestCase):
+
+    ''' Tests for the digest delivery of the event emails '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd', email='user@localhost.com')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        self.subscription = Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=True,
+                                                        delivery=Subscription.DIGEST,
+                                                        user_template_text='<p>{{ alarm.name }}</p>')
+
+    def test_events_wait_for_digest(self):
+        ''' Digest subscriptions create the notifications at once, and save the events for the digest '''
+        for n in range(3):
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(OutboxEmail.objects.count(), 0)
+        self.assertEqual(DigestEntry.objects.filter(user=self.user, email='user@localhost.com').count(), 3)
+        self.assertEqual(flush_digests(), 0)  # the window isn't over
+        self.assertEqual(DigestEntry.objects.count(), 3)
+
+    def test_flush_digest(self):
+        ''' The events of a window are sent in one email by user '''
+        for n in range(3):
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        now = timezone.now() + timezone.timedelta(seconds=DIGEST_WINDOW)
+        self.assertEqual(flush_digests(now=now), 1)
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.subject, email.recipient_list()), ('Event Digest: 3 events', ['user@localhost.com']))
+        self.assertEqual(email.body.count('Alarm: alarma'), 3)
+        self.assertEqual(DigestEntry.objects.count(), 0)
+        self.assertEqual(deliver_due(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_group_digest(self):
+        ''' Each user of a group subscription receives its own digest '''
+        self.subscription.delete()
+        group = Group.objects.create(name='operators')
+        assign_perm('can_subscribe', group, self.alarm)
+        other = User.objects.create_user(username='other', password='abcd', email='other@localhost.com')
+        for user in (self.user, other):
+            user.groups.add(group)
+        Subscription.objects.create(active=True, group=group, alarm=self.alarm, email=True,
+                                    delivery=Subscription.DIGEST, staff_template='email_template_staff.html')
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(OutboxEmail.objects.count(), 0)
+        now = timezone.now() + timezone.timedelta(seconds=DIGEST_WINDOW)
+        self.assertEqual(flush_digests(now=now), 2)
+        self.assertEqual(sorted(OutboxEmail.objects.values_list('recipients', flat=True)),
+                         ['other@localhost.com', 'user@localhost.com'])
+
+
+class FanOutOnReadTest(APITestCase):
+
+    ''' Tests for the notifications of large groups computed on read '''
+
+    def setUp(self):
+        patcher = mock.patch('alarms.notifications.FAN_OUT_ON_READ_MIN_GROUP', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.group = Group.objects.create(name='operators')
+        assign_perm('can_subscribe', self.group, self.alarm)
+        self.users = [User.objects.create_user(username='user%d' % n, password='abcd') for n in range(3)]
+        self.group.user_set.add(*self.users)
+        Subscription.objects.create(active=True, group=self.group, alarm=self.alarm, email=False,
+                                    staff_template='email_template_staff.html')
+        self.event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.notification = Notification.objects.get()
+        self.client.login(username='user0', password='abcd')
+
+    def statuses(self, username):
+        self.client.login(username=username, password='abcd')
+        response = self.client.get(reverse('notifications_list'))
+        return [(item['id'], item['status']) for item in response.data['results']]
+
+    def test_one_notification_by_group(self):
+        ''' A large group is notified with one notification, listed by each of its users '''
+        self.assertEqual((self.notification.group, self.notification.user), (self.group, None))
+        for user in self.users:
+            self.assertEqual(self.statuses(user.username), [(self.notification.pk, Notification.UNCHECKED)])
+        outsider = User.objects.create_user(username='outsider', password='abcd')
+        self.assertEqual(self.statuses(outsider.username), [])
+        response = self.client.get('/api/alarms/notifications/%d/' % self.notification.pk)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_status_by_user(self):
+        ''' The status of a group notification is saved only for the user who changes it '''
+        url = '/api/alarms/notifications/%d/' % self.notification.pk
+        response = self.client.put(url, {'status': Notification.CHECKED})
+        self.assertEqual((response.status_code, response.data['status']), (status.HTTP_200_OK, Notification.CHECKED))
+        self.assertEqual(self.client.get(url).data['status'], Notification.CHECKED)
+        self.assertEqual(self.statuses('user1'), [(self.notification.pk, Notification.UNCHECKED)])
+        response = self.client.get(reverse('notifications_list'), {'status': Notification.UNCHECKED})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(NotificationState.objects.count(), 1)
+        self.assertEqual(Notification.objects.get().status, Notification.UNCHECKED)
+
+    def test_delete_hides_for_user(self):
+        ''' Deleting a group notification hides it only for the user '''
+        response = self.client.delete('/api/alarms/notifications/%d/' % self.notification.pk)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.statuses('user0'), [])
+        self.assertEqual(self.statuses('user1'), [(self.notification.pk, Notification.UNCHECKED)])
+
+    def test_listed_once_by_event(self):
+        ''' An event is listed once, even if the user was notified by two ways '''
+        other = Group.objects.create(name='supervisors')
+        other.user_set.add(*self.users)
+        Notification.objects.create(group=other, event=self.event)
+        Notification.objects.create(user=self.users[1], event=self.event)
+        self.assertEqual(self.statuses('user0'), [(self.notification.pk, Notification.UNCHECKED)])
+        self.assertEqual(len(self.statuses('user1')), 1)
+
+    def test_fan_out_on_read_benchmark(self):
+        ''' The fan-out on read benchmark rolls back its data '''
+        out = io.StringIO()
+        with mock.patch('alarms.benchmarks.FAN_OUT_SIZES', (10, )), \
+                mock.patch('alarms.benchmarks.FAN_OUT_ON_READ_EVENTS', 2):
+            call_command('alarms_benchmark', 'fan_out_on_read', iterations=1, stdout=out)
+        self.assertIn('10 | 20 |', out.getvalue())
+        self.assertFalse(Group.objects.filter(name__startswith='benchmark-').exists())
+
+
+class NotificationCounterTest(APITestCase):
+
+    ''' Tests for the unchecked notification counters '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False,
+                                    staff_template='email_template_staff.html')
+        self.client.login(username='user', password='abcd')
+        self.url = reverse('notifications_count')
+
+    def counter(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['unchecked'], response.data['latest']
+
+    def test_count_without_notifications_table(self):
+        ''' The counter is counted once, then kept by the event fan-out without reading notifications '''
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(self.counter(), (1, Notification.objects.get().pk))
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        with CaptureQueriesContext(connection) as queries:
+            unchecked, latest = self.counter()
+        self.assertEqual((unchecked, latest), (2, Notification.objects.latest('pk').pk))
+        self.assertFalse([query for query in queries.captured_queries if 'alarms_notification"' in query['sql']])
+
+    def test_status_change(self):
+        ''' Checking a notification updates the counter '''
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertEqual(self.counter()[0], 2)
+        notification = Notification.objects.earliest('pk')
+        self.client.put('/api/alarms/notifications/%d/' % notification.pk, {'status': Notification.CHECKED})
+        self.assertEqual(self.counter()[0], 1)
+        self.client.delete('/api/alarms/notifications/%d/' % Notification.objects.latest('pk').pk)
+        self.assertEqual(self.counter(), (0, notification.pk))
+
+    def test_anonymous(self):
+        ''' Anonymous users have no counter '''
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(NotificationCounter.objects.exists())
+
+    def test_group_notifications(self):
+        ''' Group notifications computed on read are counted for each user of the group '''
+        group = Group.objects.create(name='operators')
+        assign_perm('can_subscribe', group, self.alarm)
+        other = User.objects.create_user(username='other', password='abcd')
+        group.user_set.add(other)
+        Subscription.objects.create(active=True, group=group, alarm=self.alarm, email=False,
+                                    staff_template='email_template_staff.html')
+        self.client.login(username='other', password='abcd')
+        self.assertEqual(self.counter(), (0, None))
+        with mock.patch('alarms.notifications.FAN_OUT_ON_READ_MIN_GROUP', 1):
+            AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        notification = Notification.objects.get(group=group)
+        self.assertEqual(NotificationCounter.objects.get(user=other).unchecked, 1)
+        self.assertEqual(self.counter(), (1, notification.pk))
+        self.client.put('/api/alarms/notifications/%d/' % notification.pk, {'status': Notification.CHECKED})
+        self.assertEqual(self.counter(), (0, notification.pk))
+        group.user_set.remove(other)
+        self.assertEqual(self.counter(), (0, None))
+
+
+class NotificationStatusTest(APITestCase):
+
+    ''' Tests for the bulk status endpoint of the notifications '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarms = [Alarm.objects.create(name='alarma%d' % n, formula='{{ var.value }} < 5', duration=1)
+                       for n in range(2)]
+        self.user = User.objects.create_user(username='user', password='abcd')
+        self.other = User.objects.create_user(username='other', password='abcd')
+        for alarm in self.alarms:
+            for event in range(3):
+                event = AlarmEvent.objects.create(alarm=alarm, device=self.device)
+                Notification.objects.create(user=self.user, event=event)
+                Notification.objects.create(user=self.other, event=event)
+        self.client.login(username='user', password='abcd')
+        self.url = reverse('notifications_status')
+
+    def test_mark_all_checked(self):
+        ''' All the notifications of the user are checked with one update, and its counter is kept '''
+        self.assertEqual(self.client.get(reverse('notifications_count')).data['unchecked'], 6)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(self.url, {'status': Notification.CHECKED}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['changed'], response.data['unchecked']), (6, 0))
+        updates = [query for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE "alarms_notification"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Notification.objects.filter(user=self.user, status=Notification.CHECKED).count(), 6)
+        self.assertEqual(Notification.objects.filter(user=self.other, status=Notification.CHECKED).count(), 0)
+        self.assertEqual(self.client.get(reverse('notifications_count')).data['unchecked'], 0)
+
+    def test_anonymous(self):
+        ''' Anonymous users can't change notifications '''
+        self.client.logout()
+        response = self.client.put(self.url, {'status': Notification.CHECKED}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Notification.objects.filter(status=Notification.CHECKED).exists())
+
+    def test_by_ids_and_filters(self):
+        ''' Notifications are selected by ids or by the filters of the list, only the ones of the user '''
+        others = list(Notification.objects.filter(user=self.other).values_list('pk', flat=True))
+        own = list(Notification.objects.filter(user=self.user).order_by('pk').values_list('pk', flat=True))
+        response = self.client.put(self.url, {'status': Notification.CHECKED, 'ids': own[:2] + others},
+                                   format='json')
+        self.assertEqual((response.data['changed'], response.data['unchecked']), (2, 4))
+        response = self.client.put('%s?event__alarm=%d' % (self.url, self.alarms[1].pk),
+                                   {'status': Notification.CHECKED}, format='json')
+        self.assertEqual((response.data['changed'], response.data['unchecked']), (3, 1))
+        self.assertEqual(Notification.objects.filter(user=self.other, status=Notification.CHECKED).count(), 0)
+
+    def test_group_notifications(self):
+        ''' Group notifications are changed only for the user '''
+        group = Group.objects.create(name='operators')
+        group.user_set.add(self.user, self.other)
+        event = AlarmEvent.objects.create(alarm=self.alarms[0], device=self.device)
+        notification = Notification.objects.create(group=group, event=event)
+        NotificationState.objects.create(notification=notification, user=self.other, status=Notification.CHECKED)
+        response = self.client.put(self.url, {'status': Notification.CHECKED}, format='json')
+        self.assertEqual(response.data['unchecked'], 0)
+        self.assertEqual(NotificationState.objects.get(user=self.user).status, Notification.CHECKED)
+        response = self.client.put(self.url, {'status': Notification.UNCHECKED, 'ids': [notification.pk]},
+                                   format='json')
+        self.assertEqual((response.data['changed'], response.data['unchecked']), (1, 1))
+        self.assertEqual(NotificationState.objects.get(user=self.other).status, Notification.CHECKED)
+
+    def test_invalid_data(self):
+        ''' The status is required, and ids must be a list of ids '''
+        self.assertEqual(self.client.put(self.url, {'status': 'read'}, format='json').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(self.url, {'status': Notification.CHECKED, 'ids': 'all'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Notification.objects.filter(status=Notification.CHECKED).exists())
+
+
+class ContentSerializerTest(APITestCase):
+
+    ''' Tests for the serializers of the content objects of the events '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        self.client.login(username='user', password='abcd')
+        self.add_events(2)
+
+    def add_events(self, number):
+        for n in range(number):
+            monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+            monitor.devices.add(self.device)
+            event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+            event.content_type.add(monitor, self.device)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response.data['results']
+
+    def test_serializer_by_model(self):
+        ''' Each content model has its serializer class, built once, and the shared Meta isn't changed '''
+        serializer = content_serializers.get(Monitor)
+        self.assertIs(content_serializers.get(Monitor), serializer)
+        self.assertEqual(serializer.Meta.model, Monitor)
+        self.assertEqual(content_serializers.get(Device).Meta.model, Device)
+        self.assertIsNone(GenericSerializer.Meta.model)
+
+    def test_events_list(self):
+        ''' The content objects of the events are serialized without queries by event '''
+        queries, data = self.count_queries(reverse('events_list'))
+        contents = data[0]['content_type']
+        self.assertEqual([(content['app_label'], content['model']) for content in contents],
+                         [('alarms', 'monitor'), ('fotuto_models', 'device')])
+        self.assertEqual(contents[0]['data']['devices'], [self.device.pk])
+        self.assertEqual(contents[1]['data']['serial'], '0001')
+        self.add_events(5)
+        self.assertEqual(self.count_queries(reverse('events_list'))[0], queries)
+
+    def test_notifications_list(self):
+        ''' The content objects of the notified events are serialized without queries by notification '''
+        queries, data = self.count_queries(reverse('notifications_list'))
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['event']['content_type'][0]['data']['devices'], [self.device.pk])
+        self.add_events(5)
+        self.assertEqual(self.count_queries(reverse('notifications_list'))[0], queries)
+
+
+class ListQueriesTest(APITestCase):
+
+    ''' The list endpoints make the same queries for any number of rows '''
+
+    ROWS = (10, 1000)
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.var = Var.objects.create(var_type='food', name='food', value=20, device=self.device, slug='food')
+        self.monitor = Monitor.objects.create(duration=10, active=True, lookups='')
+        self.monitor.devices.add(self.device)
+        self.monitor.variables.add(self.var)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.alarm.monitor.add(self.monitor)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        self.client.login(username='user', password='abcd')
+
+    def add_events(self, number):
+        AlarmEvent.objects.bulk_create([AlarmEvent(alarm=self.alarm, device=self.device, variables=self.var)
+                                        for n in range(number)])
+        events = list(AlarmEvent.objects.order_by('-pk')[:number])
+        through = AlarmEvent.content_type.through
+        content_types = {model: ContentType.objects.get_for_model(model) for model in (Monitor, Device)}
+        through.objects.bulk_create([through(gm2m_src=event, gm2m_ct=content_types[type(content)], gm2m_pk=content.pk)
+                                     for event in events for content in (self.monitor, self.device)])
+        Notification.objects.bulk_create([Notification(user=self.user, event=event) for event in events])
+
+    def add_alarms(self, number):
+        Monitor.objects.bulk_create([Monitor(duration=10, active=True, lookups='') for n in range(number)])
+        monitors = list(Monitor.objects.order_by('-pk')[:number])
+        Monitor.devices.through.objects.bulk_create([Monitor.devices.through(monitor=monitor, device=self.device)
+                                                     for monitor in monitors])
+        Alarm.objects.bulk_create([Alarm(name='alarma%d' % n, slug='alarma-%d' % n) for n in range(number)])
+        alarms = list(Alarm.objects.order_by('-pk')[:number])
+        Alarm.monitor.through.objects.bulk_create([Alarm.monitor.through(alarm=alarm, monitor=monitor)
+                                                   for alarm, monitor in zip(alarms, monitors)])
+
+    def assertConstantQueries(self, url, add_rows):
+        counts = []
+        rows = 0
+        for number in self.ROWS:
+            add_rows(number - rows)
+            rows = number
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            rows_data = response.data['results'] if 'results' in response.data else response.data
+            self.assertGreaterEqual(len(rows_data), number)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[-1], url)
+
+    def test_events_list(self):
+        ''' Events with content objects '''
+        self.assertConstantQueries(reverse('events_list') + '?page_size=%d' % MAX_PAGE_SIZE, self.add_events)
+
+    def test_notifications_list(self):
+        ''' Notifications of events with content objects '''
+        self.assertConstantQueries(reverse('notifications_list') + '?page_size=%d' % MAX_PAGE_SIZE, self.add_events)
+
+    def test_alarms_list(self):
+        ''' Alarms with their monitors '''
+        self.assertConstantQueries(reverse('alarms_list'), self.add_alarms)
+
+
+class KeysetPaginationTest(APITestCase):
+
+    ''' Tests for the cursor pagination of the events and notifications lists '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        AlarmEvent.objects.bulk_create([AlarmEvent(alarm=self.alarm, device=self.device) for n in range(25)])
+        # events created at the same time are ordered by id
+        created = timezone.now() - timezone.timedelta(hours=1)
+        AlarmEvent.objects.filter(pk__in=AlarmEvent.objects.order_by('pk').values('pk')[5:15]).update(created=created)
+        AlarmEvent.objects.filter(pk__in=AlarmEvent.objects.order_by('pk').values('pk')[:5]).update(finished=created)
+        self.client.login(username='user', password='abcd')
+
+    def pages(self, url):
+        ids = []
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.append([item['id'] for item in response.data['results']])
+            url = response.data['next']
+        return ids, response
+
+    def test_events_pages(self):
+        ''' The events are listed newest first by pages, without repeated or missing events '''
+        ids, response = self.pages(reverse('events_list') + '?page_size=10')
+        self.assertEqual([len(page) for page in ids], [10, 10, 5])
+        expected = list(AlarmEvent.objects.order_by('-created', '-id').values_list('pk', flat=True))
+        self.assertEqual(sum(ids, []), expected)
+        previous = self.client.get(response.data['previous'])
+        self.assertEqual([item['id'] for item in previous.data['results']], ids[1])
+        self.assertIsNone(self.client.get(previous.data['previous']).data['previous'])
+
+    def test_filters_in_links(self):
+        ''' The filters are kept in the links of the pages '''
+        ids, response = self.pages(reverse('events_list') + '?finished=3&page_size=5')
+        self.assertEqual(len(sum(ids, [])), 20)
+        self.assertIn('finished=3', response.data['previous'])
+
+    def test_page_queries(self):
+        ''' A deep page makes the same queries as the first one '''
+        url = reverse('events_list') + '?page_size=2'
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(url)
+        for n in range(5):
+            response = self.client.get(response.data['next'])
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(response.data['next'])
+        self.assertEqual(len(first), len(deep))
+
+    def test_invalid_cursor(self):
+        ''' A bad cursor is not found '''
+        response = self.client.get(reverse('events_list'), {'cursor': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_notifications_pages(self):
+        ''' The notifications are listed newest first by pages '''
+        Notification.objects.bulk_create([Notification(user=self.user, event=event)
+                                          for event in AlarmEvent.objects.all()])
+        ids, response = self.pages(reverse('notifications_list') + '?page_size=10')
+        expected = list(Notification.objects.order_by('-created', '-id').values_list('pk', flat=True))
+        self.assertEqual(sum(ids, []), expected)
+
+
+class SyncTest(APITestCase):
+
+    ''' Tests for the incremental sync of the events and notifications lists '''
+
+    def setUp(self):
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        assign_perm('can_subscribe', self.user, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        self.events = [AlarmEvent.objects.create(alarm=self.alarm, device=self.device) for n in range(3)]
+        self.client.login(username='user', password='abcd')
+
+    def sync(self, url, **watermark):
+        response = self.client.get(url, watermark)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']], response.data
+
+    def test_events_since_id(self):
+        ''' Only the events created after the id are listed, with the id of the last one '''
+        ids, data = self.sync(reverse('events_list'), since_id=self.events[0].pk)
+        self.assertEqual(ids, [self.events[1].pk, self.events[2].pk])
+        self.assertEqual((data['since_id'], data['more']), (self.events[2].pk, False))
+        ids, data = self.sync(reverse('events_list'), since_id=data['since_id'])
+        self.assertEqual((ids, data['since_id']), ([], self.events[2].pk))
+
+    def test_events_since(self):
+        ''' The events created or finished after the date are listed, oldest change first '''
+        ids, data = self.sync(reverse('events_list'), since=self.events[2].created.isoformat())
+        self.assertEqual(ids, [])
+        watermark = self.events[2].created.isoformat()
+        self.events[0].finished = timezone.now()
+        self.events[0].save()
+        self.events[1].finished = timezone.now() + timezone.timedelta(days=1)  # not finished yet
+        self.events[1].save()
+        event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        ids, data = self.sync(reverse('events_list'), since=watermark)
+        self.assertEqual(ids, [self.events[0].pk, event.pk])
+        self.assertEqual(data['since'], AlarmEventSerializer(event).data['created'])
+        self.assertEqual(self.sync(reverse('events_list'), since=data['since'])[0], [])
+
+    def test_notifications_since_id(self):
+        ''' Only the notifications created after the id are listed '''
+        notifications = [Notification.objects.create(user=self.user, event=event) for event in self.events]
+        ids, data = self.sync(reverse('notifications_list'), since_id=notifications[1].pk)
+        self.assertEqual((ids, data['since_id']), ([notifications[2].pk], notifications[2].pk))
+
+    def test_filters(self):
+        ''' The filters of the list are applied to the delta '''
+        AlarmEvent.objects.filter(pk=self.events[1].pk).update(finished=timezone.now())
+        ids, data = self.sync(reverse('events_list'), since_id=0, finished=3)
+        self.assertEqual(ids, [self.events[0].pk, self.events[2].pk])
+
+    def test_bad_watermark(self):
+        ''' A bad watermark is a bad request '''
+        response = self.client.get(reverse('events_list'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('notifications_list'), {'since_id': -1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_more(self):
+        ''' A limited delta doesn't split the rows changed at the same time '''
+        created = timezone.now() - timezone.timedelta(hours=1)
+        AlarmEvent.objects.filter(pk__in=[self.events[1].pk, self.events[2].pk]).update(created=created)
+        since = created - timezone.timedelta(hours=1)
+        rows, watermark, more = delta(AlarmEvent.objects.all(), since, size=2, finished=True)
+        self.assertEqual(([row.pk for row in rows], watermark, more), ([self.events[1].pk, self.events[2].pk],
+                                                                       {'since': created}, True))
+        rows, watermark, more = delta(AlarmEvent.objects.all(), since, size=1, finished=True)
+        self.assertEqual([row.pk for row in rows], [self.events[1].pk, self.events[2].pk])
+        rows, watermark, more = delta(AlarmEvent.objects.all(), watermark['since'], size=1, finished=True)
+        self.assertEqual(([row.pk for row in rows], more), ([self.events[0].pk], False))
+
+    def test_queries(self):
+        ''' The delta makes the same queries for any size of the history '''
+        since_id = self.events[1].pk
+        with CaptureQueriesContext(connection) as before:
+            self.sync(reverse('events_list'), since_id=since_id)
+        AlarmEvent.objects.bulk_create([AlarmEvent(alarm=self.alarm, device=self.device) for n in range(50)])
+        since_id = AlarmEvent.objects.latest('pk').pk - 1
+        with CaptureQueriesContext(connection) as after:
+            self.sync(reverse('events_list'), since_id=since_id)
+        self.assertEqual(len(before), len(after))
+
+
+class NotificationHubTest(TestCase):
+
+    ''' Tests for the in-process publish/subscribe of new notifications '''
+
+    def test_publish(self):
+        ''' The messages of a user are received by its listeners until they are closed '''
+        hub = NotificationHub()
+        with hub.subscribe(1) as listener, hub.subscribe(1) as other:
+            hub.publish(1, {'notification': 1, 'event': 1})
+            hub.publish(2, {'notification': 2, 'event': 1})
+            self.assertEqual(listener.get(0), [{'notification': 1, 'event': 1}])
+            self.assertEqual(other.get(0), [{'notification': 1, 'event': 1}])
+            self.assertEqual(listener.get(0), [])
+            self.assertEqual(hub.users(), {1})
+        self.assertEqual(hub.users(), set())
+
+    def test_wait(self):
+        ''' A listener waits for the messages published by other thread '''
+        hub = NotificationHub()
+        with hub.subscribe(1) as listener:
+            threading.Timer(0.1, hub.publish, (1, {'notification': 1, 'event': 1})).start()
+            self.assertEqual(listener.get(5), [{'notification': 1, 'event': 1}])
+
+    def test_full_listener(self):
+        ''' The messages of a full listener are dropped, and the listener knows it '''
+        hub = NotificationHub()
+        with mock.patch('alarms.hub.LISTENER_SIZE', 1), hub.subscribe(1) as listener:
+            hub.publish(1, {'notification': 1, 'event': 1})
+            hub.publish(1, {'notification': 2, 'event': 1})
+            self.assertEqual((listener.get(0), listener.lost), ([{'notification': 1, 'event': 1}], True))
+
+
+class NotificationStreamTest(TransactionTestCase):
+
+    ''' Tests for the stream of new notifications fed by the events fan-out '''
+
+    def setUp(self):
+        ContentType.objects.clear_cache()  # the permissions of assign_perm are deleted by each flush
+        create_permissions(apps.get_app_config('alarms'), verbosity=0)
+        patcher = mock.patch('alarms.notifications.FAN_OUT_ON_READ_MIN_GROUP', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.device = Device.objects.create(serial='0001', name='device1', connected=True)
+        self.alarm = Alarm.objects.create(name='alarma', formula='{{ var.value }} < 5', duration=1)
+        self.user = User.objects.create_user(username='user', password='abcd')
+        self.members = [User.objects.create_user(username='member%d' % n, password='abcd') for n in range(2)]
+        self.group = Group.objects.create(name='operators')
+        self.group.user_set.add(*self.members)
+        assign_perm('can_subscribe', self.user, self.alarm)
+        assign_perm('can_subscribe', self.group, self.alarm)
+        Subscription.objects.create(active=True, user=self.user, alarm=self.alarm, email=False)
+        Subscription.objects.create(active=True, group=self.group, alarm=self.alarm, email=False)
+        self.client.login(username='user', password='abcd')
+
+    def test_fan_out_published(self):
+        ''' The notifications of an event are published to their listening users after the commit '''
+        with notification_hub.subscribe(self.user.pk) as listener, \
+                notification_hub.subscribe(self.members[0].pk) as member:
+            with transaction.atomic():
+                event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+                self.assertEqual(listener.get(0), [])
+            own = Notification.objects.get(user=self.user)
+            group = Notification.objects.get(group=self.group)
+            self.assertEqual(listener.get(0), [{'notification': own.pk, 'event': event.pk}])
+            self.assertEqual(member.get(0), [{'notification': group.pk, 'event': event.pk}])
+
+    def test_long_poll(self):
+        ''' The long-poll returns the notifications after since_id at once, or waits for new ones '''
+        event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        notification = Notification.objects.get(user=self.user)
+        url = reverse('notifications_stream')
+        response = self.client.get(url, {'since_id': 0})
+        self.assertEqual(response.data, {'since_id': notification.pk,
+                                         'results': [{'notification': notification.pk, 'event': event.pk}]})
+        response = self.client.get(url, {'since_id': notification.pk, 'timeout': 0})
+        self.assertEqual(response.data, {'since_id': notification.pk, 'results': []})
+        threading.Timer(0.2, AlarmEvent.objects.create, kwargs={'alarm': self.alarm, 'device': self.device}).start()
+        response = self.client.get(url, {'since_id': notification.pk, 'timeout': 10})
+        self.assertEqual(response.data['results'][0]['event'], AlarmEvent.objects.latest('pk').pk)
+
+    def test_server_sent_events(self):
+        ''' The server-sent events stream sends the notifications after Last-Event-ID, then the new ones '''
+        event = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        notification = Notification.objects.get(user=self.user)
+        response = self.client.get(reverse('notifications_stream'), HTTP_ACCEPT='text/event-stream',
+                                   HTTP_LAST_EVENT_ID='0')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertTrue(next(stream).startswith(b'retry: '))
+        self.assertEqual(next(stream).decode(), 'id: %d\nevent: notification\ndata: %s\n\n' % (
+            notification.pk, json.dumps({'notification': notification.pk, 'event': event.pk})))
+        self.assertEqual(notification_hub.users(), {self.user.pk})
+        new = AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        self.assertIn('"event": %d' % new.pk, next(stream).decode())
+        response.close()
+        self.assertEqual(notification_hub.users(), set())
+
+    def test_server_sent_events_lost(self):
+        ''' Messages dropped by the listener of a stream opened without Last-Event-ID are taken from database '''
+        AlarmEvent.objects.create(alarm=self.alarm, device=self.device)
+        response = self.client.get(reverse('notifications_stream'), HTTP_ACCEPT='text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertTrue(next(stream).startswith(b'retry: '))
+        with mock.patch('alarms.hub.Listener.put', lambda listener, message: setattr(listener, 'lost', True)):
+            events = [AlarmEvent.objects.create(alarm=self.alarm, device=self.device) for n in range(2)]
+        for event in events:
+            self.assertIn('"event": %d' % event.pk, next(stream).decode())
+        response.close()
+
+    def test_bad_requests(self):
+        ''' The stream is only for authenticated users, and the timeout is limited '''
+        response = self.client.get(reverse('notifications_stream'), {'timeout': 1000})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.logout()
+        response = self.client.get(reverse('notifications_stream'), {'timeout': 0})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
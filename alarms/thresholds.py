@@ -0,0 +1,134 @@
+# coding=utf-8
+import ast
+from bisect import bisect_left, bisect_right
+from .expressions import FormulaError, parse_formula, constant_value
+
+VALUE_PATH = ('var', 'value')
+
+# Comparison of the value with the threshold, with the placeholder at the left: {{ var.value }} > 12
+GREATER, GREATER_EQUAL, LESS, LESS_EQUAL, EQUAL, NOT_EQUAL = '>', '>=', '<', '<=', '==', '!='
+COMPARISONS = {ast.Gt: GREATER, ast.GtE: GREATER_EQUAL, ast.Lt: LESS, ast.LtE: LESS_EQUAL, ast.Eq: EQUAL,
+               ast.NotEq: NOT_EQUAL}
+# 12 < {{ var.value }} is {{ var.value }} > 12
+REVERSED = {GREATER: LESS, GREATER_EQUAL: LESS_EQUAL, LESS: GREATER, LESS_EQUAL: GREATER_EQUAL, EQUAL: EQUAL,
+            NOT_EQUAL: NOT_EQUAL}
+
+
+def number(node):
+
+    """
+    Value of a number constant node, i.e 12, -5 or 2.5. Raise FormulaError for other nodes
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = number(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+    value = constant_value(node)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:  # no booleans or NaN
+        raise FormulaError('%r is not a number' % value)
+    return value
+
+
+def formula_threshold(formula):
+
+    """
+    Comparison and threshold of formulas which compare the var value with a number,
+    i.e {{ var.value }} > 12 -> ('>', 12), 5 >= {{ var.value }} -> ('<=', 5)
+    :return: (comparison, threshold), or None for other formulas
+    """
+    try:
+        expression = parse_formula(formula)
+    except FormulaError:
+        return None
+    body = expression.tree.body
+    if not isinstance(body, ast.Compare) or len(body.ops) != 1 or type(body.ops[0]) not in COMPARISONS:
+        return None
+    if len(expression.placeholders) != 1:
+        return None
+    placeholder = expression.placeholders[0]
+    if placeholder.path != VALUE_PATH or placeholder.filters:
+        return None
+    comparison = COMPARISONS[type(body.ops[0])]
+    left, right = body.left, body.comparators[0]
+    try:
+        if isinstance(left, ast.Name) and left.id in expression.names:
+            return comparison, number(right)
+        if isinstance(right, ast.Name) and right.id in expression.names:
+            return REVERSED[comparison], number(left)
+    except FormulaError:
+        return None
+    return None
+
+
+class ThresholdSet(object):
+
+    """
+    Index of alarms which formula compares the var value with a number, i.e {{ var.value }} > 12.
+    Thresholds are kept in sorted lists by comparison, so the alarms triggered by a value are found
+    by bisection instead of evaluating each formula. The alarms which aren't triggered are cleared.
+    """
+
+    def __init__(self, alarms):
+
+        """
+        :param alarms: list of (alarm id, formula), alarms which formula isn't a threshold are ignored
+        """
+        self.formulas = {}  # alarm id -> formula, of indexed alarms
+        by_comparison = {comparison: [] for comparison in REVERSED}
+        for alarm_id, formula in alarms:
+            threshold = formula_threshold(formula)
+            if threshold is not None:
+                self.formulas[alarm_id] = formula
+                by_comparison[threshold[0]].append((threshold[1], alarm_id))
+        self.sorted = {}  # comparison -> (sorted thresholds, alarm ids)
+        for comparison in (GREATER, GREATER_EQUAL, LESS, LESS_EQUAL):
+            items = sorted(by_comparison[comparison])
+            self.sorted[comparison] = ([threshold for threshold, alarm_id in items],
+                                       [alarm_id for threshold, alarm_id in items])
+        self.equal = {}  # threshold -> alarm ids
+        for threshold, alarm_id in by_comparison[EQUAL]:
+            self.equal.setdefault(threshold, set()).add(alarm_id)
+        self.not_equal = {}
+        for threshold, alarm_id in by_comparison[NOT_EQUAL]:
+            self.not_equal.setdefault(threshold, set()).add(alarm_id)
+        self.all_not_equal = set(alarm_id for threshold, alarm_id in by_comparison[NOT_EQUAL])
+
+    def __len__(self):
+        return len(self.formulas)
+
+    def __contains__(self, alarm_id):
+        return alarm_id in self.formulas
+
+    def matches(self, alarm):
+
+        """
+        True if the alarm is indexed with its current formula
+        """
+        return self.formulas.get(alarm.pk) == alarm.formula
+
+    @staticmethod
+    def accepts(value):
+
+        """
+        Only numbers are compared by bisection, other values are evaluated with the formula
+        """
+        return not isinstance(value, bool) and isinstance(value, (int, float)) and value == value
+
+    def triggered(self, value):
+
+        """
+        Alarms which formula is True for the value
+        :return: set of alarm ids
+        """
+        triggered = set()
+        thresholds, alarm_ids = self.sorted[GREATER]  # threshold < value
+        triggered.update(alarm_ids[:bisect_left(thresholds, value)])
+        thresholds, alarm_ids = self.sorted[GREATER_EQUAL]  # threshold <= value
+        triggered.update(alarm_ids[:bisect_right(thresholds, value)])
+        thresholds, alarm_ids = self.sorted[LESS]  # threshold > value
+        triggered.update(alarm_ids[bisect_right(thresholds, value):])
+        thresholds, alarm_ids = self.sorted[LESS_EQUAL]  # threshold >= value
+        triggered.update(alarm_ids[bisect_left(thresholds, value):])
+        triggered.update(self.equal.get(value, ()))
+        if self.all_not_equal:
+            triggered.update(self.all_not_equal - self.not_equal.get(value, set()))
+        return triggered
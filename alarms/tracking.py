@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Fields changed by the saves of Vars and Devices, to evaluate only the saves which change fields used by formulas.
+The values of an instance are compared with the ones remembered when it was loaded or last saved, not with
+database: changes made by other writers meanwhile (other processes, queryset updates, the ingest API) aren't seen.
+So the fields of ALWAYS_CHANGED are changed by every save which writes them, i.e an instance loaded with value 3
+is evaluated when it's saved again with value 3, although other writer saved 5 after it was loaded.
+"""
+from django.core.exceptions import FieldDoesNotExist
+
+# Instance attributes set by the tracking receivers of Var and Device
+SAVED_VALUES = '_alarms_saved_values'
+CHANGED_FIELDS = '_alarms_changed_fields'
+# Attnames which are changed by all the saves which write them (see module docstring)
+ALWAYS_CHANGED = {'value'}
+
+
+def field_values(instance):
+
+    """
+    Values of the loaded concrete fields of an instance, by attname. Deferred fields aren't read,
+    so the database isn't queried
+    """
+    return {field.attname: instance.__dict__[field.attname] for field in instance._meta.concrete_fields
+            if field.attname in instance.__dict__}
+
+
+def remember_values(instance, version=None):
+
+    """
+    Save the current field values, to compare them in the next save
+    :param version: version of the alarms configuration, values saved with other version aren't compared
+    """
+    setattr(instance, SAVED_VALUES, (version, field_values(instance)))
+
+
+def remember_changed_fields(instance, update_fields=None, version=None):
+
+    """
+    Save in the instance the fields changed since it was loaded or saved, and remember the new values.
+    The changed fields are None (unknown, all of them) for new instances, or if the alarms configuration
+    changed since the values were remembered. The fields of ALWAYS_CHANGED are always changed
+    :param update_fields: update_fields argument of save, only these fields are saved
+    :param version: version of the alarms configuration
+    """
+    saved_version, saved_values = getattr(instance, SAVED_VALUES, (None, None))
+    values = field_values(instance)
+    if instance._state.adding or saved_values is None or saved_version != version:
+        changed = None
+    else:
+        changed = set(attname for attname, value in values.items()
+                      if attname not in saved_values or saved_values[attname] != value)
+        changed |= ALWAYS_CHANGED & set(values)
+        if update_fields is not None:
+            changed &= set(instance._meta.get_field(name).attname for name in update_fields)
+    setattr(instance, CHANGED_FIELDS, changed)
+    setattr(instance, SAVED_VALUES, (version, values))
+
+
+def changed_fields(instance):
+
+    """
+    Fields changed by the last save of the instance, None if unknown
+    """
+    return getattr(instance, CHANGED_FIELDS, None)
+
+
+def fields_changed(changed, fields):
+
+    """
+    True if some of fields is in changed fields
+    :param changed: changed fields, None if they are unknown
+    :param fields: fields to check, None for any field
+    """
+    if changed is None or fields is None:
+        return True
+    return bool(changed & fields)
+
+
+def model_attnames(model, names):
+
+    """
+    Attnames of the concrete fields of a model, i.e ['value', 'device'] -> {'value', 'device_id'}
+    :return: set of attnames, or None if some name isn't a concrete field (reverse relations, properties)
+    """
+    attnames = set()
+    for name in names:
+        if name is None:
+            return None
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not getattr(field, 'concrete', False):
+            return None
+        attnames.add(field.attname)
+    return attnames
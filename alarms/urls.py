@@ -1,6 +1,7 @@
 
 from django.conf.urls import url
-from .views import AlarmEventList, AlarmEventDetail, SubscriptionList, SubscriptionDetail, AlarmList, AlarmDetail, NotificationList, NotificationDetail
+from .views import AlarmEventList, AlarmEventDetail, SubscriptionList, SubscriptionDetail, AlarmList, AlarmDetail, NotificationList, NotificationDetail, \
+    NotificationCount, NotificationStatus, NotificationStream, VarValuesIngest
 from rest_framework.urlpatterns import format_suffix_patterns
 from django.views.generic import TemplateView
 
@@ -13,7 +14,11 @@ urlpatterns = [
     url(r'api/alarms/subscriptions/$', SubscriptionList.as_view(), name='subscriptions_list'),
     url(r'api/alarms/subscriptions/(?P<pk>[0-9]+)/$', SubscriptionDetail.as_view(), name='subscriptions_detail'),
     url(r'api/alarms/notifications/$', NotificationList.as_view(), name='notifications_list'),
+    url(r'api/alarms/notifications/count/$', NotificationCount.as_view(), name='notifications_count'),
+    url(r'api/alarms/notifications/status/$', NotificationStatus.as_view(), name='notifications_status'),
+    url(r'api/alarms/notifications/stream/$', NotificationStream.as_view(), name='notifications_stream'),
     url(r'api/alarms/notifications/(?P<pk>[0-9]+)/$', NotificationDetail.as_view(), name='notifications_detail'),
+    url(r'api/alarms/ingest/$', VarValuesIngest.as_view(), name='values_ingest'),
     ### END API endpoints ###
 
 ]
@@ -0,0 +1,208 @@
+# coding=utf-8
+import ast
+from .expressions import FormulaError, BOOL_OPERATORS, CONSTANT_NAMES, constant_value
+from .templatetags.alarms_template_filters import bit
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is in requirements.txt, without it formulas are evaluated var by var
+    np = None
+    print('NumPy is not installed, formulas of monitors with lookups are evaluated var by var (not vectorized)')
+
+# Constants and shifts are limited, so int64 results are the same as python ints for IntegerField values
+MAX_CONSTANT = 2 ** 31
+MAX_SHIFT = 31
+
+
+def as_numbers(array):
+
+    """
+    Booleans are used as integers in arithmetic, as in python (True + 1 == 2)
+    """
+    array = np.asarray(array)
+    return array.astype(np.int64) if array.dtype == np.bool_ else array
+
+
+def truthy(array):
+    return array != 0
+
+
+def vector_constant(node):
+    if isinstance(node, ast.Name) and node.id not in CONSTANT_NAMES:
+        raise FormulaError('Name %s is not a constant' % node.id)
+    value = CONSTANT_NAMES[node.id] if isinstance(node, ast.Name) else constant_value(node)
+    if isinstance(value, bool) or (isinstance(value, (int, float)) and abs(value) < MAX_CONSTANT):
+        return value
+    raise FormulaError('Constant %r is not vectorized' % value)
+
+
+def compile_vector_node(node, placeholders):
+
+    """
+    Compile a formula AST node into a function over NumPy arrays, with the semantics of compile_node
+    :param node: AST node
+    :param placeholders: dict with placeholder names -> index in columns list
+    :return: function(columns) -> array, raise FormulaError if the node can't be vectorized
+    """
+    if isinstance(node, ast.Expression):
+        return compile_vector_node(node.body, placeholders)
+
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, BOOL_OPERATORS):
+        operands = [compile_vector_node(value, placeholders) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        def evaluate_bool(columns):
+            # a and b -> b if a else a, a or b -> a if a else b, by element
+            result = operands[-1](columns)
+            for operand in reversed(operands[:-1]):
+                value = operand(columns)
+                result = np.where(truthy(value), result, value) if is_and else np.where(truthy(value), value, result)
+            return result
+        return evaluate_bool
+
+    if isinstance(node, ast.BinOp):
+        left, right = compile_vector_node(node.left, placeholders), compile_vector_node(node.right, placeholders)
+        op = type(node.op)
+        if op in (ast.Add, ast.Sub, ast.Mult, ast.BitAnd, ast.BitOr, ast.BitXor):
+            function = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.BitAnd: np.bitwise_and,
+                        ast.BitOr: np.bitwise_or, ast.BitXor: np.bitwise_xor}[op]
+            if op in (ast.Add, ast.Sub, ast.Mult):
+                return lambda columns: function(as_numbers(left(columns)), as_numbers(right(columns)))
+            return lambda columns: function(left(columns), right(columns))
+        # The right operand of divisions and shifts should be a constant, so they never fail
+        constant = vector_constant(node.right)
+        if op in (ast.Div, ast.FloorDiv, ast.Mod) and constant:
+            function = {ast.Div: np.true_divide, ast.FloorDiv: np.floor_divide, ast.Mod: np.mod}[op]
+            return lambda columns: function(as_numbers(left(columns)), constant)
+        if op in (ast.LShift, ast.RShift) and isinstance(constant, int) and 0 <= constant <= MAX_SHIFT:
+            function = np.left_shift if op is ast.LShift else np.right_shift
+            return lambda columns: function(as_numbers(left(columns)), constant)
+        raise FormulaError('Operator %s is not vectorized' % op.__name__)
+
+    if isinstance(node, ast.UnaryOp):
+        operand = compile_vector_node(node.operand, placeholders)
+        function = {ast.Not: lambda value: np.logical_not(truthy(value)),
+                    ast.USub: lambda value: np.negative(as_numbers(value)),
+                    ast.UAdd: as_numbers,
+                    ast.Invert: lambda value: np.invert(as_numbers(value))}.get(type(node.op))
+        if function is None:
+            raise FormulaError('Operator %s is not vectorized' % type(node.op).__name__)
+        return lambda columns: function(operand(columns))
+
+    if isinstance(node, ast.Compare):
+        left = compile_vector_node(node.left, placeholders)
+        comparisons = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(comparator, (ast.Tuple, ast.List)):
+                    raise FormulaError('Only in constant tuples is vectorized')
+                items = [vector_constant(item) for item in comparator.elts]
+                invert = isinstance(op, ast.NotIn)
+                comparisons.append((lambda a, b, items=items, invert=invert: np.isin(a, items, invert=invert), None))
+                continue
+            function = {ast.Eq: np.equal, ast.NotEq: np.not_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+                        ast.Gt: np.greater, ast.GtE: np.greater_equal}.get(type(op))
+            if function is None:
+                raise FormulaError('Operator %s is not vectorized' % type(op).__name__)
+            comparisons.append((function, compile_vector_node(comparator, placeholders)))
+
+        def evaluate_compare(columns):
+            current = left(columns)
+            result = None
+            for function, comparator in comparisons:
+                other = comparator(columns) if comparator is not None else None
+                value = function(current, other)
+                result = value if result is None else result & value
+                current = other
+            return result
+        return evaluate_compare
+
+    if isinstance(node, ast.Name) and node.id in placeholders:
+        index = placeholders[node.id]
+        return lambda columns: columns[index]
+
+    constant = vector_constant(node)
+    return lambda columns: constant
+
+
+def vector_bit(column, number):
+
+    """
+    bit filter over an array. For negative values bit works with the digits of bin(value)[2:],
+    i.e 'b11' for -3: it takes the bits of the absolute value, fails taking the 'b' and is 0 after it
+    :return: bits array, valid array (False where bit fails)
+    """
+    absolute = np.abs(column.astype(np.int64))
+    bits = np.right_shift(absolute, number) & 1
+    if number == 0:
+        return bits, np.ones(len(column), dtype=np.bool_)
+    # the 'b' is taken when the absolute value has number digits
+    fails = (column < 0) & (absolute >= 2 ** (number - 1)) & (absolute < 2 ** number)
+    return bits, ~fails
+
+
+class VectorizedExpression(object):
+
+    """
+    Formula evaluated over arrays of values, for formulas which only use fields of the evaluated var,
+    with or without bit filter, i.e "{{ var.value }} > 12" or "{{ var.value | bit:2 }} and {{ var.value }} < 5".
+    All the vars of a monitor are evaluated at once, instead of one by one.
+    """
+
+    def __init__(self, expression):
+        if np is None:
+            raise FormulaError('NumPy is not installed')
+        self.formula = expression.formula
+        self.fields = []  # var field of each placeholder
+        self.bits = []  # bit filter argument of each placeholder, or None
+        for placeholder in expression.placeholders:
+            path = placeholder.path
+            if len(path) != 2 or path[0] != 'var' or placeholder.simple_filters is None:
+                raise FormulaError('Placeholder %s is not vectorized' % '.'.join(path))
+            filters = placeholder.simple_filters
+            if filters and (len(filters) > 1 or filters[0][0] is not bit or not isinstance(filters[0][1][0], int)):
+                raise FormulaError('Filters of %s are not vectorized' % '.'.join(path))
+            self.fields.append(path[1])
+            self.bits.append(filters[0][1][0] if filters else None)
+        self.function = compile_vector_node(expression.tree, expression.names)
+
+    def evaluate(self, vars):
+
+        """
+        Evaluate the formula for each var
+        :param vars: list of Var instances or dicts
+        :return: (true mask, false mask), arrays of booleans. Vars which evaluation fails are in none of them
+        """
+        columns = []
+        valid = np.ones(len(vars), dtype=np.bool_)
+        for field, bit_number in zip(self.fields, self.bits):
+            values = [var[field] if isinstance(var, dict) else getattr(var, field) for var in vars]
+            column = np.array(values)
+            if column.dtype.kind not in 'biuf':  # None, text or objects
+                raise FormulaError('Values of %s are not numbers' % field)
+            if bit_number is not None:
+                if column.dtype.kind not in 'iu':
+                    raise FormulaError('bit filter of not integer values')
+                column, bit_valid = vector_bit(column, bit_number)
+                valid &= bit_valid
+            columns.append(column)
+        with np.errstate(all='ignore'):
+            result = np.broadcast_to(self.function(columns), (len(vars), ))
+        # as condition == True and condition == False of the evaluation by var
+        return valid & (result == 1), valid & (result == 0)
+
+
+def vectorize(expression):
+
+    """
+    Vectorized version of an expression, None if it can't be evaluated over arrays.
+    It's saved in the expression, which is cached by formula.
+    """
+    if expression is None:
+        return None
+    if not hasattr(expression, 'vectorized'):
+        try:
+            expression.vectorized = VectorizedExpression(expression)
+        except FormulaError:
+            expression.vectorized = None
+    return expression.vectorized
@@ -1,15 +1,24 @@
 from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.settings import api_settings
 from rest_framework import status, generics
 from django.db.models import Q
 from django_filters import rest_framework as filters
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from .models import Monitor, Alarm, AlarmEvent, Subscription, Notification
 from .serializers import MonitorSerializer, AlarmSerializer, AlarmEventSerializer, SubscriptionSerializer, \
-                         NotificationSerializer
+                         NotificationSerializer, NotificationCounterSerializer, VarValueSerializer, SinceSerializer, \
+                         StreamSerializer, prefetch_contents
 from guardian.shortcuts import get_user_perms, get_group_perms
 from .filters import SubscriptionFilter, NotificationFilter, AlarmEventFilter
+from .ingest import ingest_values
+from .notifications import user_notifications, is_recipient, set_state, update_status
+from .counters import get_counter, reset_counters
+from .pagination import KeysetPagination
+from .sync import delta
+from .streams import EventStreamRenderer, long_poll, event_stream, STREAM_TIMEOUT
 
 from django.apps import apps
 Device = apps.get_model(settings.DEVICE_MODEL)
@@ -26,9 +35,9 @@ class AlarmList(APIView):
     def get(self, request, format=None):
 
         """
-        Get all alarms
+        Get all alarms, with their monitors and the devices and vars of the monitors in one query each
         """
-        alarms = Alarm.objects.all()
+        alarms = Alarm.objects.prefetch_related('monitor__devices', 'monitor__variables')
         serializer = AlarmSerializer(alarms, many=True)
         return Response(serializer.data)
 
@@ -62,7 +71,7 @@ class AlarmDetail(APIView):
         Get a Alarm by PK
         """
         try:
-            alarm = Alarm.objects.get(pk=pk)
+            alarm = Alarm.objects.prefetch_related('monitor__devices', 'monitor__variables').get(pk=pk)
             serializer = AlarmSerializer(alarm)
             return Response(serializer.data)
         except Alarm.DoesNotExist:
@@ -93,14 +102,57 @@ class AlarmDetail(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class AlarmEventList(generics.ListAPIView):
+class ContentPrefetchMixin(object):
+
+    """
+    List views of events (or objects with an event): the content objects of the listed events
+    are prefetched at once before serializing them (see serializers.prefetch_contents)
+    """
+
+    def events_of(self, instances):
+        return instances
+
+    def get_serializer(self, *args, **kwargs):
+        if kwargs.get('many') and args:
+            instances = list(args[0])
+            prefetch_contents(self.events_of(instances))
+            args = (instances, ) + args[1:]
+        return super(ContentPrefetchMixin, self).get_serializer(*args, **kwargs)
+
+
+class SinceMixin(object):
+
+    """
+    List views with incremental sync: with the since or since_id parameter, only the rows changed after the
+    watermark are listed, oldest first and without pages, with the watermark of the next request (see sync.delta)
+    """
+    since_finished = False  # the rows have a finished date
+
+    def list(self, request, *args, **kwargs):
+        if 'since' not in request.query_params and 'since_id' not in request.query_params:
+            return super(SinceMixin, self).list(request, *args, **kwargs)
+        watermark = SinceSerializer(data=request.query_params)
+        if not watermark.is_valid():
+            return Response(watermark.errors, status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset())
+        rows, next_watermark, more = delta(queryset, watermark.validated_data.get('since'),
+                                           watermark.validated_data.get('since_id'), finished=self.since_finished)
+        data = SinceSerializer(next_watermark).data
+        data['more'] = more
+        data['results'] = self.get_serializer(rows, many=True).data
+        return Response(data)
+
+
+class AlarmEventList(SinceMixin, ContentPrefetchMixin, generics.ListAPIView):
 
     """
-    List AlarmEvents by filters, or create a new AlarmEvent
+    List AlarmEvents by filters, newest first by pages (see pagination.KeysetPagination), or create a new AlarmEvent
     """
     serializer_class = AlarmEventSerializer
     filter_backends = (filters.DjangoFilterBackend, )
     filter_class = AlarmEventFilter
+    pagination_class = KeysetPagination
+    since_finished = True
 
     def get_queryset(self):
 
@@ -109,7 +161,7 @@ class AlarmEventList(generics.ListAPIView):
         """
         alarms = Subscription.objects.filter(Q(user__in=[self.request.user])
                                          | Q(group__in=self.request.user.groups.all())).values_list('alarm', flat=True)
-        return AlarmEvent.objects.filter(alarm__in=alarms)
+        return AlarmEvent.objects.filter(alarm__in=alarms).prefetch_related('content_type')
 
     def post(self, request, format=None):
 
@@ -233,22 +285,26 @@ class SubscriptionDetail(APIView):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
 
-class NotificationList(generics.ListAPIView):
+class NotificationList(SinceMixin, ContentPrefetchMixin, generics.ListAPIView):
 
     """
-    List Notifications by Filters
+    List Notifications by Filters, newest first by pages (see pagination.KeysetPagination)
     """
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
     filter_backends = (filters.DjangoFilterBackend, )
     filter_class = NotificationFilter
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
 
         """
-        Get user's notifications only
+        Get user's notifications only, with the notifications of its groups
         """
-        return Notification.objects.filter(user=self.request.user)
+        return user_notifications(self.request.user).select_related('event')
+
+    def events_of(self, instances):
+        return [notification.event for notification in instances]
 
     def post(self, request, format=None):
 
@@ -262,6 +318,79 @@ class NotificationList(generics.ListAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class NotificationCount(APIView):
+
+    """
+    Unchecked notifications of the user and id of its latest notification, for the notifications badge.
+    It's read from the counter of the user (see alarms.counters), the notifications aren't counted
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def get(self, request, format=None):
+        return Response(NotificationCounterSerializer(get_counter(request.user)).data)
+
+
+class NotificationStream(APIView):
+
+    """
+    New notifications of the user as they are created (see alarms.hub), so clients don't poll the notifications list:
+    server-sent events if the client accepts text/event-stream, or else a long-poll
+    """
+    permission_classes = (IsAuthenticated, )
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (EventStreamRenderer, )
+
+    def get(self, request, format=None):
+
+        """
+        Server-sent events from the notification after since_id (or the Last-Event-ID header), or a long-poll which
+        returns the notifications after since_id at once, or waits up to timeout seconds for new ones
+        """
+        params = request.query_params.dict()
+        if 'since_id' not in params and 'HTTP_LAST_EVENT_ID' in request.META:
+            params['since_id'] = request.META['HTTP_LAST_EVENT_ID']
+        serializer = StreamSerializer(data=params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        since_id = serializer.validated_data.get('since_id')
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            response = StreamingHttpResponse(event_stream(request.user, since_id), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            return response
+        messages = long_poll(request.user, since_id, serializer.validated_data.get('timeout', STREAM_TIMEOUT))
+        return Response({'since_id': messages[-1]['notification'] if messages else since_id, 'results': messages})
+
+
+class NotificationStatus(APIView):
+
+    """
+    Change the status of many notifications of the user, i.e mark all as read
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def put(self, request, format=None):
+
+        """
+        Change to status the notifications with ids, or all the notifications selected by the filters of the list
+        (query params, i.e ?event__alarm=1&event__created_0=2018-04-20), with one update. Only the notifications
+        of the user are changed. {"status": "checked", "ids": [1, 2]}
+        """
+        value = request.data.get('status')
+        if value not in dict(Notification.CHECKED_CHOICES):
+            return Response(data={'status': ['"%s" is not a valid choice.' % value]}, status=status.HTTP_400_BAD_REQUEST)
+        notifications = NotificationFilter(request.query_params, queryset=user_notifications(request.user),
+                                           request=request).qs
+        ids = request.data.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(pk, int) for pk in ids):
+                return Response(data={'ids': ['A list of notification ids is required.']},
+                                status=status.HTTP_400_BAD_REQUEST)
+            notifications = notifications.filter(pk__in=ids)
+        changed = update_status(notifications, request.user, value)
+        reset_counters(user_ids=[request.user.pk])
+        counter = NotificationCounterSerializer(get_counter(request.user)).data
+        return Response(dict(counter, changed=changed), status=status.HTTP_200_OK)
+
+
 class NotificationDetail(APIView):
 
     """
@@ -271,10 +400,13 @@ class NotificationDetail(APIView):
     def get(self, request, pk, format=None):
 
         """
-        Get notification by pk, if user is owner
+        Get notification by pk, if user is owner (or is in the notified group)
         """
         try:
             notification = Notification.objects.get(pk=pk)
+            if notification.group_id is not None and is_recipient(notification, request.user):
+                notification = user_notifications(request.user).get(pk=notification.pk)
+                return Response(NotificationSerializer(notification).data)
             serializer = NotificationSerializer(notification)
             if serializer.data['user'] == request.user.id:
                 return Response(serializer.data)
@@ -285,7 +417,7 @@ class NotificationDetail(APIView):
     def put(self, request, pk):
 
         """
-        Only can change status information
+        Only can change status information. The status of a group notification is changed only for the user
         """
         try:
             notification = Notification.objects.get(pk=pk)
@@ -294,6 +426,10 @@ class NotificationDetail(APIView):
             if request_serializer.is_valid():
                 user_id = noti_serializer.data['user']
                 if 'status' in self.request.data.keys() and len(self.request.data.keys()) == 1:  # Only can change status field
+                    if notification.group_id is not None and is_recipient(notification, self.request.user):
+                        set_state(notification, self.request.user, status=request_serializer.validated_data['status'])
+                        notification = user_notifications(self.request.user).get(pk=notification.pk)
+                        return Response(NotificationSerializer(notification).data, status=status.HTTP_200_OK)
                     if user_id == self.request.user.id:
                         request_serializer.save()
                         return Response(request_serializer.data, status=status.HTTP_200_OK)  # if ok
@@ -306,13 +442,34 @@ class NotificationDetail(APIView):
     def delete(self, request, pk, format=None):
 
         """
-        Delete a notification by pk '''
+        Delete a notification by pk. A group notification is only hidden for the user '''
         """
         try:
             notification = Notification.objects.get(pk=pk)
+            if notification.group_id is not None:
+                if not is_recipient(notification, request.user):
+                    return Response(data={'detail': 'Not Authorized User'}, status=status.HTTP_403_FORBIDDEN)
+                set_state(notification, request.user, hidden=True)
+                return Response(status=status.HTTP_204_NO_CONTENT)
             notification.delete()
             return Response(status=status.HTTP_204_NO_CONTENT)
         except Notification.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+class VarValuesIngest(APIView):
+
+    """
+    Save a batch of var values and evaluate their alarms once
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def post(self, request, format=None):
+
+        """
+        Ingest a list of values, i.e [{"var": 1, "value": 3, "timestamp": 1525000000.0}, {"var": "food", "value": 0}]
+        """
+        serializer = VarValueSerializer(data=request.data, many=True)
+        if serializer.is_valid():
+            return Response(ingest_values(serializer.validated_data), status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
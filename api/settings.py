@@ -146,4 +146,38 @@ STATIC_URL = '/static/'
 VAR_MODEL = 'fotuto_models.Var'
 DEVICE_MODEL = 'fotuto_models.Device'
 PROFILE_MODEL = 'fotuto_models.Profile'
-VARLOG_MODEL ='fotuto_models.VarLog'
\ No newline at end of file
+VARLOG_MODEL ='fotuto_models.VarLog'
+# Alarms evaluation queue: 'sync' evaluate alarms in the post_save of Var and Device, 'local' in worker threads
+# of the process, 'sqlite' in a queue file drained by worker threads or by "python manage.py alarms_worker"
+ALARMS_EVALUATION_QUEUE = 'sync'
+ALARMS_EVALUATION_WORKERS = 2
+ALARMS_EVALUATION_QUEUE_PATH = os.path.join(BASE_DIR, 'alarms_queue.sqlite3')
+# Seconds the sqlite queue tasks taken by a worker are reserved for it, before other worker evaluates them again
+ALARMS_EVALUATION_LEASE = 60
+# Evaluate once by var or device the updates of a transaction, after the commit
+ALARMS_EVALUATION_COALESCE = True
+# Seconds before the in memory open events states are built again from database
+ALARMS_EVENT_STATES_TTL = 60
+# Seconds before the subscribed users of an alarm are resolved again from database
+ALARMS_AUDIENCE_TTL = 60
+# Event emails are put in an outbox and delivered by a thread of the process, with False only by
+# "python manage.py alarms_outbox"
+ALARMS_EMAIL_OUTBOX_SENDER = True
+# Emails delivered by connection, attempts before an email is failed, and seconds before the first retry
+ALARMS_EMAIL_OUTBOX_BATCH_SIZE = 100
+ALARMS_EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+ALARMS_EMAIL_OUTBOX_BACKOFF = 60
+# Seconds the events of digest subscriptions are accumulated before they are sent in one email by user
+ALARMS_EMAIL_DIGEST_WINDOW = 900
+# Group subscriptions with at least this number of users create one notification by group, computed by user on read
+# (None: a notification by user)
+ALARMS_FAN_OUT_ON_READ_MIN_GROUP = None
+# Events and notifications by page of their lists (clients can ask up to 1000 with ?page_size=)
+ALARMS_PAGE_SIZE = 100
+# Maximum events or notifications of a delta of the incremental sync (?since= or ?since_id=)
+ALARMS_SYNC_SIZE = 1000
+# Seconds a long-poll of the new notifications stream waits (maximum ?timeout=), seconds a server-sent events
+# stream is open before the client reconnects, and messages kept for a stream which doesn't read them
+ALARMS_STREAM_TIMEOUT = 30
+ALARMS_STREAM_DURATION = 300
+ALARMS_STREAM_LISTENER_SIZE = 1000